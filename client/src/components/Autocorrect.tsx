@@ -25,6 +25,13 @@ const Autocorrect: React.FC = () => {
   // Create a Map to act like an OrderedDict for caching
   const cache = useRef<Map<string, string[]>>(new Map());
 
+  // Identifies this text field to the server, which keeps the Trie walk of its last
+  // keystroke and drops the requests of words we have typed past already
+  const sessionId = useRef(Math.random().toString(36).slice(2));
+
+  // The word of the last request; replies for any other word arrive too late to be shown
+  const latestWord = useRef('');
+
   // Load cache from localStorage
   const loadCache = () => {
     const storedCache = localStorage.getItem('autocorrectCache');
@@ -56,6 +63,7 @@ const Autocorrect: React.FC = () => {
   const fetchSuggestions = async (word: string) => {
     if (word.length <= 1 || word.length > 22)
       return;
+    latestWord.current = word;
     if (cache.current.has(word)) {
         console.log(`Cache hit for word: ${word}`);
         console.log(`size of cache: ${cache.current.get(word).length}`);
@@ -75,7 +83,7 @@ const Autocorrect: React.FC = () => {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ input_word: word })
+        body: JSON.stringify({ input_word: word, session_id: sessionId.current })
       });
       console.log("Response from server: ", response);
 
@@ -84,7 +92,9 @@ const Autocorrect: React.FC = () => {
 
       const data = await response.json();
       console.log("Response JSON", data);
-      const fetchedSuggestions = data.suggestions.data || [];
+      if (data.superseded || latestWord.current !== word)
+        return;
+      const fetchedSuggestions = data.suggestions || [];
       if (fetchedSuggestions.length == 1 && fetchedSuggestions[0] === word) 
           setSuggestions([]);
       else {
@@ -163,7 +173,30 @@ const Autocorrect: React.FC = () => {
     calculateCaretPositionAndLine();
   };
 
-  const handleSuggestionClick = (suggestion: string) => {
+  // Suggestions picked since they were last reported
+  const accepted = useRef<string[]>([]);
+  const ACCEPT_REPORT_DELAY = 5000;
+
+  // Tell the server which suggestions were picked, so the words in use rank higher next
+  // time; picks are sent a few seconds later in one request, to stay under the rate limit
+  const reportAccepted = (suggestion: string) => {
+    accepted.current.push(suggestion);
+    if (accepted.current.length > 1)
+      return;
+    setTimeout(() => {
+      const words = accepted.current;
+      accepted.current = [];
+      fetch(`${API_BASE_URL}/api/dictionary`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ accept: words })
+      }).catch(error => console.error('Error reporting accepted suggestions:', error));
+    }, ACCEPT_REPORT_DELAY);
+  };
+
+  const handleSuggestionClick = (suggestion: string, accepted: boolean = true) => {
     const textarea = textareaRef.current;
     if (!textarea) return;
 
@@ -187,10 +220,12 @@ const Autocorrect: React.FC = () => {
     textarea.setSelectionRange(newCaretPos, newCaretPos);
 
     setSuggestions([]);
+    if (accepted && suggestion !== lastWord)
+      reportAccepted(suggestion);
   };
 
   const handleInvert = () => {
-      handleSuggestionClick(prevWord);
+      handleSuggestionClick(prevWord, false);
   };
 
   const handleKeyDown = (e: KeyboardEvent) => {
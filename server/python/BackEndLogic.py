@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 import ctypes
 import numba
 import requests
@@ -13,27 +14,72 @@ import aiohttp
 from concurrent.futures import ThreadPoolExecutor
 
 import json
+import codecs
 from collections import deque
 from collections import Counter
 import time
 from collections import OrderedDict
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import List, Optional
 from pydantic import BaseModel
 import platform
 
-import MinDist
+try:
+    import MinDist
+except ImportError:
+    # Same functions and results, compiled with numba instead of a C++ toolchain
+    import numba_scoring as MinDist
 import TrieModule
+from suggestion_cache import SuggestionCache
+from word_ingest import WordIngester, raw_words
+from dictionary_log import DictionaryLog
+from metrics import Metrics
+from shared_index import SharedIndex
+from document_check import DocumentChecker
+from word_weights import read_weights
+from request_coalescing import SessionSequence, SingleFlight, Superseded
 
 
 # Define a request model for JSON input
 class InputWordRequest(BaseModel):
     input_word: str
+    layout: str = "qwerty"
+    session_id: Optional[str] = None
 
 class SuggestionResponse(BaseModel):
     suggestions: List[str]
+    superseded: bool = False
+
+class InputWordsRequest(BaseModel):
+    input_words: List[str]
+    layout: str = "qwerty"
+
+class BatchSuggestionResponse(BaseModel):
+    suggestions: List[List[str]]
+
+class DictionaryUpdateRequest(BaseModel):
+    add: List[str] = []
+    remove: List[str] = []
+    accept: List[str] = []
+
+class DictionaryUpdateResponse(BaseModel):
+    added: int
+    removed: int
+    accepted: int = 0
+    size: int
+
+class BodyStreamingResponse(StreamingResponse):
+    # StreamingResponse also listens for the client disconnecting, which takes the
+    # messages off receive() (before ASGI 2.4) and would swallow the rest of a body that
+    # the route is still reading; request.stream() notices a disconnect by itself
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
 
 
 '''
@@ -152,30 +198,117 @@ class Trie:
 
 trie = TrieModule.Trie()
 word_dict = {}
-word_map_first = dict()
-word_map_last = dict()
 words = []
+
+# The words of the Trie: membership is a native hash lookup, and word ids index into it
+vocabulary = trie.vocabulary()
 responses = []
 
+# Suggestions recently returned for (input_word, layout), least recently used evicted first
+suggestion_cache = SuggestionCache(max_size=10000)
+
+# The trie cursor of every typing session, least recently used first
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+MAX_SESSIONS = 1000
+
+# Requests for a word that is already being looked up wait for that lookup instead of
+# repeating it, and a session's request is dropped before correcting once the session
+# sent a newer one (nobody is going to see its suggestions)
+in_flight = SingleFlight()
+latest_requests = SessionSequence(MAX_SESSIONS)
+
+# Words added and removed at runtime, replayed on top of words.txt at startup. Updates
+# are applied one at a time; requests never wait for them
+dictionary_log = DictionaryLog("words.log")
+dictionary_lock = threading.Lock()
+
+# Every worker serving words.txt maps the same words.snapshot: the first one to start
+# builds it, and a dictionary update in any worker is published to the others through it
+shared_index = SharedIndex("words.txt", "words.snapshot", dictionary_log, trie.getK(), "word_counts.txt")
+DICTIONARY_POLL_SECONDS = 1.0
+
+# Completions are ranked by weight: how often a word is used (word_counts.txt, one
+# "word count" per line, if there is one), plus one every time it was picked from the
+# suggestions. Picks are applied LEARN_BATCH_SIZE at a time, not one rebuild each
+WEIGHTS_FILE = "word_counts.txt"
+LEARN_BATCH_SIZE = 64
+accepted_words = Counter()
+
+# Words with no exact completions are completed from the prefixes within this many
+# edits of them (see fuzzy_autocomplete), if they are long enough
+FUZZY_PREFIX_DISTANCE = 1
+FUZZY_PREFIX_MIN_LENGTH = 4
+
+# Correction candidates are the words of the typed word's length window (see
+# correction_window) within the smallest edit budget, up to CORRECTION_MAX_EDIT, that
+# yields CORRECTION_MIN_RESULTS of them. Every route uses these, with or without a
+# session, as processor.py does (max_edit_distance, _length_window)
+CORRECTION_MAX_EDIT = 5
+CORRECTION_MIN_RESULTS = 3
+
+# Per-stage latency histograms and counters of the suggestion routes, served at /metrics.
+# One in ten requests slower than 50 ms is logged with the time of each of its stages
+metrics = Metrics(slow_threshold=0.05, slow_sample_rate=0.1)
+for name in ("hits", "misses", "evictions"):
+    metrics.collect(f"cache_{name}_total", "counter", f"Suggestion cache {name}.",
+                    lambda name=name: getattr(suggestion_cache, name))
+metrics.collect("cache_entries", "gauge", "Suggestions in the cache.", lambda: len(suggestion_cache))
+metrics.collect("coalesced_requests_total", "counter",
+                "Requests answered by the lookup of an identical one already running.",
+                lambda: in_flight.coalesced)
+metrics.collect("superseded_requests_total", "counter",
+                "Session requests dropped because a newer one arrived.",
+                lambda: latest_requests.superseded)
+
 
 """
 
 This is the autocomplete function that exploits the Trie data structure, looking
-for 3 valid words which the input word could be a prefix of.
+for 3 valid words which the input word could be a prefix of. The Trie keeps the
+best 3 completions of every prefix when it is frozen, so this is just a walk down
+the prefix and the suggestions already come back ranked: the most used words first
+(see WEIGHTS_FILE), then the shortest, then alphabetically. Asking trie.search for
+more than 3 searches best-first instead, stopping after that many words.
 
 """
 
 def autocomplete(input_word: str):
     global trie
     suggestions = trie.search(input_word)
-    # Sort by length first, then alphabetically
-    suggestions.sort(key=lambda x: (len(x), x))
     if not suggestions:
         return []
     return suggestions
 
 """
 
+This is autocomplete for a prefix with a typo in it: "aplp" has no completions,
+but "appl" (one swap away) does, and those are what the user is most likely
+typing. trie.fuzzyComplete walks the Trie once with a bounded edit distance, like
+the correction search, but keeps the nodes whose path is within 1 edit of the input
+word instead of the words, and returns the best completions of those, the closest
+prefixes first. Words shorter than 4 letters are within 1 edit of far too many
+prefixes for that to be useful, so they are left to autocorrect.
+
+
+Args:
+
+- input_word (str): the word typed so far, which has no exact completions.
+
+Returns:
+
+- suggestions (list): up to 3 completions of the prefixes closest to input_word, or none.
+
+"""
+
+def fuzzy_autocomplete(input_word: str):
+    global trie
+    if len(input_word) < FUZZY_PREFIX_MIN_LENGTH:
+        return []
+    return [word for word, _ in trie.fuzzyComplete(input_word, FUZZY_PREFIX_DISTANCE, transpositions=True)]
+
+"""
+
 This is the autocorrect function employing Levenshtein Edit Distance (Dynamic
 Programming) and Keyboard Distance (Euclidean Distance between letters from 
 the input word and any given word in words) to find the best suggestions for 
@@ -193,11 +326,21 @@ discover a better way to implement this for any keyboard, but for now, this prog
 implements this for English keyboards only. No special characters are given any consideration
 and add nothing to the Keyboard Distance.
 
+The keyboard is now compiled into a position table and a key distance matrix when
+the program starts, so scoring a letter pair is a single table read. QWERTY, AZERTY
+and Dvorak are built in, any other layout can be dropped into the layouts directory
+(one row of keys per line), and each request picks the layout it wants by name.
+
+The top 3 are picked inside compareWords with a bounded heap instead of sorting every
+candidate in Python, and the GIL is released while it scores (long candidate lists are
+split across a thread pool), so concurrent requests can actually run in parallel.
+
 
 Args:
 
 - words (list): the full database of words for the current program run.
 - input_word (str): the word that the user has potentially misspelled.
+- layout (str): the name of the keyboard layout the user is typing on.
 
 Returns:
 
@@ -206,7 +349,7 @@ Returns:
 
 """ 
 
-def autocorrect(words, input_word: str):
+def autocorrect(words, input_word: str, layout: str = "qwerty"):
 
     res = []
 
@@ -219,14 +362,9 @@ def autocorrect(words, input_word: str):
         # Add word to results
         res.append((word, edit_score, kb_score))"""
 
-    res = MinDist.compareWords(input_word, words)
-
-    # Sort by edit distance, then keyboard distance
-    res.sort(key=lambda x: (x[1], x[2]))
-
-    # Take the top 3 results 
-    res = res[:3]
-    print(res)
+    # Take the top 3 results, sorted by edit distance, then keyboard distance.
+    # Candidates further than 5 edits away are dropped inside compareWords.
+    res = MinDist.compareWords(input_word, words, 3, 5.0, layout)
 
     # Check if the smallest edit score is too large 
     if res and res[0][1] > 5.0:
@@ -235,23 +373,174 @@ def autocorrect(words, input_word: str):
     return [word for word, _, _, in res]
 
 
+"""
 
-async def fetch_text(url, session):
-    async with session.get(url) as response:
-        return await response.text()
+Corrects several misspelled words at once: their candidates come from a single
+trie.closestWordIdsBatch call and their scores from a single
+MinDist.compareWordIdsBatch call, both with the GIL released. The candidates stay
+word ids of the Trie's vocabulary until they are scored, so only the 3 suggestions
+kept per word are ever turned into strings.
 
 
-async def fetch_and_process_responses(urls):
-    unique_words = set()
-    word_pattern = re.compile(r'\b[a-z]+\b')
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_text(url, session) for url in urls]
-        responses = await asyncio.gather(*tasks)
+Args:
+
+- current (TrieModule.Trie): the Trie to correct against; its vocabulary gives the ids meaning.
+- misspelled (list): the words to correct, without duplicates.
+- layout (str): the name of the keyboard layout the words were typed on.
+- timer (RequestTimer): the timer of the request, which gets the candidates and score laps.
+
+Returns:
+
+- corrections (list): the suggestions of every word, in the order of misspelled.
+
+"""
+
+def corrections_batch(current, misspelled, layout, timer):
+    current_vocabulary = current.vocabulary()
+    visited = TrieModule.nodesVisited()
+    windows = [correction_window(word) for word in misspelled]
+    candidates = current.closestWordIdsBatch(misspelled, CORRECTION_MAX_EDIT, [low for low, _ in windows],
+                                             [high for _, high in windows], CORRECTION_MIN_RESULTS)
+    timer.lap("candidates")
+    timer.count("trie_nodes_visited", TrieModule.nodesVisited() - visited)
+    timer.count("candidates_scored", sum(len(ids) for ids in candidates))
+    scored = MinDist.compareWordIdsBatch(misspelled, current_vocabulary, candidates, 3, 5.0, layout)
+    corrections = [current_vocabulary.words([word_id for word_id, _, _ in res]) for res in scored]
+    timer.lap("score")
+    return corrections
+
+
+"""
+
+The lengths of the words that can be suggested as a correction of input_word: from
+its own length (2 less for words longer than 5 letters, which are more likely to have
+a letter doubled by mistake) to 4 more.
+
+
+Args:
+
+- input_word (str): the word that the user has potentially misspelled.
+
+Returns:
+
+- (min_length, max_length) (tuple): the length window of the correction candidates.
+
+"""
+
+def correction_window(input_word: str):
+    min_length = len(input_word)
+    if len(input_word) > 5:
+        min_length -= 2
+    return min_length, len(input_word) + 4
+
+
+
+"""
+
+This function finds the words autocorrect should score for an input word. Instead
+of handing every word of a similar length to autocorrect, it walks the Trie with
+a bounded Levenshtein search, so only the Trie nodes that are close to the input
+word get visited. The edit distance budget starts at 1 and grows until at least
+3 candidates are found (or the cap of 5 edits is reached), which keeps the same
+top 3 autocorrect would have picked out of the whole length window. The growing
+budget is handled by the Trie itself (closestWords).
+
+
+Args:
+
+- input_word (str): the word that the user has potentially misspelled.
+
+Returns:
 
-    for text in responses:
-        for word in word_pattern.findall(text.lower()):
-            unique_words.add(word)
-    return unique_words 
+- candidates (list): words in the length window of input_word (see correction_window)
+                     within the smallest edit distance budget that yields 3 of them.
+
+"""
+
+def correction_candidates(input_word: str):
+    global trie
+
+    min_length, max_length = correction_window(input_word)
+    candidates = trie.closestWords(input_word, CORRECTION_MAX_EDIT, min_length, max_length, CORRECTION_MIN_RESULTS)
+    return [word for word, _ in candidates]
+
+
+
+"""
+
+This function does what autocomplete and correction_candidates do for a client
+that sends a session_id with every keystroke. Each session keeps a TrieCursor
+that follows the word as it is typed: when the user types one more letter the
+cursor moves one node down the Trie, and a backspace moves it back up, so the
+work per keystroke no longer grows with the length of the word. The cursor also
+keeps the Trie nodes within 2 edits of the typed word, so the first two edit
+distance budgets of the correction search are read off that set instead of
+walking the Trie again; the larger ones fall back to a search from the root, so
+the candidates are the same as correction_candidates'. Sessions are kept for the 1000 most recently active
+clients.
+
+
+Args:
+
+- session_id (str): identifies the client (and text field) the user is typing in.
+- input_word (str): the word typed so far.
+
+Returns:
+
+- (completions, candidates) (tuple): the autocomplete suggestions, and the candidates for
+                                     autocorrect when there are no completions.
+
+"""
+
+def session_suggestions(session_id: str, input_word: str):
+    global trie
+
+    with sessions_lock:
+        cursor = sessions.get(session_id)
+        if cursor is None:
+            cursor = TrieModule.TrieCursor(trie)
+            sessions[session_id] = cursor
+            if len(sessions) > MAX_SESSIONS:
+                sessions.popitem(last=False)
+        sessions.move_to_end(session_id)
+
+        cursor.moveTo(input_word)
+        completions = cursor.completions()
+        if completions:
+            return completions, []
+        # The same budget and window as correction_candidates, so a session gets the
+        # same corrections (and the cache the same entry) as any other request
+        min_length, max_length = correction_window(input_word)
+        candidates = cursor.closestWords(CORRECTION_MAX_EDIT, min_length, max_length, CORRECTION_MIN_RESULTS)
+        return [], [word for word, _ in candidates]
+
+
+
+"""
+
+Fetches every page in urls and returns the set of words found in them. At most 16
+pages are downloaded at once (4 per host), and each page is tokenized in a worker
+process as soon as it arrives, so neither the event loop nor memory is tied up by
+all of the pages at the same time. Raw pages are kept in page_cache/ and only
+downloaded again when the server reports a change (ETag / Last-Modified); a page
+that cannot be fetched falls back to its cached copy and is reported instead of
+being dropped silently.
+
+
+Args:
+
+- urls (list): the pages to take words from.
+
+Returns:
+
+- unique_words (set): every run of letters in the pages, lowercased.
+
+"""
+
+async def fetch_and_process_responses(urls):
+    ingester = WordIngester(max_connections=16, per_host_connections=4, cache_dir="page_cache",
+                            tokenizer=raw_words)
+    return await ingester.ingest(urls)
 
 
 async def do_responses():
@@ -304,6 +593,97 @@ async def initialize_words(word_file="words.txt"):
 
 
 
+"""
+
+Builds the Trie of the words in words.txt plus the words added through /dictionary,
+minus the removed ones, weighted by word_counts.txt and the accepted suggestions.
+Only one worker builds it at a time (see SharedIndex); the others map the snapshot
+it saves.
+
+
+Args:
+
+- added (list): words added at runtime, from words.log.
+- removed (list): words removed at runtime, from words.log.
+- accepted (dict): how often each word was picked from the suggestions, from words.log.
+
+Returns:
+
+- built (TrieModule.Trie): the frozen Trie.
+
+"""
+
+def build_trie(added, removed, accepted):
+    global words
+
+    weights = read_weights(WEIGHTS_FILE)
+    built = TrieModule.Trie(trie.getK())
+    for word in words + added:
+        built.insert(word, weights.get(word, 0))
+    for word in removed:
+        built.remove(word)
+    for word, count in accepted.items():
+        built.learn(word, count)
+    built.freeze()
+    return built
+
+
+
+"""
+
+Switches the routes over to a new Trie with a single assignment, along with its
+vocabulary, and drops the suggestions and session cursors of the old one.
+
+
+Args:
+
+- updated (TrieModule.Trie): the Trie to serve from now on.
+
+Returns: None
+
+"""
+
+def use_trie(updated):
+    global trie, vocabulary
+
+    trie = updated
+    vocabulary = updated.vocabulary()
+
+    # Suggestions cached for the previous word list may no longer be right
+    suggestion_cache.clear()
+    with sessions_lock:
+        sessions.clear()
+
+
+
+"""
+
+Runs in the background while the server is up, checking once a second whether
+another worker changed the dictionary (a single stat of words.log). If one did, the
+snapshot it published is mapped and swapped in, so every worker answers from the
+same words shortly after an update.
+
+
+Args:
+
+- stop (threading.Event): set on shutdown.
+
+Returns: None
+
+"""
+
+def watch_dictionary(stop):
+    while not stop.wait(DICTIONARY_POLL_SECONDS):
+        try:
+            with dictionary_lock:
+                updated = shared_index.refresh(build_trie)
+                if updated is not None:
+                    use_trie(updated)
+        except Exception as e:
+            print(f"Could not refresh the dictionary: {e}")
+
+
+
 """
 
 This function initializes the autocorrect and autocomplete data structures,
@@ -311,6 +691,19 @@ doing all requests to load valid words when necessary (and saving work to
 the file words.txt). This will be called when the client side opens the app
 for the first time.
 
+Building the Trie is most of the startup time, so the frozen Trie is also saved
+to words.snapshot, a binary file that is memory-mapped on the next start instead
+of being parsed. The snapshot remembers a hash of the words.txt (and words.log)
+it was built from and is rebuilt whenever either file changes.
+
+Words added or removed through /dictionary while the server ran are already in
+words.log, so words.txt is no longer rewritten on shutdown.
+
+Several workers can serve the app at once (uvicorn --workers N). They all map the
+same words.snapshot, whose pages the OS keeps in memory once for all of them, and
+only the first worker to start after words.txt or words.log changed builds it; the
+others wait for it and map the result.
+
 
 Args: None
 
@@ -323,37 +716,37 @@ async def lifespan(app: FastAPI):
     # The following happens on startup of the API
 
     global words
-    global word_map_first
-    global word_map_last
+    global vocabulary
     global trie
     global responses
 
     await initialize_words()
 
+    # Every layouts/<name>.txt file becomes a keyboard layout requests can ask for
+    layouts_dir = Path("layouts")
+    if layouts_dir.is_dir():
+        for path in sorted(layouts_dir.glob("*.txt")):
+            MinDist.loadLayout(path.stem, str(path))
+
     words = [x.lower() for x in words]
-    words = sorted(words, key=len)
-    f_len = 1
 
-    for i in range(len(words)):
-        curr_word = words[i]
-        trie.insert(curr_word)
-        if len(curr_word) > f_len:
-            word_map_last[f_len] = i
-            f_len = len(curr_word)
-            word_map_first[f_len] = i
+    # The Trie is memory-mapped from words.snapshot when that was built from the
+    # current words.txt and words.log, and only rebuilt (and saved for the other
+    # workers and the next start) when it was not
+    use_trie(shared_index.open(build_trie))
+
+    # Dictionary updates made by other workers are picked up in the background
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch_dictionary, args=(stop,), daemon=True)
+    watcher.start()
 
     # The server runs
 
     yield
 
-    # What happens on shutdown
-
-    words = sorted(words, key=lambda word: (word[0], len(word)))
-
-    with open("words.txt", "w") as f:
-        f.write(f"{len(responses)}\n")
-        for word in words:
-            f.write(word + '\n')
+    # What happens on shutdown: nothing to save, runtime changes are in words.log already
+    stop.set()
+    watcher.join()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -378,14 +771,23 @@ When given a choice between autocomplete and autocorrect, this function always p
 autocomplete since there is a bigger chance the user just isn't finished typing a word.
 
 If the word cannot be completed and it was simply misspelled, the output to autocorrect will
-be returned. Before calling autocorrect, the function will check the cache to see if users
-have misspelled this specific word before, making returns easier.
+be returned. Before doing either, the function will check the cache to see if users
+have typed this specific word before, making returns easier. The cache keeps the suggestions
+of the 10000 most recently used (word, layout) pairs and is emptied whenever the word list
+is reloaded; its hit, miss and eviction counts are served at /cache/stats.
+
+A word that misses the cache while another request is already looking it up waits for
+that lookup and shares its suggestions. A session's request that is overtaken by a newer
+one of the same session (the user kept typing) stops before correcting the word and is
+answered with no suggestions and superseded set, which clients should ignore.
 
 
 Args:
 
 - input_word (str): This represents the word the user has currently typed, and the word we will
                     try to correct or complete.
+- session_id (str): Optional, identifies the client so the Trie walk can pick up where the
+                    previous keystroke left it (see session_suggestions).
 
 Returns:
 
@@ -396,42 +798,311 @@ Returns:
 
 @app.post("/autocorrect")
 def autocorrect_and_autocomplete_req(request: InputWordRequest) -> SuggestionResponse:
-    global words
-    global word_map_first
-    global word_map_last
+    global vocabulary
     global trie
     global responses
 
     input_word = request.input_word
     #print(f"Received Word: {input_word}")
     num_responses_done = len(responses)
-    shorter_words = []
     output = []
 
-    if input_word in words and len(input_word) < 44:
+    if request.layout not in MinDist.layouts():
+        raise HTTPException(status_code=400, detail=f"Unknown keyboard layout: {request.layout}")
+    if request.session_id is not None:
+        ticket = latest_requests.arrive(request.session_id)
+
+    # Every stage below ends with a lap, which adds its time to the /metrics histograms
+    timer = metrics.timer("autocorrect")
+
+    # Read before any lookup, so suggestions computed from a Trie that is swapped out
+    # meanwhile are not cached
+    generation = suggestion_cache.generation
+    cached = suggestion_cache.get((input_word, request.layout))
+    timer.lap("cache")
+    if cached is not None:
+        timer.finish(input_word)
+        return SuggestionResponse(suggestions=cached)
+
+    def suggest():
+        visited = TrieModule.nodesVisited()
+        if request.session_id is not None and 0 < len(input_word) < 44:
+
+            # The session's cursor is usually one keystroke away from input_word
+
+            output, candidates = session_suggestions(request.session_id, input_word)
+            timer.lap("session")
+            if not output:
+                output = fuzzy_autocomplete(input_word)
+                timer.lap("fuzzy_complete")
+            if not output:
+
+                # Correcting is the expensive part; skip it if the user already typed on
+
+                latest_requests.check(request.session_id, ticket)
+                output = autocorrect(candidates, input_word, request.layout)
+                timer.lap("score")
+                timer.count("candidates_scored", len(candidates))
+        elif input_word in vocabulary and len(input_word) < 44:
+            timer.lap("lookup")
+
+            # This occurs when the word is spelled correctly and we need to
+            # suggests ways to complete potentially unfinished text.
+
+            output = autocomplete(input_word)
+            timer.lap("complete")
+        elif len(input_word) < 44:
+            timer.lap("lookup")
+
+            output = autocomplete(input_word)
+            timer.lap("complete")
+
+            if not output:
+                output = fuzzy_autocomplete(input_word)
+                timer.lap("fuzzy_complete")
+
+            if not output:
+                candidates = correction_candidates(input_word)
+                timer.lap("candidates")
+                corrected_suggestions = autocorrect(candidates, input_word, request.layout)
+                timer.lap("score")
+                timer.count("candidates_scored", len(candidates))
+                output = corrected_suggestions
+        else:
 
-        # This occurs when the word is spelled correctly and we need to
-        # suggests ways to complete potentially unfinished text.
+            # The word is too long to be considered valid for any operations.
 
-        output = autocomplete(input_word)
-    elif len(input_word) < 44:
+            output = []
+        timer.count("trie_nodes_visited", TrieModule.nodesVisited() - visited)
+        return output
 
-        output = autocomplete(input_word)
+    # Identical requests that miss the cache together share one lookup
+    try:
+        output = in_flight.do((input_word, request.layout), suggest)
+    except Superseded:
+        timer.finish(input_word)
+        return SuggestionResponse(suggestions=[], superseded=True)
 
-        if not output:
-            lower_bound = word_map_first.get(len(input_word), 0)
-            upper_bound = word_map_last.get(len(input_word) + 4, 0)
-            shorter_words = words[lower_bound:upper_bound + 1]
-            corrected_suggestions = autocorrect(shorter_words, input_word)
-            output = corrected_suggestions
-    else:
+    suggestion_cache.put((input_word, request.layout), output, generation)
+    timer.finish(input_word)
+    return SuggestionResponse(suggestions=output)
 
-        # The word is too long to be considered valid for any operations.
 
-        output = []
 
-    
-    return SuggestionResponse(suggestions=output)
+"""
+
+This is the batch version of the route above, for clients that check a whole
+sentence (or a pasted block of text) at once instead of sending one request per
+word. Repeated words are only looked up once (and not at all when they are in the
+suggestion cache), and every stage runs in a single
+native call over all of the words: the completions come from trie.searchBatch
+(and trie.fuzzyCompleteBatch for the words with a typo in their prefix),
+the correction candidates of the words that cannot be completed from
+trie.closestWordIdsBatch, and their scores from MinDist.compareWordIdsBatch. The
+candidates stay word ids of the Trie's vocabulary until they are scored, so only
+the 3 suggestions kept per word are ever turned into strings. The GIL is released
+during each of those calls.
+
+
+Args:
+
+- input_words (list): The words the user has typed, in order.
+- layout (str): the name of the keyboard layout the user is typing on.
+
+Returns:
+
+- output (list): One list of suggestions per input word, in the same order as input_words.
+
+"""
+
+@app.post("/autocorrect/batch")
+def autocorrect_and_autocomplete_batch_req(request: InputWordsRequest) -> BatchSuggestionResponse:
+    global trie
+    global vocabulary
+
+    if request.layout not in MinDist.layouts():
+        raise HTTPException(status_code=400, detail=f"Unknown keyboard layout: {request.layout}")
+
+    # Every stage reads the same version of the dictionary, even if /dictionary swaps
+    # in a new one meanwhile, so the word ids of one stage mean the same in the next
+    current = trie
+    generation = suggestion_cache.generation
+    timer = metrics.timer("batch")
+
+    # Words that are too long are not considered valid for any operations
+    results = dict.fromkeys(request.input_words, [])
+    unique = []
+    for word in dict.fromkeys(request.input_words):
+        cached = suggestion_cache.get((word, request.layout)) if len(word) < 44 else []
+        if cached is None:
+            unique.append(word)
+        else:
+            results[word] = cached
+    timer.lap("cache")
+
+    for word, suggestions in zip(unique, current.searchBatch(unique)):
+        results[word] = suggestions
+    timer.lap("complete")
+
+    # Words with a typo may still be the start of a word; the rest get corrected
+    misspelled = [word for word in unique if not results[word]]
+    fuzzy = [word for word in misspelled if len(word) >= FUZZY_PREFIX_MIN_LENGTH]
+    for word, suggestions in zip(fuzzy, current.fuzzyCompleteBatch(fuzzy, FUZZY_PREFIX_DISTANCE,
+                                                                   transpositions=True)):
+        results[word] = suggestions
+    timer.lap("fuzzy_complete")
+
+    misspelled = [word for word in misspelled if not results[word]]
+    if misspelled:
+        for word, corrections in zip(misspelled, corrections_batch(current, misspelled, request.layout, timer)):
+            results[word] = corrections
+
+    for word in unique:
+        suggestion_cache.put((word, request.layout), results[word], generation)
+    timer.finish(f"{len(request.input_words)} words")
+    return BatchSuggestionResponse(suggestions=[results[word] for word in request.input_words])
+
+
+
+"""
+
+Checks a whole document (a pasted paragraph, a file) for misspelled words. The body
+is plain text and is read as a stream, so the document never has to be held in
+memory at once: it is split into words as it arrives, the words in the dictionary
+are skipped with one native lookup per batch of 1024 words, and the distinct
+misspelled ones of a batch are corrected together (see corrections_batch). A
+misspelling that comes up again reuses the corrections it got the first time.
+Every misspelling is streamed back as one line of JSON as soon as its batch is
+done, in document order.
+
+
+Args:
+
+- body (text): the document, UTF-8 encoded.
+- layout (str): query parameter, the name of the keyboard layout the document was typed on.
+
+Returns:
+
+- lines (NDJSON): one {"offset", "token", "suggestions"} object per misspelled word, where
+                  offset is the position of the word in the document, in characters.
+
+"""
+
+@app.post("/spellcheck")
+async def spellcheck_req(request: Request, layout: str = "qwerty") -> BodyStreamingResponse:
+    if layout not in MinDist.layouts():
+        raise HTTPException(status_code=400, detail=f"Unknown keyboard layout: {layout}")
+
+    def correct(words):
+        # Every batch uses the dictionary of the moment, like the other routes do
+        timer = metrics.timer("spellcheck")
+        corrections = corrections_batch(trie, words, layout, timer)
+        timer.finish(f"{len(words)} words")
+        return corrections
+
+    checker = DocumentChecker(lambda words: vocabulary.containsBatch(words), correct)
+
+    async def misspellings():
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        async for chunk in request.stream():
+            # The lookups release the GIL, but they should not hold up the event loop either
+            found = await run_in_threadpool(checker.feed, decoder.decode(chunk))
+            if found:
+                yield "".join(json.dumps(misspelling) + "\n" for misspelling in found)
+        found = await run_in_threadpool(lambda: checker.feed(decoder.decode(b"", final=True)) + checker.finish())
+        if found:
+            yield "".join(json.dumps(misspelling) + "\n" for misspelling in found)
+
+    return BodyStreamingResponse(misspellings(), media_type="application/x-ndjson")
+
+
+
+"""
+
+Returns the counters of the suggestion cache (hits, misses, evictions, its size
+and the hit rate), to see how much work the cache is taking off the routes above.
+
+"""
+
+@app.get("/cache/stats")
+def cache_stats_req():
+    return suggestion_cache.stats()
+
+
+
+"""
+
+Serves the metrics of the suggestion routes in the Prometheus text format, for a
+Prometheus server to scrape. Each route times its stages (the cache lookup, the
+dictionary lookup, autocomplete, finding correction candidates and scoring them)
+with one clock read per stage, and adds them to a latency histogram per route and
+stage when the request is done. Next to those are counters of the candidates
+scored, the Trie nodes the searches visited, the requests slower than 50 ms, and
+the suggestion cache's hits, misses and evictions.
+
+""" 
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_req():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+
+"""
+
+Adds and removes dictionary words while the server runs, e.g. to push the
+vocabulary of a domain without a restart. The change is appended to words.log
+first (so it survives a restart), then a new Trie holding the current words plus
+the added ones, minus the removed ones, is built next to the one requests are
+using. That build happens natively with the GIL released, so requests keep being
+answered from the old Trie the whole time, and the new one replaces it with a
+single assignment once it is complete. A word that is both added and removed
+ends up removed. The new Trie is also saved as words.snapshot, which the other
+workers switch to within a second (see watch_dictionary).
+
+Suggestions the user picked are sent as accept, and each pick adds one to the
+weight of its word, so the words someone actually uses climb the completions.
+Picks only rebuild the Trie once LEARN_BATCH_SIZE of them came in (or along with
+the next added or removed words).
+
+
+Args:
+
+- add (list): words to add to the dictionary.
+- remove (list): words to remove from the dictionary.
+- accept (list): suggestions that were picked.
+
+Returns:
+
+- (added, removed, accepted, size): how many words were added, removed and accepted, and the new size of the dictionary.
+
+"""
+
+@app.post("/dictionary")
+def dictionary_update_req(request: DictionaryUpdateRequest) -> DictionaryUpdateResponse:
+    global trie
+    global vocabulary
+
+    added = [word for word in (word.strip().lower() for word in request.add) if 0 < len(word) < 44]
+    removed = [word.strip().lower() for word in request.remove]
+    accepted = [word for word in (word.strip().lower() for word in request.accept) if 0 < len(word) < 44]
+
+    # Updates are serialized (across workers too), so two of them at once cannot both
+    # start from the same Trie
+    with dictionary_lock:
+        accepted_words.update(accepted)
+        if added or removed or sum(accepted_words.values()) >= LEARN_BATCH_SIZE:
+            # The picks are only forgotten once they are in the Trie; if the update fails
+            # (a full disk, a lock that timed out) they are tried again with the next one
+            learned = dict(accepted_words)
+            weights = read_weights(WEIGHTS_FILE) if added else {}
+            updated = shared_index.update(trie, added, removed, build_trie, learned,
+                                          {word: weights[word] for word in added if word in weights})
+            accepted_words.clear()
+            use_trie(updated)
+
+    return DictionaryUpdateResponse(added=len(added), removed=len(removed), accepted=len(accepted),
+                                    size=trie.size())
 
 
 
@@ -450,14 +1121,13 @@ def autocorrect_and_autocomplete_req(request: InputWordRequest) -> SuggestionRes
 
 
 def autocorrect_and_autocomplete_req_test(input_word: str) -> List[str]:
-    global words, word_map_first, word_map_last, trie, responses
+    global words, vocabulary, trie, responses
 
     #print(f"Received Word: {input_word}")
     num_responses_done = len(responses)
-    shorter_words = []
     output = []
     
-    if input_word in words and len(input_word) < 44:
+    if input_word in vocabulary and len(input_word) < 44:
 
         # This occurs when the word is spelled correctly and we need to
         # suggests ways to complete potentially unfinished text.
@@ -468,10 +1138,8 @@ def autocorrect_and_autocomplete_req_test(input_word: str) -> List[str]:
         output = autocomplete(input_word)
 
         if not output:
-            lower_bound = word_map_first.get(len(input_word), 0)
-            upper_bound = word_map_last.get(len(input_word) + 4, 0)
-            shorter_words = words[lower_bound:upper_bound + 1]
-            corrected_suggestions = autocorrect(shorter_words, input_word)
+            candidates = correction_candidates(input_word)
+            corrected_suggestions = autocorrect(candidates, input_word)
             output = corrected_suggestions
     else:
 
@@ -489,7 +1157,7 @@ def autocorrect_and_autocomplete_req_test(input_word: str) -> List[str]:
 
 
 async def initialize_data_test():
-    global words, word_map_first, word_map_last, trie, responses
+    global words, vocabulary, trie, responses
 
     try:
         num_responses_done = int(open('words.txt').readline().strip())
@@ -556,32 +1224,28 @@ async def initialize_data_test():
             words = [line.strip() for line in file]
 
     words = [x.lower() for x in words]
-    words = sorted(words, key=len)
-    f_len = 1
-
-    for i in range(len(words)):
-        curr_word = words[i]
-        trie.insert(curr_word)
-        if len(curr_word) > f_len:
-            word_map_last[f_len] = i
-            f_len = len(curr_word)
-            word_map_first[f_len] = i
+
+    for word in words:
+        trie.insert(word)
+    trie.freeze()
+    vocabulary = trie.vocabulary()
     pass
 
 
 
 
-# testing purposes only
+# testing purposes only (benchmark.py measures the processor offline)
 
 
-asyncio.run(initialize_data_test())
+if __name__ == "__main__":
+    asyncio.run(initialize_data_test())
 
 
-print(len(words))
-input_word = input("Enter word: ")
+    print(len(words))
+    input_word = input("Enter word: ")
 
-start = time.time()
-print(autocorrect_and_autocomplete_req_test(input_word))
-end = time.time()
-dur = end - start
-print("Time it took: ", dur)
+    start = time.time()
+    print(autocorrect_and_autocomplete_req_test(input_word))
+    end = time.time()
+    dur = end - start
+    print("Time it took: ", dur)
@@ -0,0 +1,369 @@
+"""Offline benchmark of the suggestion pipeline.
+
+Builds a WordProcessor from a fixed word list (nothing is fetched), replays a
+seeded corpus of keystrokes and typos against WordProcessor.process_word,
+Trie.search and compareWords (of MinDist, or of numba_scoring with --backend
+numba), and reports p50 / p95 / p99 latency, throughput under concurrent
+callers and peak RSS as JSON. Given a baseline written by an earlier run, it
+exits with status 1 if anything regressed. With --cross-check, it also scores
+the typos with both backends, checks that a trie holding non-ASCII words
+completes every word to itself, and exits with status 1 if either fails.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.25
+    python benchmark.py --backend numba --cross-check
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import platform
+import statistics
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+import TrieModule
+from processor import ProcessorConfig, WordProcessor, CORRECTION_ENGINES, SCORING_MODES, SCORING_BACKENDS, load_scorer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, so peak RSS is not reported there
+    resource = None
+
+BENCHMARKS = ("process_word", "trie_search", "compare_words")
+QWERTY_ROWS = ("qwertyuiop", "asdfghjkl", "zxcvbnm")
+# Latencies this close are within the noise of timing single calls, whatever the tolerance
+LATENCY_SLACK_US = 2.0
+# Words with bytes of 0x80 and up, which sort after every ASCII letter, next to ASCII ones
+NON_ASCII_WORDS = ("cafe", "café", "cafz", "cafÿ", "naive", "naïve", "über", "uber")
+
+
+def _neighbours() -> Dict[str, str]:
+    """Map every letter to the letters next to it on a qwerty keyboard (same row, and the rows above and below)."""
+    neighbours = {}
+    for row_index, row in enumerate(QWERTY_ROWS):
+        for column, key in enumerate(row):
+            near = []
+            for other in range(max(0, row_index - 1), min(len(QWERTY_ROWS), row_index + 2)):
+                other_row = QWERTY_ROWS[other]
+                near.extend(other_row[max(0, column - 1):column + 2])
+            neighbours[key] = "".join(letter for letter in near if letter != key)
+    return neighbours
+
+
+def _typo(word: str, rng: random.Random, neighbours: Dict[str, str]) -> str:
+    """Return word with one typing mistake: a neighbouring key, a swap, a dropped or a doubled letter."""
+    position = rng.randrange(len(word))
+    kind = rng.choice(("substitute", "transpose", "delete", "insert"))
+    if kind == "substitute" and word[position] in neighbours:
+        return word[:position] + rng.choice(neighbours[word[position]]) + word[position + 1:]
+    if kind == "transpose" and position + 1 < len(word):
+        return word[:position] + word[position + 1] + word[position] + word[position + 2:]
+    if kind == "delete" and len(word) > 2:
+        return word[:position] + word[position + 1:]
+    return word[:position] + word[position] + word[position:]
+
+
+def build_corpus(words: Sequence[str], size: int, seed: int) -> Dict[str, List[str]]:
+    """Return a reproducible corpus of size typed words from words.
+
+    "keystrokes" holds every prefix of each word as it is typed, and "typos"
+    holds each word with one or two mistakes in it (after the first letter,
+    which people rarely get wrong).
+    """
+    rng = random.Random(seed)
+    neighbours = _neighbours()
+    pool = [word for word in words if len(word) >= 3 and word.isalpha()]
+    sample = rng.sample(pool, min(size, len(pool)))
+
+    keystrokes = [word[:length] for word in sample for length in range(1, len(word) + 1)]
+    typos = []
+    for word in sample:
+        typo = word[0] + _typo(word[1:], rng, neighbours)
+        if rng.random() < 0.3:
+            typo = typo[0] + _typo(typo[1:], rng, neighbours)
+        typos.append(typo)
+    return {"keystrokes": keystrokes, "typos": typos}
+
+
+def corpus_digest(corpus: Dict[str, List[str]]) -> str:
+    """Return a digest of the corpus, so results are only compared when they replayed the same queries."""
+    return hashlib.blake2b(json.dumps(corpus, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Return the given percentile of sorted_values by linear interpolation."""
+    if not sorted_values:
+        return 0.0
+    position = fraction * (len(sorted_values) - 1)
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def measure_latency(call: Callable, arguments: List, warmup: int, repeat: int) -> Dict[str, float]:
+    """Call call once per argument, one after the other, and summarize the latencies in microseconds.
+
+    The arguments are replayed repeat times and every statistic is the median
+    of the replays, so one replay disturbed by the rest of the machine does not
+    decide the result.
+    """
+    for argument in arguments[:warmup]:
+        call(argument)
+
+    replays = []
+    for _ in range(repeat):
+        latencies = []
+        for argument in arguments:
+            start = time.perf_counter_ns()
+            call(argument)
+            latencies.append((time.perf_counter_ns() - start) / 1000)
+        latencies.sort()
+        replays.append({
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max": latencies[-1] if latencies else 0.0,
+        })
+    return {statistic: statistics.median(replay[statistic] for replay in replays) for statistic in replays[0]}
+
+
+def measure_throughput(call: Callable, arguments: List, callers: int, repeat: int) -> float:
+    """Return the calls per second of callers threads sharing arguments between them (the median of repeat replays)."""
+    shares = [arguments[index::callers] for index in range(callers)]
+
+    def run(share):
+        for argument in share:
+            call(argument)
+
+    rates = []
+    with ThreadPoolExecutor(callers) as executor:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(executor.map(run, shares))
+            elapsed = time.perf_counter() - start
+            rates.append(len(arguments) / elapsed if elapsed > 0 else 0.0)
+    return statistics.median(rates)
+
+
+def peak_rss_mib() -> Optional[float]:
+    """Return the peak resident set size of this process so far, in MiB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def cross_check(processor: WordProcessor, typos: List[str], windows: List[Sequence[int]],
+                candidate_ids: List[List[int]]) -> Dict:
+    """Score the typos with both backends, over their candidates and their length windows, and count the disagreements."""
+    config = processor.config
+    native, numba = load_scorer("native"), load_scorer("numba")
+    min_lengths = [low for low, _ in windows]
+    max_lengths = [high for _, high in windows]
+    checks = {
+        "compare_ids": lambda scorer: scorer.compareWordIdsBatch(typos, processor.vocabulary, candidate_ids,
+                                                                 config.max_suggestions, config.max_edit_distance,
+                                                                 config.keyboard_layout),
+        "rank_ids": lambda scorer: scorer.rankWordIdsBatch(typos, processor.vocabulary, candidate_ids,
+                                                           config.max_suggestions, config.max_edit_distance,
+                                                           config.keyboard_layout),
+        "compare_window": lambda scorer: scorer.compareLengthWindowBatch(typos, processor.vocabulary, min_lengths,
+                                                                         max_lengths, config.max_suggestions,
+                                                                         config.max_edit_distance, config.keyboard_layout),
+        "rank_window": lambda scorer: scorer.rankLengthWindowBatch(typos, processor.vocabulary, min_lengths,
+                                                                   max_lengths, config.max_suggestions,
+                                                                   config.max_edit_distance, config.keyboard_layout),
+    }
+
+    mismatches = {}
+    for name, check in checks.items():
+        expected, actual = check(native), check(numba)
+        mismatches[name] = [typo for typo, want, got in zip(typos, expected, actual) if want != got]
+        print(f"cross-check {name}: {len(mismatches[name])} of {len(typos)} typos differ", file=sys.stderr)
+    return {
+        "typos": len(typos),
+        "mismatches": {name: len(differing) for name, differing in mismatches.items()},
+        # A few of the differing typos, to reproduce them with
+        "examples": {name: differing[:5] for name, differing in mismatches.items() if differing},
+    }
+
+
+def check_trie(words: Sequence[str]) -> List[str]:
+    """Return the words that a frozen trie of words does not complete to themselves by search, searchBatch or a cursor."""
+    trie = TrieModule.Trie(len(words))
+    for word in words:
+        trie.insert(word)
+    trie.freeze()
+    cursor = TrieModule.TrieCursor(trie)
+    missed = []
+    for word, batched in zip(words, trie.searchBatch(list(words))):
+        cursor.moveTo(word)
+        if word not in trie.search(word) or word not in batched or word not in cursor.completions():
+            missed.append(word)
+    print(f"trie check: {len(missed)} of {len(words)} words not found", file=sys.stderr)
+    return missed
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict:
+    """Load the word list, replay the corpus against every selected benchmark and return the results."""
+    with tempfile.TemporaryDirectory() as scratch:
+        # The snapshot and the dictionary log go to a scratch directory, so the run
+        # neither reuses nor disturbs the server's; the result cache is off by default
+        # because the corpus repeats prefixes and would mostly measure cache hits
+        config = ProcessorConfig(cache_file=args.words, snapshot_file=str(Path(scratch) / "words.snapshot"),
+                                 dictionary_log=str(Path(scratch) / "words.log"),
+                                 correction_engine=args.engine, scoring=args.scoring,
+                                 result_cache_size=args.cache_size, scoring_backend=args.backend)
+        processor = WordProcessor(config)
+        start = time.perf_counter()
+        asyncio.run(processor.initialize())
+        load_seconds = time.perf_counter() - start
+    rss_after_load = peak_rss_mib()
+
+    words = processor.vocabulary.words(list(range(len(processor.vocabulary))))
+    corpus = build_corpus(words, args.corpus_size, args.seed)
+
+    # compareWords gets the candidates the trie finds for every typo, as the
+    # pipeline would hand them over, so only the scoring is timed
+    def window(word):
+        return max(1, len(word) - 2), len(word) + 4
+
+    windows = [window(typo) for typo in corpus["typos"]]
+    candidate_ids = processor.trie.closestWordIdsBatch(corpus["typos"], config.max_edit_distance,
+                                                      [low for low, _ in windows], [high for _, high in windows],
+                                                      min_results=config.max_suggestions)
+    candidate_lists = [processor.vocabulary.words(ids) for ids in candidate_ids]
+
+    calls = {
+        "process_word": (processor.process_word, corpus["keystrokes"] + corpus["typos"]),
+        "trie_search": (processor.trie.search, corpus["keystrokes"]),
+        "compare_words": (lambda pair: processor.scorer.compareWords(pair[0], pair[1], config.max_suggestions,
+                                                                     config.max_edit_distance, config.keyboard_layout),
+                          list(zip(corpus["typos"], candidate_lists))),
+    }
+
+    benchmarks = {}
+    for name in args.benchmarks:
+        call, arguments = calls[name]
+        start = time.perf_counter()
+        latency = measure_latency(call, arguments, args.warmup, args.repeat)
+        benchmarks[name] = {
+            "calls": len(arguments),
+            "latency_us": latency,
+            "throughput": {str(callers): measure_throughput(call, arguments, callers, args.repeat) for callers in args.callers},
+        }
+        print(f"{name}: {len(arguments)} calls, p50 {latency['p50']:.1f}us, p99 {latency['p99']:.1f}us "
+              f"({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "words_file": args.words,
+            "word_count": len(words),
+            "engine": args.engine,
+            "scoring": args.scoring,
+            "backend": processor.scorer.__name__,
+            "result_cache_size": args.cache_size,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "corpus_size": len(corpus["typos"]),
+            "corpus_digest": corpus_digest(corpus),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "load_seconds": load_seconds,
+        "peak_rss_mib": {"after_load": rss_after_load, "total": peak_rss_mib()},
+        "benchmarks": benchmarks,
+    }
+    if args.cross_check:
+        results["cross_check"] = cross_check(processor, corpus["typos"], windows, candidate_ids)
+        results["cross_check"]["trie_missed"] = check_trie(NON_ASCII_WORDS)
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Return a description of every latency or throughput that is worse than baseline by more than tolerance."""
+    if results["meta"]["corpus_digest"] != baseline["meta"]["corpus_digest"]:
+        print("The baseline replayed a different corpus, so the comparison is only indicative", file=sys.stderr)
+
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        previous = baseline["benchmarks"].get(name)
+        if previous is None:
+            continue
+        for statistic in ("p50", "p95", "p99"):
+            old, new = previous["latency_us"][statistic], result["latency_us"][statistic]
+            if new > old * (1 + tolerance) and new - old > LATENCY_SLACK_US:
+                regressions.append(f"{name} {statistic} latency {old:.1f}us -> {new:.1f}us")
+        for callers, new in result["throughput"].items():
+            old = previous["throughput"].get(callers)
+            if old and new < old * (1 - tolerance):
+                regressions.append(f"{name} throughput with {callers} callers {old:.0f}/s -> {new:.0f}/s")
+
+    old, new = baseline["peak_rss_mib"]["total"], results["peak_rss_mib"]["total"]
+    if old and new and new > old * (1 + tolerance):
+        regressions.append(f"peak RSS {old:.1f} MiB -> {new:.1f} MiB")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark autocomplete and autocorrect offline.")
+    parser.add_argument("--words", default="words.txt", help="word list to load, in the words.txt format (default: %(default)s)")
+    parser.add_argument("--corpus-size", type=int, default=2000, help="number of words typed (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="replays of the corpus per measurement, the median is kept (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=200, help="calls made before timing (default: %(default)s)")
+    parser.add_argument("--callers", type=int, nargs="+", default=[1, 4, 8],
+                        help="numbers of concurrent callers to measure throughput with (default: %(default)s)")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--engine", choices=CORRECTION_ENGINES, default=ProcessorConfig.correction_engine)
+    parser.add_argument("--scoring", choices=SCORING_MODES, default=ProcessorConfig.scoring)
+    parser.add_argument("--backend", choices=SCORING_BACKENDS, default=ProcessorConfig.scoring_backend,
+                        help="scoring backend of process_word and compare_words (default: %(default)s)")
+    parser.add_argument("--cross-check", action="store_true",
+                        help="also check that MinDist and numba_scoring score the typos alike")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="result cache entries of process_word, 0 to time every call (default: %(default)s)")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative slowdown allowed before it counts as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.corpus_size < 1 or args.repeat < 1 or any(callers < 1 for callers in args.callers):
+        parser.error("--corpus-size, --repeat and --callers must be positive")
+
+    results = run_benchmarks(args)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+    else:
+        print(json.dumps(results, indent=2))
+
+    status = 0
+    if args.cross_check and any(results["cross_check"]["mismatches"].values()):
+        print("The scoring backends disagree", file=sys.stderr)
+        status = 1
+    if args.cross_check and results["cross_check"]["trie_missed"]:
+        print("The trie does not find some of its own words", file=sys.stderr)
+        status = 1
+
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against the baseline", file=sys.stderr)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
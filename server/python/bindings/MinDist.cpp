@@ -3,82 +3,321 @@
 #include <vector>
 #include <tuple>
 #include <cmath>
+#include <cstdint>
+#include <climits>
+#include <limits>
+#include <algorithm>
+#include <functional>
+#include <memory>
+#include <queue>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <stdexcept>
+#include <map>
+#include <string>
+#include <string_view>
+#include <fstream>
 #include <iostream>
 
+#include "Vocabulary.h"
+
 
 using namespace std;
+namespace py = pybind11;
 
-constexpr int ROWS = 4;
-constexpr int COLS = 24;
+/*
+ * What swapping two neighbouring letters costs in the fused score. It is the
+ * most common typo, so it costs less than even the cheapest substitution
+ * (half an edit): "teh" is closer to "the" than to "ten". Swaps mostly
+ * happen when the two hands race each other, so a swap of two keys typed by
+ * the same hand (or off the keyboard) costs a little more: "hte" is closer
+ * to "the" than to "het".
+ */
+constexpr double TRANSPOSITION_COST = 0.4;
+constexpr double SAME_HAND_TRANSPOSITION_COST = 0.45;
+/* the first this many keys of a row are typed by the left hand */
+constexpr int LEFT_HAND_KEYS = 5;
 
-char keyboard[ROWS][COLS] = {
-    {'1', '!', '2', '@', '3', '#', '4', '$', '5', '%', '6', '^', '7', '&', '8', '*', '9', '(', '0', ')', '-', '_', '='},
-    {'q', 'w', 'e', 'r', 't', 'y', 'u', 'i', 'o', 'p', '{', '[', '}', ']', '\\', '|'},
-    {'a', 's', 'd', 'f', 'g', 'h', 'j', 'k', 'l', ';', ':', '"', '\''},
-    {'z', 'x', 'c', 'v', 'b', 'n', 'm', ',', '<', '.', '>', '/', '?'}
+/*
+ * A keyboard layout is given as its rows of keys, top to bottom. The column
+ * of a key is its index in the row, and a space leaves a gap. The default
+ * US layout below is the one this program has always used.
+ */
+const map<string, vector<string>> BUILTIN_LAYOUTS = {
+    {"qwerty", {"1!2@3#4$5%6^7&8*9(0)-_=", "qwertyuiop{[}]\\|", "asdfghjkl;:\"'", "zxcvbnm,<.>/?"}},
+    {"azerty", {"1234567890)=", "azertyuiop^$", "qsdfghjklm%*", "wxcvbn,;:!"}},
+    {"dvorak", {"1234567890[]", "',.pyfgcrl/=\\", "aoeuidhtns-", ";qjkxbmwvz"}},
 };
 
-struct Position {
-    int x;
-    int y;
-};
+/*
+ * A layout compiled into lookup tables, so the keyboard distance of a letter
+ * pair is a single table read: the row and column of every byte (-1 when it
+ * is not on the keyboard), and the Euclidean distance between the keys of
+ * every pair of bytes (0 when either one is not on the keyboard).
+ */
+class KeyboardLayout {
+
+private:
+
+    struct Position {
+        int x;
+        int y;
+    };
+
+    Position positions[256];
+    vector<double> distances;
 
-Position get_position(char ch) {
-    for (int i = 0; i < ROWS; i++) {
-        for (int j = 0; j < COLS; j++) {
-            if (keyboard[i][j] == ch)
-                return {j, i};
+public:
+
+    explicit KeyboardLayout(const vector<string>& rows) : distances(256 * 256, 0.0) {
+        fill(begin(positions), end(positions), Position{-1, -1});
+        for (size_t y = 0; y < rows.size(); y++) {
+            for (size_t x = 0; x < rows[y].size(); x++) {
+                unsigned char ch = static_cast<unsigned char>(rows[y][x]);
+                /* the first occurrence of a key wins, like the old linear scan */
+                if (ch != ' ' && positions[ch].x == -1)
+                    positions[ch] = {static_cast<int>(x), static_cast<int>(y)};
+            }
+        }
+
+        for (int a = 0; a < 256; a++) {
+            if (positions[a].x == -1)
+                continue;
+            for (int b = 0; b < 256; b++) {
+                if (positions[b].x == -1)
+                    continue;
+                distances[a * 256 + b] = sqrt(pow(positions[a].x - positions[b].x, 2) +
+                                              pow(positions[a].y - positions[b].y, 2));
+            }
         }
     }
-    return {-1, -1};
+
+    double distance(char a, char b) const {
+        return distances[static_cast<unsigned char>(a) * 256 + static_cast<unsigned char>(b)];
+    }
+
+    /*
+     * What typing b instead of a costs in the fused score: keys right next to
+     * each other cost half an edit, anything two or more keys apart (or not on
+     * the keyboard) costs a full edit.
+     */
+    double substitutionCost(char a, char b) const {
+        if (a == b)
+            return 0.0;
+        if (!contains(a) || !contains(b))
+            return 1.0;
+        return min(1.0, 0.5 * distance(a, b));
+    }
+
+    /* What typing b, a instead of a, b costs in the fused score. */
+    double transpositionCost(char a, char b) const {
+        if (!contains(a) || !contains(b))
+            return SAME_HAND_TRANSPOSITION_COST;
+        bool leftA = positions[static_cast<unsigned char>(a)].x < LEFT_HAND_KEYS;
+        bool leftB = positions[static_cast<unsigned char>(b)].x < LEFT_HAND_KEYS;
+        return leftA != leftB ? TRANSPOSITION_COST : SAME_HAND_TRANSPOSITION_COST;
+    }
+
+    bool contains(char ch) const {
+        return positions[static_cast<unsigned char>(ch)].x != -1;
+    }
+};
+
+/*
+ * Layouts by name. They are compiled once (the built-in ones on first use,
+ * files when loaded at startup), and a request just picks one by name.
+ */
+mutex layoutsLock;
+map<string, shared_ptr<const KeyboardLayout>> layouts;
+
+void addLayout(const string& name, const vector<string>& rows) {
+    auto layout = make_shared<const KeyboardLayout>(rows);
+    lock_guard<mutex> guard(layoutsLock);
+    layouts[name] = layout;
+}
+
+/* Reads a layout from a text file with one row of keys per line and registers it as name. */
+void loadLayout(const string& name, const string& path) {
+    ifstream file(path);
+    if (!file)
+        throw std::runtime_error("Could not open keyboard layout file: " + path);
+
+    vector<string> rows;
+    string line;
+    while (getline(file, line)) {
+        if (!line.empty() && line.back() == '\r')
+            line.pop_back();
+        if (!line.empty())
+            rows.push_back(line);
+    }
+    if (rows.empty())
+        throw std::runtime_error("Keyboard layout file has no rows: " + path);
+    addLayout(name, rows);
+}
+
+shared_ptr<const KeyboardLayout> getLayout(const string& name) {
+    lock_guard<mutex> guard(layoutsLock);
+    auto it = layouts.find(name);
+    if (it != layouts.end())
+        return it->second;
+
+    auto builtin = BUILTIN_LAYOUTS.find(name);
+    if (builtin == BUILTIN_LAYOUTS.end())
+        throw std::invalid_argument("Unknown keyboard layout: " + name);
+    auto layout = make_shared<const KeyboardLayout>(builtin->second);
+    layouts[name] = layout;
+    return layout;
+}
+
+vector<string> layoutNames() {
+    lock_guard<mutex> guard(layoutsLock);
+    vector<string> names;
+    for (const auto& builtin : BUILTIN_LAYOUTS) {
+        names.push_back(builtin.first);
+    }
+    for (const auto& layout : layouts) {
+        if (!BUILTIN_LAYOUTS.count(layout.first))
+            names.push_back(layout.first);
+    }
+    return names;
 }
 
 
-double minDistance(const string &word1, const string &word2) {
-  int m = word1.size();
-  int n = word2.size();
+/*
+ * Bit-parallel edit distance (Myers' algorithm, in the global form described
+ * by Hyyro). The pattern is the word the user typed: bit i of peq[c] is set
+ * when pattern[i] == c, and one DP column of up to 64 cells is kept as bit
+ * vectors of +1/-1 vertical differences, so a whole column is updated with a
+ * handful of word operations per character of the other word.
+ */
+class MyersPattern {
+
+private:
 
-  vector<vector<double>> cache(m + 1, vector<double>(n + 1)); 
+    uint64_t peq[256];
+    int m;
 
-  for (int j = 0; j <= n; j++) {
-    cache[0][j] = static_cast<double>(j);
-  }
+public:
 
-  for (int i = 0; i <= m; i++) {
-    cache[i][0] =  static_cast<double>(i);
-  }
+    static constexpr int MAX_LENGTH = 64;
 
-  // Compute the minimum distance
-  for (int i = 1; i <= m; i++) {
-    for (int j = 1; j <= n; j++) {
-      if (word1[i - 1] == word2[j - 1]) {
-        cache[i][j] = cache[i - 1][j - 1];  // No operation needed
-      } else {
-        cache[i][j] = min({1.0 + cache[i - 1][j], 1.0 + cache[i][j - 1], 1.0 + cache[i - 1][j - 1]});  // Take the minimum of insert, delete, replace
-      }
+    explicit MyersPattern(const string &pattern) : m(static_cast<int>(pattern.size())) {
+        fill(begin(peq), end(peq), 0);
+        for (int i = 0; i < m && i < MAX_LENGTH; i++) {
+            peq[static_cast<unsigned char>(pattern[i])] |= 1ULL << i;
+        }
     }
-  }
 
-  return cache[m][n];  // Return the minimum edit distance
+    /*
+     * Returns the edit distance between the pattern and text, or cutoff + 1 as
+     * soon as the distance is known to be larger than cutoff.
+     */
+    int distance(string_view text, int cutoff) const {
+        int n = static_cast<int>(text.size());
+        if (abs(n - m) > cutoff)
+            return cutoff + 1;
+        if (m == 0)
+            return n;
+
+        const uint64_t high = 1ULL << (m - 1);
+        uint64_t pv = m == MAX_LENGTH ? ~0ULL : (1ULL << m) - 1;
+        uint64_t mv = 0;
+        int score = m;
+
+        for (int j = 0; j < n; j++) {
+            uint64_t eq = peq[static_cast<unsigned char>(text[j])];
+            uint64_t xv = eq | mv;
+            uint64_t xh = (((eq & pv) + pv) ^ pv) | eq;
+            uint64_t ph = mv | ~(xh | pv);
+            uint64_t mh = pv & xh;
+
+            if (ph & high)
+                score++;
+            else if (mh & high)
+                score--;
+
+            /* the rest of text can lower the score by at most one per character */
+            if (score - (n - j - 1) > cutoff)
+                return cutoff + 1;
+
+            ph = (ph << 1) | 1;
+            mh <<= 1;
+            pv = mh | ~(xv | ph);
+            mv = ph & xv;
+        }
+
+        return score;
+    }
+};
+
+
+/*
+ * Two-row edit distance for words too long for MyersPattern. Only the cells
+ * within cutoff of the diagonal can lead to a distance of at most cutoff, so
+ * the rest of each row is skipped. row is scratch space reused across calls.
+ */
+int bandedDistance(string_view word1, string_view word2, int cutoff, vector<int> &row) {
+    int m = word1.size();
+    int n = word2.size();
+    if (abs(m - n) > cutoff)
+        return cutoff + 1;
+
+    const int INF = cutoff + 1;
+    row.assign(n + 1, INF);
+    for (int j = 0; j <= n && j <= cutoff; j++) {
+        row[j] = j;
+    }
+
+    for (int i = 1; i <= m; i++) {
+        int lo = max(1, i - cutoff);
+        int hi = min(n, i + cutoff);
+        int diag = row[lo - 1];     /* cell (i - 1, lo - 1) */
+        row[lo - 1] = lo == 1 && i <= cutoff ? i : INF;
+        int rowMin = row[lo - 1];
+
+        for (int j = lo; j <= hi; j++) {
+            int up = row[j];
+            int cost = word1[i - 1] == word2[j - 1] ? 0 : 1;
+            row[j] = min({up + 1, row[j - 1] + 1, diag + cost, INF});
+            diag = up;
+            rowMin = min(rowMin, row[j]);
+        }
+        if (hi < n)
+            row[hi + 1] = INF;
+
+        if (rowMin > cutoff)
+            return cutoff + 1;
+    }
+
+    return min(row[n], INF);
+}
+
+
+/* Turns a floating point max_edit (infinity meaning no limit) into an integer cutoff. */
+int toCutoff(double maxEdit) {
+    if (!(maxEdit < static_cast<double>(INT_MAX / 2)))
+        return INT_MAX / 2;
+    return static_cast<int>(floor(maxEdit));
+}
+
+
+double minDistance(const string &word1, const string &word2, double maxEdit) {
+    int cutoff = toCutoff(maxEdit);
+    if (word1.size() <= MyersPattern::MAX_LENGTH)
+        return MyersPattern(word1).distance(word2, cutoff);
+
+    vector<int> row;
+    return bandedDistance(word1, word2, cutoff, row);
 }
 
-double keyboardDist(const string &word1, const string &word2) {
+double keyboardDist(string_view word1, string_view word2, const KeyboardLayout &layout) {
     double dist = 0.0;
-    size_t i = 0;
-    size_t j = 0;
+    size_t len = min(word1.size(), word2.size());
 
-    while (i < word1.size() && j < word2.size()) {
-        Position p1 = get_position(word1[i]);
-        Position p2 = get_position(word2[j]);
-        if (p1.x == -1 || p2.x == -1) {
-          i++;
-          j++;
-          continue;
-        }
-        
-        dist += sqrt(pow(p1.x - p2.x, 2) + pow(p1.y - p2.y, 2));
-        i++;
-        j++;
+    /* keys that are not on the keyboard have a distance of 0 in the table */
+    for (size_t i = 0; i < len; i++) {
+        dist += layout.distance(word1[i], word2[i]);
     }
 
     dist += 2.0 * fabs(static_cast<double>(word2.size()) - static_cast<double>(word1.size()));
@@ -86,20 +325,838 @@ double keyboardDist(const string &word1, const string &word2) {
     return dist;
 }
 
-vector<tuple<string, double, double>> compareWords(const string& input_word, const vector<string>& words) {
+/*
+ * A fixed set of worker threads that compareWords splits large candidate
+ * lists across. It is created on first use, so processes that never score a
+ * large list never start any threads.
+ */
+class ThreadPool {
+
+private:
+
+    vector<thread> workers;
+    queue<function<void()>> tasks;
+    mutex lock;
+    condition_variable ready;
+    bool stopping;
+
+    void work() {
+        while (true) {
+            function<void()> task;
+            {
+                unique_lock<mutex> guard(lock);
+                ready.wait(guard, [this] { return stopping || !tasks.empty(); });
+                if (stopping && tasks.empty())
+                    return;
+                task = move(tasks.front());
+                tasks.pop();
+            }
+            task();
+        }
+    }
+
+public:
+
+    explicit ThreadPool(size_t numThreads) : stopping(false) {
+        for (size_t i = 0; i < numThreads; i++) {
+            workers.emplace_back([this] { work(); });
+        }
+    }
+
+    ~ThreadPool() {
+        {
+            lock_guard<mutex> guard(lock);
+            stopping = true;
+        }
+        ready.notify_all();
+        for (thread& worker : workers) {
+            worker.join();
+        }
+    }
+
+    size_t size() const {
+        return workers.size();
+    }
+
+    /* Runs body(0) .. body(chunks - 1), one of them on the calling thread, and waits for all of them. */
+    void parallelFor(size_t chunks, const function<void(size_t)>& body) {
+        size_t remaining = chunks - 1;
+        mutex doneLock;
+        condition_variable done;
+
+        {
+            lock_guard<mutex> guard(lock);
+            for (size_t chunk = 1; chunk < chunks; chunk++) {
+                tasks.push([&, chunk] {
+                    body(chunk);
+                    lock_guard<mutex> doneGuard(doneLock);
+                    if (--remaining == 0)
+                        done.notify_one();
+                });
+            }
+        }
+        ready.notify_all();
+
+        body(0);
+
+        unique_lock<mutex> doneGuard(doneLock);
+        done.wait(doneGuard, [&] { return remaining == 0; });
+    }
+};
+
+/* lists shorter than this are scored on the calling thread alone */
+constexpr size_t MIN_PARALLEL_WORDS = 4096;
+
+mutex poolLock;
+shared_ptr<ThreadPool> pool;
+size_t numThreads = max(1u, thread::hardware_concurrency());
+
+/* Callers hold on to the pool they got, so resizing it never pulls it out from under them. */
+shared_ptr<ThreadPool> getPool() {
+    lock_guard<mutex> guard(poolLock);
+    if (!pool || pool->size() != numThreads - 1)
+        pool = make_shared<ThreadPool>(numThreads - 1);
+    return pool;
+}
+
+/* Sets how many threads (including the caller) compareWords may use; 1 disables threading. */
+void setNumThreads(size_t n) {
+    lock_guard<mutex> guard(poolLock);
+    numThreads = max<size_t>(n, 1);
+}
+
+size_t getNumThreads() {
+    lock_guard<mutex> guard(poolLock);
+    return numThreads;
+}
+
+
+/* Pushes result into out, keeping only the k best (as a max-heap) when k > 0. */
+template <typename Result>
+void keepBest(vector<Result>& out, const Result& result, size_t k) {
+    if (k == 0) {
+        out.push_back(result);
+    } else if (out.size() < k) {
+        out.push_back(result);
+        push_heap(out.begin(), out.end());
+    } else if (result < out.front()) {
+        pop_heap(out.begin(), out.end());
+        out.back() = result;
+        push_heap(out.begin(), out.end());
+    }
+}
+
+/* With k > 0, sorts results and keeps the k best; with k == 0 leaves them in input order. */
+template <typename Result>
+void finishBest(vector<Result>& results, size_t k) {
+    if (k > 0) {
+        sort(results.begin(), results.end());
+        if (results.size() > k)
+            results.resize(k);
+    }
+}
+
+/*
+ * Runs scoreRange(first, last, out) over n words, split into chunks across
+ * the thread pool for long lists, and merges the results. With k > 0 only
+ * the k best are kept, in order; with k == 0 all of them, in input order.
+ */
+template <typename Result, typename RangeScorer>
+vector<Result> selectBest(size_t n, size_t k, const RangeScorer& scoreRange) {
+    size_t chunks = min(getNumThreads(), n / MIN_PARALLEL_WORDS);
+    vector<Result> results;
+
+    if (chunks <= 1) {
+        scoreRange(0, n, results);
+    } else {
+        vector<vector<Result>> partial(chunks);
+        size_t step = (n + chunks - 1) / chunks;
+        getPool()->parallelFor(chunks, [&](size_t chunk) {
+            size_t first = min(n, chunk * step);
+            size_t last = min(n, first + step);
+            scoreRange(first, last, partial[chunk]);
+        });
+        for (const vector<Result>& part : partial) {
+            results.insert(results.end(), part.begin(), part.end());
+        }
+    }
+
+    finishBest(results, k);
+    return results;
+}
+
+/*
+ * Runs body(i) for i in [0, n), split into contiguous chunks across the
+ * thread pool. Used by the batch functions, which score many short lists
+ * (one per input word) rather than one long one.
+ */
+template <typename Body>
+void forEachInput(size_t n, const Body& body) {
+    size_t chunks = min(getNumThreads(), n);
+    if (chunks <= 1) {
+        for (size_t i = 0; i < n; i++) {
+            body(i);
+        }
+        return;
+    }
+
+    size_t step = (n + chunks - 1) / chunks;
+    getPool()->parallelFor(chunks, [&](size_t chunk) {
+        for (size_t i = chunk * step; i < min(n, (chunk + 1) * step); i++) {
+            body(i);
+        }
+    });
+}
+
+
+/*
+ * Lower bounds on the distance between the input word and a candidate that
+ * are much cheaper than the distance itself, so candidates that cannot be
+ * within the cutoff are dropped before the DP. None of them can drop a word
+ * that is within the cutoff:
+ *
+ * - letters: an edit changes the count of at most one letter in each word,
+ *   so the letters one word has more of than the other (the counts from the
+ *   Vocabulary's letter signatures) each took an edit; the letter masks give
+ *   the same bound with one popcount and are checked first.
+ * - bigrams: with both words padded at the ends, a word of length n has
+ *   n + 1 bigrams and one edit destroys at most two of them, so words within
+ *   d edits share at least max(m, n) + 1 - 2d bigrams.
+ *
+ * Under the fused score a substitution can cost half an edit, so the letter
+ * bounds count for half as much, and a swap of two letters destroys three
+ * bigrams for as little as TRANSPOSITION_COST.
+ */
+class Prefilter {
+
+private:
+
+    static constexpr size_t LETTERS = Vocabulary::LETTERS;
+    static constexpr size_t SYMBOLS = LETTERS + 1;        /* letters, then the padding and anything else */
+
+    uint32_t mask;
+    uint8_t counts[LETTERS];
+    size_t length;
+    double perEdit;                 /* letters one edit can account for */
+    double bigramsPerEdit;          /* bigrams one edit can destroy */
+    vector<uint8_t> bigrams;        /* the input's bigrams, counted by code */
+    vector<uint8_t> used;           /* scratch for matching a candidate's bigrams */
+
+    static size_t symbol(char c) {
+        return c >= 'a' && c <= 'z' ? static_cast<size_t>(c - 'a') : LETTERS;
+    }
+
+    /* calls body(code) for every bigram of "#word#" */
+    template <typename Body>
+    static void forEachBigram(string_view word, const Body& body) {
+        size_t previous = LETTERS;
+        for (char c : word) {
+            size_t current = symbol(c);
+            body(previous * SYMBOLS + current);
+            previous = current;
+        }
+        body(previous * SYMBOLS + LETTERS);
+    }
+
+public:
+
+    Prefilter(string_view input, bool fused)
+        : length(input.size()), perEdit(fused ? 2.0 : 1.0),
+          bigramsPerEdit(fused ? max(4.0, 3.0 / TRANSPOSITION_COST) : 2.0),
+          bigrams(SYMBOLS * SYMBOLS, 0), used(SYMBOLS * SYMBOLS, 0) {
+        mask = Vocabulary::letterSignature(input, counts);
+        forEachBigram(input, [this](size_t code) {
+            if (bigrams[code] < UINT8_MAX)
+                bigrams[code]++;
+        });
+    }
+
+    /* false when word (with the given letter signature) is certainly further than cutoff */
+    bool mayMatch(string_view word, uint32_t wordMask, const uint8_t* wordCounts, double cutoff) {
+        const double letterBudget = cutoff * perEdit;
+
+        int missing = __builtin_popcount(mask & ~wordMask);
+        int extra = __builtin_popcount(wordMask & ~mask);
+        if (max(missing, extra) > letterBudget)
+            return false;
+
+        int surplus = 0;
+        int deficit = 0;
+        for (size_t c = 0; c < LETTERS; c++) {
+            int difference = static_cast<int>(counts[c]) - static_cast<int>(wordCounts[c]);
+            surplus += max(difference, 0);
+            deficit += max(-difference, 0);
+        }
+        if (max(surplus, deficit) > letterBudget)
+            return false;
+
+        /* the bigram bound only says something once the words are long enough */
+        double required = static_cast<double>(max(length, word.size()) + 1) - cutoff * bigramsPerEdit;
+        if (required <= 0)
+            return true;
+
+        int shared = 0;
+        forEachBigram(word, [&](size_t code) {
+            if (used[code] < bigrams[code]) {
+                used[code]++;
+                shared++;
+            }
+        });
+        forEachBigram(word, [&](size_t code) {
+            used[code] = 0;
+        });
+        return shared >= required;
+    }
+};
+
+
+/*
+ * Candidates given as word ids of a Vocabulary, read in place: indexing
+ * yields the word itself, so the scoring loops take them like a list of
+ * strings without copying one. Their letter signatures come with them, so
+ * they go through the Prefilter first.
+ */
+struct VocabularyWords {
+    static constexpr bool filtered = true;
+
+    const Vocabulary& vocabulary;
+    const vector<int32_t>& ids;
+
+    string_view operator[](size_t i) const {
+        return vocabulary.word(ids[i]);
+    }
+    size_t size() const {
+        return ids.size();
+    }
+    int32_t id(size_t i) const {
+        return ids[i];
+    }
+    /* what results are ordered by when they tie: the position in the list */
+    size_t key(size_t i) const {
+        return i;
+    }
+};
+
+/*
+ * Every word of a Vocabulary with a length in [minLength, maxLength], which
+ * is one contiguous run of its length-ordered ids. Ties are broken by word
+ * id, i.e. alphabetically, like a list of ids coming from the Trie.
+ */
+struct VocabularyWindow {
+    static constexpr bool filtered = true;
+
+    const Vocabulary& vocabulary;
+    uint32_t first;
+    uint32_t last;
+
+    VocabularyWindow(const Vocabulary& vocabulary, int minLength, int maxLength) : vocabulary(vocabulary) {
+        size_t low = static_cast<size_t>(max(minLength, 0));
+        size_t high = maxLength < 0 ? vocabulary.maxLength() : static_cast<size_t>(maxLength);
+        first = vocabulary.lengthRange(low).first;
+        last = high < low ? first : max(first, vocabulary.lengthRange(high).second);
+    }
+
+    string_view operator[](size_t i) const {
+        return vocabulary.word(id(i));
+    }
+    size_t size() const {
+        return last - first;
+    }
+    int32_t id(size_t i) const {
+        return static_cast<int32_t>(vocabulary.byLength[first + i]);
+    }
+    size_t key(size_t i) const {
+        return static_cast<size_t>(id(i));
+    }
+};
+
+/* A plain list of words, scored as it is. */
+struct StringWords {
+    static constexpr bool filtered = false;
+
+    const vector<string>& words;
+
+    const string& operator[](size_t i) const {
+        return words[i];
+    }
+    size_t size() const {
+        return words.size();
+    }
+    size_t key(size_t i) const {
+        return i;
+    }
+};
+
+/* Throws unless every id of every list is a word of vocabulary. */
+void checkIds(const Vocabulary& vocabulary, const vector<vector<int32_t>>& id_lists) {
+    for (const vector<int32_t>& ids : id_lists) {
+        for (int32_t id : ids) {
+            vocabulary.checkId(id);
+        }
+    }
+}
+
+
+/* A scored candidate; index is its position in the list that was scored. */
+struct Score {
+    int edit;
+    double kb;
+    size_t index;
+
+    /* ordered by edit distance, then keyboard distance, then input order */
+    bool operator<(const Score& other) const {
+        return tie(edit, kb, index) < tie(other.edit, other.kb, other.index);
+    }
+};
+
+/*
+ * Scores words[first, last) against input_word into out. When k > 0 only the
+ * k best scores are kept, as a max-heap: once it is full, its worst edit
+ * distance becomes the cutoff, so most candidates are abandoned early.
+ */
+template <typename Words>
+void scoreRange(const string& input_word, const Words& words, size_t first, size_t last,
+                size_t k, int cutoff, const KeyboardLayout& layout, vector<Score>& out) {
+    const bool bitParallel = input_word.size() <= MyersPattern::MAX_LENGTH;
+    const MyersPattern pattern(bitParallel ? input_word : string());
+    vector<int> row;
+    unique_ptr<Prefilter> filter = Words::filtered ? make_unique<Prefilter>(input_word, false) : nullptr;
+
+    for (size_t i = first; i < last; i++) {
+        string_view word = words[i];
+        int bound = k > 0 && out.size() == k ? min(cutoff, out.front().edit) : cutoff;
+        if constexpr (Words::filtered) {
+            int32_t id = words.id(i);
+            if (!filter->mayMatch(word, words.vocabulary.letterMasks[id], words.vocabulary.letterCountsOf(id), bound))
+                continue;
+        }
+        int edit = bitParallel ? pattern.distance(word, bound) : bandedDistance(input_word, word, bound, row);
+        if (edit > bound)
+            continue;
+
+        keepBest(out, Score{edit, keyboardDist(input_word, word, layout), words.key(i)}, k);
+    }
+}
+
+/*
+ * Scores every word against input_word. Words whose edit distance is larger
+ * than max_edit are abandoned as soon as that is certain and left out of the
+ * result, so they never pay for the keyboard distance either.
+ *
+ * With k == 0 every remaining word is returned in input order. Otherwise only
+ * the k best are returned, sorted by edit distance and then keyboard distance
+ * (ties keep their input order), so the caller does not have to sort.
+ *
+ * Keyboard distances use the named layout. The GIL is released while
+ * scoring, and long lists are split across the thread pool.
+ */
+vector<tuple<string, double, double>> compareWords(const string& input_word, const vector<string>& words,
+                                                   int k, double max_edit, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
     vector<tuple<string, double, double>> res;
+    {
+        py::gil_scoped_release release;
+
+        const int cutoff = toCutoff(max_edit);
+        const size_t topK = static_cast<size_t>(k);
+        vector<Score> scores = selectBest<Score>(words.size(), topK, [&](size_t first, size_t last, vector<Score>& out) {
+            scoreRange(input_word, StringWords{words}, first, last, topK, cutoff, *layout, out);
+        });
+
+        res.reserve(scores.size());
+        for (const Score& score : scores) {
+            res.push_back(make_tuple(words[score.index], static_cast<double>(score.edit), score.kb));
+        }
+    }
+
+    return res;
+}
+
+/*
+ * compareWords for a batch of input words, each against its own list of
+ * candidates (word_lists[i] for input_words[i]), in one call. Each list is
+ * scored on one thread, and the lists are split across the thread pool.
+ */
+vector<vector<tuple<string, double, double>>> compareWordsBatch(const vector<string>& input_words,
+                                                                const vector<vector<string>>& word_lists,
+                                                                int k, double max_edit, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    if (input_words.size() != word_lists.size())
+        throw std::invalid_argument("There must be one list of words per input word.");
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<vector<tuple<string, double, double>>> res(input_words.size());
+    {
+        py::gil_scoped_release release;
+
+        const int cutoff = toCutoff(max_edit);
+        const size_t topK = static_cast<size_t>(k);
+        forEachInput(input_words.size(), [&](size_t i) {
+            const vector<string>& words = word_lists[i];
+            vector<Score> scores;
+            scoreRange(input_words[i], StringWords{words}, 0, words.size(), topK, cutoff, *layout, scores);
+            finishBest(scores, topK);
+
+            res[i].reserve(scores.size());
+            for (const Score& score : scores) {
+                res[i].push_back(make_tuple(words[score.index], static_cast<double>(score.edit), score.kb));
+            }
+        });
+    }
+
+    return res;
+}
+
+/*
+ * compareWordsBatch over word ids: id_lists[i] holds the candidates of
+ * input_words[i] as ids of vocabulary (Trie.closestWordIdsBatch gives them
+ * in that form), and the results carry the ids back instead of the words.
+ * The words are read from the vocabulary in place, so none is copied.
+ */
+vector<vector<tuple<int32_t, double, double>>> compareWordIdsBatch(const vector<string>& input_words,
+                                                                   const Vocabulary& vocabulary,
+                                                                   const vector<vector<int32_t>>& id_lists,
+                                                                   int k, double max_edit, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    if (input_words.size() != id_lists.size())
+        throw std::invalid_argument("There must be one list of word ids per input word.");
+    checkIds(vocabulary, id_lists);
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<vector<tuple<int32_t, double, double>>> res(input_words.size());
+    {
+        py::gil_scoped_release release;
+
+        const int cutoff = toCutoff(max_edit);
+        const size_t topK = static_cast<size_t>(k);
+        forEachInput(input_words.size(), [&](size_t i) {
+            const VocabularyWords words{vocabulary, id_lists[i]};
+            vector<Score> scores;
+            scoreRange(input_words[i], words, 0, words.size(), topK, cutoff, *layout, scores);
+            finishBest(scores, topK);
 
-    for (const auto& word : words) {
-        double edit_score = minDistance(input_word, word);
-        double kb_score = keyboardDist(input_word, word);
-        res.push_back(make_tuple(word, edit_score, kb_score));
+            res[i].reserve(scores.size());
+            for (const Score& score : scores) {
+                res[i].push_back(make_tuple(id_lists[i][score.index], static_cast<double>(score.edit), score.kb));
+            }
+        });
     }
 
     return res;
 }
 
+/* Throws unless there is one length window per input word. */
+void checkWindows(const vector<string>& input_words, const vector<int>& min_lengths, const vector<int>& max_lengths) {
+    if (min_lengths.size() != input_words.size() || max_lengths.size() != input_words.size())
+        throw std::invalid_argument("There must be one min_length and max_length per input word.");
+}
+
+/*
+ * compareWordIdsBatch with every word of vocabulary whose length is in
+ * [min_lengths[i], max_lengths[i]] as the candidates of input_words[i] (a
+ * negative max_length means no upper bound). No candidate list is built:
+ * the window is a run of the vocabulary's length-ordered ids, and the
+ * Prefilter drops most of it before any distance is computed. Ties are
+ * broken alphabetically.
+ */
+vector<vector<tuple<int32_t, double, double>>> compareLengthWindowBatch(const vector<string>& input_words,
+                                                                        const Vocabulary& vocabulary,
+                                                                        const vector<int>& min_lengths,
+                                                                        const vector<int>& max_lengths,
+                                                                        int k, double max_edit, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    checkWindows(input_words, min_lengths, max_lengths);
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<vector<tuple<int32_t, double, double>>> res(input_words.size());
+    {
+        py::gil_scoped_release release;
+
+        const int cutoff = toCutoff(max_edit);
+        const size_t topK = static_cast<size_t>(k);
+        forEachInput(input_words.size(), [&](size_t i) {
+            const VocabularyWindow words(vocabulary, min_lengths[i], max_lengths[i]);
+            vector<Score> scores;
+            scoreRange(input_words[i], words, 0, words.size(), topK, cutoff, *layout, scores);
+            finishBest(scores, topK);
+
+            res[i].reserve(scores.size());
+            for (const Score& score : scores) {
+                /* the key of a window entry is its word id */
+                res[i].push_back(make_tuple(static_cast<int32_t>(score.index), static_cast<double>(score.edit), score.kb));
+            }
+        });
+    }
+
+    return res;
+}
+
+
+/*
+ * The fused typo score: a single DP over the two words that counts
+ * insertions and deletions as one edit each, swaps of two neighbouring
+ * letters ("teh" -> "the") as less than half an edit, and substitutions by
+ * how far apart the two keys are on the layout. It replaces the separate edit and keyboard distances
+ * with one number, in one pass over the matrix.
+ *
+ * Returns infinity as soon as every cell of a row is above cutoff, since no
+ * alignment can get back under it. rows is scratch space reused across calls.
+ */
+double weightedDistance(string_view word1, string_view word2, const KeyboardLayout &layout,
+                        double cutoff, vector<double> &rows) {
+    const double INF = numeric_limits<double>::infinity();
+    size_t m = word1.size();
+    size_t n = word2.size();
+    if (fabs(static_cast<double>(m) - static_cast<double>(n)) > cutoff)
+        return INF;
+
+    rows.assign(3 * (n + 1), 0.0);
+    double *beforePrev = &rows[0];
+    double *prev = &rows[n + 1];
+    double *curr = &rows[2 * (n + 1)];
+    for (size_t j = 0; j <= n; j++) {
+        prev[j] = static_cast<double>(j);
+    }
+
+    for (size_t i = 1; i <= m; i++) {
+        curr[0] = static_cast<double>(i);
+        double rowMin = curr[0];
+
+        for (size_t j = 1; j <= n; j++) {
+            double best = min({prev[j] + 1.0, curr[j - 1] + 1.0,
+                               prev[j - 1] + layout.substitutionCost(word1[i - 1], word2[j - 1])});
+            if (i > 1 && j > 1 && word1[i - 1] == word2[j - 2] && word1[i - 2] == word2[j - 1])
+                best = min(best, beforePrev[j - 2] + layout.transpositionCost(word1[i - 2], word1[i - 1]));
+            curr[j] = best;
+            rowMin = min(rowMin, best);
+        }
+
+        if (rowMin > cutoff)
+            return INF;
+
+        double *oldest = beforePrev;
+        beforePrev = prev;
+        prev = curr;
+        curr = oldest;
+    }
+
+    return prev[n] > cutoff ? INF : prev[n];
+}
+
+
+/* A candidate ranked by the fused score; index is its position in the list that was ranked. */
+struct Ranked {
+    double score;
+    size_t index;
+
+    bool operator<(const Ranked& other) const {
+        return tie(score, index) < tie(other.score, other.index);
+    }
+};
+
+template <typename Words>
+void rankRange(const string& input_word, const Words& words, size_t first, size_t last,
+               size_t k, double cutoff, const KeyboardLayout& layout, vector<Ranked>& out) {
+    vector<double> rows;
+    unique_ptr<Prefilter> filter = Words::filtered ? make_unique<Prefilter>(input_word, true) : nullptr;
+
+    for (size_t i = first; i < last; i++) {
+        string_view word = words[i];
+        double bound = k > 0 && out.size() == k ? min(cutoff, out.front().score) : cutoff;
+        if constexpr (Words::filtered) {
+            int32_t id = words.id(i);
+            if (!filter->mayMatch(word, words.vocabulary.letterMasks[id], words.vocabulary.letterCountsOf(id), bound))
+                continue;
+        }
+        double score = weightedDistance(input_word, word, layout, bound, rows);
+        if (score > bound)
+            continue;
+
+        keepBest(out, Ranked{score, words.key(i)}, k);
+    }
+}
+
+/*
+ * Like compareWords, but every word gets the single fused score instead of
+ * the (edit, keyboard) pair. Words scoring above max_score are left out, and
+ * with k > 0 only the k lowest scores are returned, best first.
+ */
+vector<pair<string, double>> rankWords(const string& input_word, const vector<string>& words,
+                                       int k, double max_score, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<pair<string, double>> res;
+    {
+        py::gil_scoped_release release;
+
+        const size_t topK = static_cast<size_t>(k);
+        vector<Ranked> ranked = selectBest<Ranked>(words.size(), topK, [&](size_t first, size_t last, vector<Ranked>& out) {
+            rankRange(input_word, StringWords{words}, first, last, topK, max_score, *layout, out);
+        });
+
+        res.reserve(ranked.size());
+        for (const Ranked& r : ranked) {
+            res.push_back({words[r.index], r.score});
+        }
+    }
+
+    return res;
+}
+
+/* rankWords for a batch of input words, like compareWordsBatch. */
+vector<vector<pair<string, double>>> rankWordsBatch(const vector<string>& input_words,
+                                                    const vector<vector<string>>& word_lists,
+                                                    int k, double max_score, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    if (input_words.size() != word_lists.size())
+        throw std::invalid_argument("There must be one list of words per input word.");
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<vector<pair<string, double>>> res(input_words.size());
+    {
+        py::gil_scoped_release release;
+
+        const size_t topK = static_cast<size_t>(k);
+        forEachInput(input_words.size(), [&](size_t i) {
+            const vector<string>& words = word_lists[i];
+            vector<Ranked> ranked;
+            rankRange(input_words[i], StringWords{words}, 0, words.size(), topK, max_score, *layout, ranked);
+            finishBest(ranked, topK);
+
+            res[i].reserve(ranked.size());
+            for (const Ranked& r : ranked) {
+                res[i].push_back({words[r.index], r.score});
+            }
+        });
+    }
+
+    return res;
+}
+
+/* rankWordsBatch over word ids, like compareWordIdsBatch. */
+vector<vector<pair<int32_t, double>>> rankWordIdsBatch(const vector<string>& input_words,
+                                                       const Vocabulary& vocabulary,
+                                                       const vector<vector<int32_t>>& id_lists,
+                                                       int k, double max_score, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    if (input_words.size() != id_lists.size())
+        throw std::invalid_argument("There must be one list of word ids per input word.");
+    checkIds(vocabulary, id_lists);
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<vector<pair<int32_t, double>>> res(input_words.size());
+    {
+        py::gil_scoped_release release;
+
+        const size_t topK = static_cast<size_t>(k);
+        forEachInput(input_words.size(), [&](size_t i) {
+            const VocabularyWords words{vocabulary, id_lists[i]};
+            vector<Ranked> ranked;
+            rankRange(input_words[i], words, 0, words.size(), topK, max_score, *layout, ranked);
+            finishBest(ranked, topK);
+
+            res[i].reserve(ranked.size());
+            for (const Ranked& r : ranked) {
+                res[i].push_back({id_lists[i][r.index], r.score});
+            }
+        });
+    }
+
+    return res;
+}
+
+/* rankWordIdsBatch over length windows of vocabulary, like compareLengthWindowBatch. */
+vector<vector<pair<int32_t, double>>> rankLengthWindowBatch(const vector<string>& input_words,
+                                                            const Vocabulary& vocabulary,
+                                                            const vector<int>& min_lengths,
+                                                            const vector<int>& max_lengths,
+                                                            int k, double max_score, const string& layout_name) {
+    if (k < 0)
+        throw std::invalid_argument("k must not be negative.");
+    checkWindows(input_words, min_lengths, max_lengths);
+    shared_ptr<const KeyboardLayout> layout = getLayout(layout_name);
+
+    vector<vector<pair<int32_t, double>>> res(input_words.size());
+    {
+        py::gil_scoped_release release;
+
+        const size_t topK = static_cast<size_t>(k);
+        forEachInput(input_words.size(), [&](size_t i) {
+            const VocabularyWindow words(vocabulary, min_lengths[i], max_lengths[i]);
+            vector<Ranked> ranked;
+            rankRange(input_words[i], words, 0, words.size(), topK, max_score, *layout, ranked);
+            finishBest(ranked, topK);
+
+            res[i].reserve(ranked.size());
+            for (const Ranked& r : ranked) {
+                res[i].push_back({static_cast<int32_t>(r.index), r.score});
+            }
+        });
+    }
+
+    return res;
+}
+
+double weightedDistancePair(const string &word1, const string &word2, const string &layout_name) {
+    vector<double> rows;
+    return weightedDistance(word1, word2, *getLayout(layout_name), numeric_limits<double>::infinity(), rows);
+}
+
 
 PYBIND11_MODULE(MinDist, m) {
-    m.def("compareWords", &compareWords, "A function that returns the resulting edit and keyboard distances of an array of words given an input word.",
-                  pybind11::arg("input_word"), pybind11::arg("words"));
+    m.def("compareWords", &compareWords, "A function that returns the resulting edit and keyboard distances of an array of words given an input word, or only the k best of them when k > 0.",
+                  pybind11::arg("input_word"), pybind11::arg("words"), pybind11::arg("k") = 0,
+                  pybind11::arg("max_edit") = numeric_limits<double>::infinity(),
+                  pybind11::arg("layout") = "qwerty");
+    m.def("rankWords", &rankWords, "A function that ranks an array of words by the fused typo score (keyboard-weighted Damerau edit distance) given an input word, returning only the k best when k > 0.",
+                  pybind11::arg("input_word"), pybind11::arg("words"), pybind11::arg("k") = 0,
+                  pybind11::arg("max_score") = numeric_limits<double>::infinity(),
+                  pybind11::arg("layout") = "qwerty");
+    m.def("compareWordsBatch", &compareWordsBatch, "compareWords for a batch of input words, each with its own array of words, in one call.",
+                  pybind11::arg("input_words"), pybind11::arg("word_lists"), pybind11::arg("k") = 0,
+                  pybind11::arg("max_edit") = numeric_limits<double>::infinity(),
+                  pybind11::arg("layout") = "qwerty");
+    m.def("rankWordsBatch", &rankWordsBatch, "rankWords for a batch of input words, each with its own array of words, in one call.",
+                  pybind11::arg("input_words"), pybind11::arg("word_lists"), pybind11::arg("k") = 0,
+                  pybind11::arg("max_score") = numeric_limits<double>::infinity(),
+                  pybind11::arg("layout") = "qwerty");
+    m.def("compareWordIdsBatch", &compareWordIdsBatch, "compareWordsBatch for candidates given as word ids of a TrieModule.Vocabulary, returning (id, edit distance, keyboard distance) tuples.",
+                  pybind11::arg("input_words"), pybind11::arg("vocabulary"), pybind11::arg("id_lists"),
+                  pybind11::arg("k") = 0, pybind11::arg("max_edit") = numeric_limits<double>::infinity(),
+                  pybind11::arg("layout") = "qwerty");
+    m.def("rankWordIdsBatch", &rankWordIdsBatch, "rankWordsBatch for candidates given as word ids of a TrieModule.Vocabulary, returning (id, score) pairs.",
+                  pybind11::arg("input_words"), pybind11::arg("vocabulary"), pybind11::arg("id_lists"),
+                  pybind11::arg("k") = 0, pybind11::arg("max_score") = numeric_limits<double>::infinity(),
+                  pybind11::arg("layout") = "qwerty");
+    m.def("compareLengthWindowBatch", &compareLengthWindowBatch, "compareWordIdsBatch with every word of the vocabulary in a length window as the candidates, prefiltered before scoring.",
+                  pybind11::arg("input_words"), pybind11::arg("vocabulary"), pybind11::arg("min_lengths"),
+                  pybind11::arg("max_lengths"), pybind11::arg("k") = 0,
+                  pybind11::arg("max_edit") = numeric_limits<double>::infinity(), pybind11::arg("layout") = "qwerty");
+    m.def("rankLengthWindowBatch", &rankLengthWindowBatch, "rankWordIdsBatch with every word of the vocabulary in a length window as the candidates, prefiltered before scoring.",
+                  pybind11::arg("input_words"), pybind11::arg("vocabulary"), pybind11::arg("min_lengths"),
+                  pybind11::arg("max_lengths"), pybind11::arg("k") = 0,
+                  pybind11::arg("max_score") = numeric_limits<double>::infinity(), pybind11::arg("layout") = "qwerty");
+    m.def("weightedDistance", &weightedDistancePair, "A function that returns the fused typo score between two words.",
+                  pybind11::arg("word1"), pybind11::arg("word2"), pybind11::arg("layout") = "qwerty");
+    m.def("minDistance", &minDistance, "A function that returns the edit distance between two words, or max_edit + 1 once it is known to exceed max_edit.",
+                  pybind11::arg("word1"), pybind11::arg("word2"),
+                  pybind11::arg("max_edit") = numeric_limits<double>::infinity());
+    m.def("setNumThreads", &setNumThreads, "Sets how many threads compareWords may use for long word lists.",
+                  pybind11::arg("n"));
+    m.def("getNumThreads", &getNumThreads, "Returns how many threads compareWords may use for long word lists.");
+    m.def("addLayout", &addLayout, "Compiles a keyboard layout from its rows of keys and registers it under name.",
+                  pybind11::arg("name"), pybind11::arg("rows"));
+    m.def("loadLayout", &loadLayout, "Reads a keyboard layout file (one row of keys per line) and registers it under name.",
+                  pybind11::arg("name"), pybind11::arg("path"));
+    m.def("layouts", &layoutNames, "Returns the names of the keyboard layouts that can be used.");
 }
@@ -0,0 +1,190 @@
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+#include <vector>
+#include <string>
+#include <algorithm>
+#include <unordered_set>
+#include <memory>
+#include <cstdint>
+#include <stdexcept>
+
+#include "Vocabulary.h"
+
+using namespace std;
+namespace py = pybind11;
+
+/* To compile this module, use: g++ -O3 -Wall -shared -std=c++17 -fPIC $(python3 -m pybind11 --includes) SymSpell.cpp -o SymSpell.dylib */
+
+/*
+ * Symmetric delete index (the idea behind SymSpell). If two words are within
+ * d edits of each other, deleting at most d characters from each of them
+ * gives the same string. So every word is stored under all of its deletion
+ * variants, and a lookup only has to generate the deletion variants of the
+ * input and collect the words stored under them. The candidates found this
+ * way are a superset of the words within d edits; they still have to be
+ * verified with the edit distance (MinDist) by the caller.
+ */
+class DeletionIndex {
+
+private:
+
+    struct Entry {
+        uint64_t hash;      /* hash of the deletion variant */
+        uint32_t wordId;
+
+        bool operator<(const Entry& other) const {
+            return hash != other.hash ? hash < other.hash : wordId < other.wordId;
+        }
+        bool operator==(const Entry& other) const {
+            return hash == other.hash && wordId == other.wordId;
+        }
+    };
+
+    int maxDistance;
+    shared_ptr<const Vocabulary> words;     /* an entry's wordId is an id of this */
+    vector<Entry> entries;      /* sorted by hash, so a lookup is an equal_range */
+
+    /* 64-bit FNV-1a */
+    static uint64_t hashString(const string& s) {
+        uint64_t h = 14695981039346656037ULL;
+        for (char c : s) {
+            h ^= static_cast<unsigned char>(c);
+            h *= 1099511628211ULL;
+        }
+        return h;
+    }
+
+    /* Adds every string reachable from word by deleting up to `remaining` characters. */
+    static void deletions(const string& word, int remaining, unordered_set<string>& out) {
+        if (remaining == 0 || word.empty())
+            return;
+        for (size_t i = 0; i < word.size(); i++) {
+            string shorter = word.substr(0, i) + word.substr(i + 1);
+            if (out.insert(shorter).second)
+                deletions(shorter, remaining - 1, out);
+        }
+    }
+
+    static unordered_set<string> variants(const string& word, int distance) {
+        unordered_set<string> res = {word};
+        deletions(word, distance, res);
+        return res;
+    }
+
+    vector<uint32_t> candidateIds(const string& word, int distance, int minLength, int maxLength) const {
+        if (distance < 0 || distance > maxDistance)
+            throw std::invalid_argument("distance must be between 0 and the distance the index was built for.");
+
+        vector<uint32_t> ids;
+        for (const string& variant : variants(word, distance)) {
+            Entry probe = {hashString(variant), 0};
+            auto it = lower_bound(entries.begin(), entries.end(), probe);
+            for (; it != entries.end() && it->hash == probe.hash; it++) {
+                ids.push_back(it->wordId);
+            }
+        }
+
+        sort(ids.begin(), ids.end());
+        ids.erase(unique(ids.begin(), ids.end()), ids.end());
+
+        vector<uint32_t> res;
+        for (uint32_t id : ids) {
+            int length = static_cast<int>(words->length(static_cast<int32_t>(id)));
+            if (length < minLength || (maxLength >= 0 && length > maxLength))
+                continue;
+            /* a candidate further away in length than the distance can never match */
+            if (abs(length - static_cast<int>(word.size())) > distance)
+                continue;
+            res.push_back(id);
+        }
+        return res;
+    }
+
+public:
+
+    DeletionIndex(int maxDistance = 2) : maxDistance(maxDistance), words(make_shared<Vocabulary>()) {
+        if (maxDistance < 0)
+            throw std::invalid_argument("max_distance must not be negative.");
+    }
+
+    /* Replaces the contents of the index with the given words. */
+    void build(vector<string> newWords) {
+        sort(newWords.begin(), newWords.end());
+        newWords.erase(unique(newWords.begin(), newWords.end()), newWords.end());
+        build(make_shared<const Vocabulary>(newWords));
+    }
+
+    /*
+     * Replaces the contents of the index with the words of vocabulary, which
+     * is shared rather than copied (the Trie's, say), so lookupIds returns
+     * ids of that vocabulary.
+     */
+    void build(shared_ptr<const Vocabulary> vocabulary) {
+        words = move(vocabulary);
+        entries.clear();
+
+        for (size_t id = 0; id < words->size(); id++) {
+            for (const string& variant : variants(string(words->word(static_cast<int32_t>(id))), maxDistance)) {
+                entries.push_back({hashString(variant), static_cast<uint32_t>(id)});
+            }
+        }
+
+        sort(entries.begin(), entries.end());
+        entries.erase(unique(entries.begin(), entries.end()), entries.end());
+        entries.shrink_to_fit();
+    }
+
+    /*
+     * Returns the candidate words for input_word at the given distance (at most
+     * the distance the index was built for), limited to lengths in
+     * [minLength, maxLength]; a negative maxLength means there is no upper bound.
+     * The candidates come back in alphabetical order, like Trie.fuzzySearch.
+     */
+    vector<string> lookup(const string& word, int distance, int minLength = 0, int maxLength = -1) const {
+        vector<string> res;
+        for (uint32_t id : candidateIds(word, distance, minLength, maxLength)) {
+            res.emplace_back(words->word(static_cast<int32_t>(id)));
+        }
+        return res;
+    }
+
+    /* lookup returning the ids of the candidates in the vocabulary of the index, in ascending order */
+    vector<int32_t> lookupIds(const string& word, int distance, int minLength = 0, int maxLength = -1) const {
+        vector<uint32_t> ids = candidateIds(word, distance, minLength, maxLength);
+        return vector<int32_t>(ids.begin(), ids.end());
+    }
+
+    /* the words of the index, which lookupIds refers to */
+    shared_ptr<const Vocabulary> vocabulary() const {
+        return words;
+    }
+
+    int getMaxDistance() const {
+        return maxDistance;
+    }
+
+    size_t size() const {
+        return entries.size();
+    }
+
+    /* approximate number of bytes held by the index, not counting its (possibly shared) vocabulary */
+    size_t memoryUsage() const {
+        return entries.capacity() * sizeof(Entry);
+    }
+};
+
+
+PYBIND11_MODULE(SymSpell, m) {
+    py::class_<DeletionIndex>(m, "DeletionIndex")
+        .def(py::init<int>(), py::arg("max_distance") = 2)
+        .def("build", py::overload_cast<shared_ptr<const Vocabulary>>(&DeletionIndex::build), py::arg("vocabulary"))
+        .def("build", py::overload_cast<vector<string>>(&DeletionIndex::build), py::arg("words"))
+        .def("lookup", &DeletionIndex::lookup, py::arg("word"), py::arg("distance"),
+             py::arg("min_length") = 0, py::arg("max_length") = -1)
+        .def("lookupIds", &DeletionIndex::lookupIds, py::arg("word"), py::arg("distance"),
+             py::arg("min_length") = 0, py::arg("max_length") = -1)
+        .def("vocabulary", &DeletionIndex::vocabulary)
+        .def("getMaxDistance", &DeletionIndex::getMaxDistance)
+        .def("size", &DeletionIndex::size)
+        .def("memoryUsage", &DeletionIndex::memoryUsage);
+}
@@ -2,322 +2,1330 @@
 #include <pybind11/stl.h>
 #include <vector>
 #include <string>
-#include <iostream>
+#include <algorithm>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <fstream>
+#include <limits>
+#include <memory>
+#include <queue>
+#include <stdexcept>
+#include <climits>
+#include <string_view>
+#include <unordered_map>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "Vocabulary.h"
 
 using namespace std;
 namespace py = pybind11;
 
-template <typename K, typename V>
-
 /* To compile this module, use: g++ -O3 -Wall -shared -std=c++17 -fPIC $(python3 -m pybind11 --includes) TrieModule.cpp -o TrieModule.dylib */
 
-class HashTable {
+/* A whole file mapped read-only into memory, unmapped when the last user lets go of it. */
+class MappedFile {
+
+private:
+
+    void* data;
+    size_t length;
+
+public:
+
+    explicit MappedFile(const string& path) : data(nullptr), length(0) {
+        int fd = open(path.c_str(), O_RDONLY);
+        if (fd == -1)
+            throw std::runtime_error("Could not open snapshot " + path);
+
+        struct stat info;
+        if (fstat(fd, &info) == -1) {
+            close(fd);
+            throw std::runtime_error("Could not read snapshot " + path);
+        }
+
+        length = static_cast<size_t>(info.st_size);
+        if (length > 0)
+            data = mmap(nullptr, length, PROT_READ, MAP_SHARED, fd, 0);
+        close(fd);
+        if (data == MAP_FAILED)
+            throw std::runtime_error("Could not map snapshot " + path);
+    }
+
+    ~MappedFile() {
+        if (data != nullptr)
+            munmap(data, length);
+    }
+
+    MappedFile(const MappedFile&) = delete;
+    MappedFile& operator=(const MappedFile&) = delete;
+
+    const char* bytes() const {
+        return static_cast<const char*>(data);
+    }
+
+    size_t size() const {
+        return length;
+    }
+};
+
+/*
+ * Layout of a snapshot file: a SnapshotHeader followed by the arrays of a
+ * frozen Trie, each starting at an 8-byte aligned offset. The arrays are
+ * stored exactly as they are held in memory, so loading a snapshot is a
+ * single mmap and the pages are shared by every process that maps it.
+ */
+constexpr char SNAPSHOT_MAGIC[8] = {'T', 'R', 'I', 'E', 'S', 'N', 'A', 'P'};
+constexpr uint32_t SNAPSHOT_VERSION = 4;
+constexpr uint32_t SNAPSHOT_BYTE_ORDER = 0x01020304;   /* snapshots are not portable across endianness */
+
+enum SnapshotSection {
+    TEXT, WORD_OFFSETS, HASH_SLOTS, BY_LENGTH, LENGTH_OFFSETS,     /* the Vocabulary */
+    LETTER_MASKS, LETTER_COUNTS,
+    NODES, LABELS, COMPLETIONS, COMPLETION_OFFSETS,
+    WEIGHTS, MAX_WEIGHTS,
+    NUM_SECTIONS
+};
+
+struct SnapshotHeader {
+    char magic[8];
+    uint32_t version;
+    uint32_t byteOrder;
+    uint32_t k;
+    uint32_t maxDepth;
+    uint64_t sourceStamp;               /* identifies the word list the snapshot was built from */
+    uint64_t counts[NUM_SECTIONS];      /* number of elements in every section */
+    uint64_t offsets[NUM_SECTIONS];     /* byte offset of every section from the start of the file */
+};
+
+/*
+ * Trie nodes examined by the fuzzy searches and cursors of the calling
+ * thread, in total. A search runs on the thread that calls it (with or
+ * without the GIL), so two readings around a call tell how many nodes that
+ * call visited, at the cost of one add per node expanded.
+ */
+static thread_local uint64_t nodesVisited = 0;
+
+uint64_t getNodesVisited() {
+    return nodesVisited;
+}
+
+class Trie {
+
+    friend class TrieCursor;
+
 private:
 
-    struct Entry {
-        K key;
-        V value;
-        bool deleted;
-        bool vacant;
+    /*
+     * The Trie is stored "frozen": instead of every node owning its own hash
+     * table of children, all nodes live in one flat array and the children of
+     * a node occupy a contiguous run of that array, sorted by their label.
+     * A node is then just an index range into `nodes`, and labels[i] is the
+     * character on the edge leading into nodes[i]. Nodes are laid out in
+     * breadth-first order, so the root is nodes[0] and a parent always comes
+     * before its children.
+     */
+    struct Node {
+        uint32_t firstChild;
+        uint32_t numChildren;
+        int32_t wordId;         /* index into the word list, or -1 if no word ends here */
+
+        Node() : firstChild(0), numChildren(0), wordId(-1) {}
+    };
 
-        Entry() : key(), value(), deleted(false), vacant(true) {}
-        Entry(K key, V value) : key(key), value(value), deleted(false), vacant(false) {}
+    /* The arrays of a Trie frozen in this process. */
+    struct Layout {
+        vector<Node> nodes;
+        vector<char> labels;
+        vector<int32_t> completions;
+        vector<uint32_t> completionOffsets;
+        vector<uint32_t> weights;
+        vector<uint32_t> maxWeights;
     };
 
-    Entry* table;
-    int capacity;
-    int num_elements;
-    const int DEFAULT_CAPACITY = (1 << 4) + 3;
-    const double LOAD_FACTOR = 0.75;
-    const int CAPACITY_INCREMENT = 1 << 5;
-    vector<pair<K, V>> valid_elements;
+    /*
+     * An entry of the best-first completion search: either a word, or a node
+     * standing in for every word below it. A node's key is a bound on the
+     * keys of all its words (none is heavier than its heaviest word, or
+     * shorter than its depth), so once a word is the best entry left, no
+     * word still below a node can rank before it.
+     */
+    struct Frontier {
+        uint32_t weight;        /* the weight of the word, or the largest weight below the node */
+        uint32_t length;        /* the length of the word, or the depth of the node */
+        int32_t wordId;         /* -1 for a node */
+        uint32_t node;
+
+        /* whether this entry comes out of the queue after other: lighter, then longer, then nodes before words */
+        bool operator<(const Frontier& other) const {
+            if (weight != other.weight)
+                return weight < other.weight;
+            if (length != other.length)
+                return length > other.length;
+            return wordId > other.wordId;
+        }
+    };
+
+    int k;                      /* number of completions kept for every node */
+    vector<string> pending;     /* words inserted since the last freeze */
+    vector<string> removed;     /* words removed since the last freeze */
+    unordered_map<string, uint32_t> pendingWeights;    /* the weights the pending words were inserted with */
+    unordered_map<string, uint64_t> learned;            /* weight to add to every word at the next freeze */
+    Layout built;
+    shared_ptr<MappedFile> mapped;  /* the snapshot the arrays below point into, if any */
+    uint64_t sourceStamp;
+    uint64_t generation;        /* bumped on every rebuild, so cursors know their node ids are stale */
+
+    /* the words; a node's wordId is a word id of the Vocabulary (alphabetical order) */
+    shared_ptr<Vocabulary> vocab;
+
+    /* The arrays searches read, pointing into either `built` or `mapped`. */
+    Span<Node> nodes;
+    Span<char> labels;
 
-    int hash(const K key) const {
-    #define ABS(x) ((x < 0) ? (-x) : (x))
-        return ABS(std::hash<K>{}(key) % capacity);
+    /*
+     * The best k completions below every node, computed once when the Trie is
+     * frozen. The completions of nodes[i] are the word ids
+     * completions[completionOffsets[i]] .. completions[completionOffsets[i + 1] - 1],
+     * already in ranked order, so a search never has to leave the prefix path.
+     */
+    Span<int32_t> completions;
+    Span<uint32_t> completionOffsets;
+
+    /*
+     * The weight of every word (by word id), e.g. how often it is used, and
+     * the largest weight of a word at or below every node. Heavier words rank
+     * first, then shorter ones, then alphabetically, so with every weight at
+     * 0 the completions are ranked by length as they always were.
+     */
+    Span<uint32_t> weights;
+    Span<uint32_t> maxWeights;
+
+    size_t maxDepth;            /* length of the longest word */
+
+    size_t numWords() const {
+        return vocab->size();
     }
 
-    int hashFunc(int h, int i) const {
-        const int idx = (h + i * i) % capacity;
-        return idx;
+    string_view wordAt(int32_t id) const {
+        return vocab->word(id);
     }
 
-    void resize() {
-        //int old_capacity = capacity;
-        int new_capacity;
-        try {
-            if (capacity > INT_MAX / 2) {
-                throw std::overflow_error("Doubling capacity causes overflow.");
-            }
-            new_capacity = capacity * 2;
-        } catch (const std::overflow_error&) {
-            if (capacity > INT_MAX - CAPACITY_INCREMENT) {
-                throw std::overflow_error("Cannot increase capacity without overflow.");
+    /*
+     * Returns the child of node labelled c, or -1 if there is none. Children are
+     * in std::string order, which compares bytes as unsigned char, so the search
+     * must too or labels of 0x80 and up are missed.
+     */
+    int32_t child(const Node& node, char c) const {
+        auto first = labels.begin() + node.firstChild;
+        auto last = first + node.numChildren;
+        auto it = lower_bound(first, last, c, [](char a, char b) {
+            return static_cast<unsigned char>(a) < static_cast<unsigned char>(b);
+        });
+        if (it == last || *it != c)
+            return -1;
+        return static_cast<int32_t>(it - labels.begin());
+    }
+
+    /* the parameters of a fuzzySearch, passed down the recursion as one */
+    struct FuzzyQuery {
+        const string& word;
+        int maxEdit;
+        size_t minLength;
+        size_t maxLength;
+        bool transpositions;    /* count swapping two neighbouring letters as one edit */
+    };
+
+    /*
+     * Fills rows[depth + 1] for the child labelled c of nodes[idx] (at depth
+     * `depth`) from the rows above it, and returns the minimum of the row.
+     */
+    int nextRow(uint32_t idx, size_t depth, char c, const string& word, bool transpositions,
+                vector<int>& rows) const {
+        const size_t width = word.size() + 1;
+        const int* prev = &rows[depth * width];
+        const int* beforePrev = depth > 0 ? &rows[(depth - 1) * width] : nullptr;
+        const bool swaps = transpositions && depth > 0;
+        int* row = &rows[(depth + 1) * width];
+
+        row[0] = static_cast<int>(depth + 1);
+        int rowMin = row[0];
+        for (size_t j = 1; j < width; j++) {
+            int cost = word[j - 1] == c ? 0 : 1;
+            row[j] = min({prev[j] + 1, row[j - 1] + 1, prev[j - 1] + cost});
+            if (swaps && j > 1 && word[j - 1] == labels[idx] && word[j - 2] == c)
+                row[j] = min(row[j], beforePrev[j - 2] + 1);
+            rowMin = min(rowMin, row[j]);
+        }
+        return rowMin;
+    }
+
+    /*
+     * Bounded Levenshtein search below nodes[idx]. rows holds one DP row per
+     * trie depth, row d being the edit distances between the path to the
+     * current node at depth d and every prefix of the query. Siblings share
+     * the rows of their common prefix, and a branch is dropped as soon as the
+     * minimum of its row exceeds maxEdit, since a row's minimum can only grow
+     * further down the Trie (a transposition only reaches back to a cell
+     * whose diagonal neighbour in the row above is at most one less).
+     */
+    void fuzzyDfs(uint32_t idx, size_t depth, const FuzzyQuery& query, vector<int>& rows,
+                  vector<pair<int32_t, int>>& res) const {
+        const size_t width = query.word.size() + 1;
+        const Node& node = nodes[idx];
+        nodesVisited += node.numChildren;
+        for (uint32_t i = node.firstChild; i < node.firstChild + node.numChildren; i++) {
+            const int* row = &rows[(depth + 1) * width];
+            int rowMin = nextRow(idx, depth, labels[i], query.word, query.transpositions, rows);
+            if (rowMin > query.maxEdit)
+                continue;
+
+            if (nodes[i].wordId != -1 && row[width - 1] <= query.maxEdit && depth + 1 >= query.minLength)
+                res.push_back({nodes[i].wordId, row[width - 1]});
+
+            if (depth + 1 < query.maxLength)
+                fuzzyDfs(i, depth + 1, query, rows, res);
+        }
+    }
+
+    /* a node whose path is within the edit budget of a fuzzyComplete query, and that distance */
+    struct PrefixMatch {
+        uint32_t node;
+        uint32_t depth;
+        int distance;
+    };
+
+    /*
+     * The fuzzy search of fuzzyComplete below nodes[idx]: it finds the nodes
+     * whose path (as a whole) is within maxEdit edits of the query, which
+     * is the last entry of their row. Every word below such a node completes
+     * a prefix that is that close. best is the smallest distance of a node on
+     * the path so far, so a node is only kept if it is closer than that, and
+     * a branch is only entered while its row minimum, a bound on every
+     * distance below it, could still beat it.
+     */
+    void fuzzyPrefixDfs(uint32_t idx, size_t depth, int best, const FuzzyQuery& query, vector<int>& rows,
+                        vector<PrefixMatch>& matches) const {
+        const size_t width = query.word.size() + 1;
+        const Node& node = nodes[idx];
+        nodesVisited += node.numChildren;
+        for (uint32_t i = node.firstChild; i < node.firstChild + node.numChildren; i++) {
+            const int* row = &rows[(depth + 1) * width];
+            int rowMin = nextRow(idx, depth, labels[i], query.word, query.transpositions, rows);
+            if (rowMin > query.maxEdit || rowMin >= best)
+                continue;
+
+            int closest = best;
+            if (row[width - 1] <= query.maxEdit && row[width - 1] < best) {
+                closest = row[width - 1];
+                matches.push_back({i, static_cast<uint32_t>(depth + 1), closest});
             }
-            new_capacity = capacity + CAPACITY_INCREMENT;
-        }
-        
-        // Create a new table with the new capacity
-        Entry* new_table = new Entry[new_capacity]();
-
-        // Rehash all entries into the new table
-        for (int i = 0; i < capacity; i++) {
-
-            // only add entries from the old table to the new table that are not vacant
-            // or deleted.
-
-            if (!table[i].vacant && !table[i].deleted) {
-                int h = std::hash<K>{}(table[i].key) % new_capacity;
-                for (int j = 0; j < new_capacity; j++) {
-                    int idx = (h + j * j) % new_capacity;
-                    if (new_table[idx].vacant) {
-                        new_table[idx] = Entry(table[idx].key, table[idx].value);
-                        break;
-                    }
+            if (rowMin < closest && depth + 1 < maxDepth)
+                fuzzyPrefixDfs(i, depth + 1, closest, query, rows, matches);
+        }
+    }
+
+    /*
+     * The best count completions of every prefix within maxEdit edits of
+     * word, as (word id, distance) pairs, ranked by that distance and then as
+     * exact completions are. A word's distance is the smallest of the nodes
+     * above it, and the best words of a node are its precomputed list (or
+     * its best-first search beyond k), so only those lists are merged: a word
+     * missing from the list of its closest node is outranked by the count
+     * words of that list, which are at least as close.
+     */
+    vector<pair<int32_t, int>> prefixCompletions(const string& word, int maxEdit, size_t count,
+                                                 bool transpositions) const {
+        vector<pair<int32_t, int>> res;
+        if (maxEdit < 0)
+            return res;
+
+        const size_t width = word.size() + 1;
+        vector<int> rows((maxDepth + 1) * width);
+        for (size_t j = 0; j < width; j++) {
+            rows[j] = static_cast<int>(j);
+        }
+
+        /* the root matches when the word could be deleted outright, and then every word does */
+        vector<PrefixMatch> matches;
+        int rootDistance = static_cast<int>(word.size());
+        if (rootDistance <= maxEdit)
+            matches.push_back({0, 0, rootDistance});
+        int best = rootDistance <= maxEdit ? rootDistance : INT_MAX;
+        if (maxDepth > 0)
+            fuzzyPrefixDfs(0, 0, best, FuzzyQuery{word, maxEdit, 0, maxDepth, transpositions}, rows, matches);
+
+        for (const PrefixMatch& match : matches) {
+            if (count <= static_cast<size_t>(k)) {
+                for (uint32_t i = completionOffsets[match.node]; i < completionOffsets[match.node + 1]; i++) {
+                    res.push_back({completions[i], match.distance});
+                }
+            } else {
+                for (int32_t id : bestCompletions(match.node, match.depth, count)) {
+                    res.push_back({id, match.distance});
                 }
             }
         }
 
-        delete[] table;
-        table = new_table;
-        capacity = new_capacity;
-    }
+        /* a word below several matches keeps the smallest distance */
+        sort(res.begin(), res.end());
+        res.erase(unique(res.begin(), res.end(), [](const pair<int32_t, int>& a, const pair<int32_t, int>& b) {
+            return a.first == b.first;
+        }), res.end());
 
-public:
+        const Vocabulary& words = *vocab;
+        const Span<uint32_t>& weights = this->weights;
+        auto rank = [&words, &weights](const pair<int32_t, int>& a, const pair<int32_t, int>& b) {
+            if (a.second != b.second)
+                return a.second < b.second;
+            if (weights[a.first] != weights[b.first])
+                return weights[a.first] > weights[b.first];
+            size_t lengthA = words.length(a.first);
+            size_t lengthB = words.length(b.first);
+            return lengthA != lengthB ? lengthA < lengthB : a.first < b.first;
+        };
+        size_t kept = min(count, res.size());
+        partial_sort(res.begin(), res.begin() + kept, res.end(), rank);
+        res.resize(kept);
+        return res;
+    }
 
     /*
-     * Hash Table with Quadratic Probing
-     */ 
-    HashTable(int init_capacity) : num_elements(0) {
-        if (init_capacity <= 0 || init_capacity > INT_MAX) {
-            std::cout << init_capacity << std::endl;
-            throw std::invalid_argument("Invalid Capacity");
+     * Fills in the completion lists and the largest weights of `built`
+     * bottom-up. Because of the breadth-first layout every child has a larger
+     * index than its parent, so walking the nodes backwards means a node's
+     * children are always done before it.
+     */
+    void buildCompletions() {
+        const vector<Node>& nodes = built.nodes;
+        const vector<uint32_t>& weights = built.weights;
+        vector<int32_t>& completions = built.completions;
+        vector<uint32_t>& completionOffsets = built.completionOffsets;
+        vector<uint32_t>& maxWeights = built.maxWeights;
+        size_t n = nodes.size();
+
+        /* the number of completions of a node is its word count capped at k */
+        vector<uint32_t> counts(n, 0);
+        maxWeights.assign(n, 0);
+        for (size_t idx = n; idx-- > 0;) {
+            uint32_t count = nodes[idx].wordId != -1 ? 1 : 0;
+            uint32_t heaviest = nodes[idx].wordId != -1 ? weights[nodes[idx].wordId] : 0;
+            for (uint32_t i = nodes[idx].firstChild; i < nodes[idx].firstChild + nodes[idx].numChildren; i++) {
+                count += counts[i];
+                heaviest = max(heaviest, maxWeights[i]);
+            }
+            counts[idx] = min(count, static_cast<uint32_t>(k));
+            maxWeights[idx] = heaviest;
+        }
+
+        completionOffsets.assign(n + 1, 0);
+        for (size_t idx = 0; idx < n; idx++) {
+            completionOffsets[idx + 1] = completionOffsets[idx] + counts[idx];
         }
-        capacity = DEFAULT_CAPACITY < init_capacity ? init_capacity : DEFAULT_CAPACITY;
-        table = new Entry[capacity]();
+        completions.assign(completionOffsets[n], -1);
+
+        /* a word ranks before another if it is heavier, then if it is shorter, ties are broken alphabetically */
+        const Vocabulary& words = *vocab;
+        auto rank = [&words, &weights](int32_t a, int32_t b) {
+            if (weights[a] != weights[b])
+                return weights[a] > weights[b];
+            size_t lengthA = words.length(a);
+            size_t lengthB = words.length(b);
+            return lengthA != lengthB ? lengthA < lengthB : a < b;
+        };
+
+        vector<int32_t> candidates;
+        for (size_t idx = n; idx-- > 0;) {
+            const Node& node = nodes[idx];
+            candidates.clear();
+            if (node.wordId != -1)
+                candidates.push_back(node.wordId);
+            for (uint32_t i = node.firstChild; i < node.firstChild + node.numChildren; i++) {
+                candidates.insert(candidates.end(), completions.begin() + completionOffsets[i],
+                                  completions.begin() + completionOffsets[i + 1]);
+            }
+            partial_sort(candidates.begin(), candidates.begin() + counts[idx], candidates.end(), rank);
+            copy(candidates.begin(), candidates.begin() + counts[idx], completions.begin() + completionOffsets[idx]);
+        }
+
+        completions.shrink_to_fit();
+    }
+
+    /* Lays the sorted, unique word list out as a breadth-first array of nodes; weights[i] is the weight of words[i]. */
+    void build(const vector<string>& words, vector<uint32_t> weights) {
+        built = Layout();
+        vocab = make_shared<Vocabulary>(words);
+        built.weights = move(weights);
+        built.weights.resize(words.size(), 0);
+
+        vector<Node>& nodes = built.nodes;
+        vector<char>& labels = built.labels;
+        nodes.assign(1, Node());
+        labels.assign(1, '\0');
+
+        /* the range of words below every node and the depth of that node, */
+        /* only needed while building */
+        vector<pair<uint32_t, uint32_t>> ranges = {{0, static_cast<uint32_t>(words.size())}};
+        vector<uint32_t> depths = {0};
+
+        for (size_t idx = 0; idx < nodes.size(); idx++) {
+            uint32_t lo = ranges[idx].first;
+            uint32_t hi = ranges[idx].second;
+            uint32_t depth = depths[idx];
+
+            /* words are sorted, so a word ending at this node is the first one in the range */
+            if (lo < hi && words[lo].size() == depth) {
+                nodes[idx].wordId = static_cast<int32_t>(lo);
+                lo++;
+            }
+
+            nodes[idx].firstChild = static_cast<uint32_t>(nodes.size());
+            while (lo < hi) {
+                char c = words[lo][depth];
+                uint32_t end = lo;
+                while (end < hi && words[end][depth] == c)
+                    end++;
+                nodes.push_back(Node());
+                labels.push_back(c);
+                ranges.push_back({lo, end});
+                depths.push_back(depth + 1);
+                nodes[idx].numChildren++;
+                lo = end;
+            }
+        }
+
+        nodes.shrink_to_fit();
+        labels.shrink_to_fit();
+        maxDepth = depths.back();
+        buildCompletions();
+
+        mapped.reset();
+        sourceStamp = 0;
+        generation++;
+        this->nodes = built.nodes;
+        this->labels = built.labels;
+        this->completions = built.completions;
+        this->completionOffsets = built.completionOffsets;
+        this->weights = built.weights;
+        this->maxWeights = built.maxWeights;
     }
 
-    HashTable() : capacity(DEFAULT_CAPACITY), num_elements(0) {
-        table = new Entry[capacity]();
+    /* Points section `section` of the snapshot at span, checking that it lies inside the file. */
+    template <typename T>
+    static void attach(const MappedFile& file, const SnapshotHeader& header, SnapshotSection section,
+                       Span<T>& span) {
+        uint64_t offset = header.offsets[section];
+        uint64_t count = header.counts[section];
+        if (offset % alignof(T) != 0 || offset > file.size() || count > (file.size() - offset) / sizeof(T))
+            throw std::runtime_error("The snapshot is truncated or corrupt.");
+        span = Span<T>(reinterpret_cast<const T*>(file.bytes() + offset), static_cast<size_t>(count));
     }
 
-    ~HashTable() {
-        delete[] table;
+    /* The searches below expect the Trie to be frozen already. */
+
+    vector<string> completionsAt(uint32_t idx) const {
+        vector<string> res;
+        res.reserve(completionOffsets[idx + 1] - completionOffsets[idx]);
+        for (uint32_t i = completionOffsets[idx]; i < completionOffsets[idx + 1]; i++) {
+            res.emplace_back(wordAt(completions[i]));
+        }
+        return res;
     }
 
-    void insert(const K key, const V value) {
-        if constexpr (std::is_pointer<K>::value && std::is_pointer<V>::value) {
-            if (key == nullptr) throw std::runtime_error("Inserting a null key or value is disallowed.");
+    /*
+     * The best count completions below nodes[idx], at depth `depth`, found
+     * best-first: the heaviest node (by the largest weight below it) is
+     * expanded next, and the search stops as soon as count words came out of
+     * the queue, so light branches are never entered. The ranking is the one
+     * of the precomputed lists, which this extends to any count.
+     */
+    vector<int32_t> bestCompletions(uint32_t idx, uint32_t depth, size_t count) const {
+        vector<int32_t> res;
+        priority_queue<Frontier> frontier;
+        frontier.push({maxWeights[idx], depth, -1, idx});
+        while (!frontier.empty() && res.size() < count) {
+            Frontier best = frontier.top();
+            frontier.pop();
+            if (best.wordId != -1) {
+                res.push_back(best.wordId);
+                continue;
+            }
+
+            const Node& node = nodes[best.node];
+            nodesVisited += node.numChildren;
+            if (node.wordId != -1)
+                frontier.push({weights[node.wordId], best.length, node.wordId, best.node});
+            for (uint32_t i = node.firstChild; i < node.firstChild + node.numChildren; i++) {
+                frontier.push({maxWeights[i], best.length + 1, -1, i});
+            }
         }
-        double load = (double) (num_elements + 1) / (double) capacity;
-        if (load > LOAD_FACTOR) {   
-            resize();
+        return res;
+    }
+
+    /* the best count completions of prefix, from the precomputed list when it is long enough (count 0 means k) */
+    vector<string> completionsOf(const string& prefix, size_t count = 0) const {
+        uint32_t current = 0;
+        for (char c : prefix) {
+            int32_t next = child(nodes[current], c);
+            if (next == -1)
+                return {}; /* prefix was not found */
+            current = static_cast<uint32_t>(next);
+        }
+        if (count == 0 || count <= static_cast<size_t>(k))
+            return count == 0 ? completionsAt(current) : first(completionsAt(current), count);
+        vector<string> res;
+        for (int32_t id : bestCompletions(current, static_cast<uint32_t>(prefix.size()), count)) {
+            res.emplace_back(wordAt(id));
         }
+        return res;
+    }
 
-        pair<K, V> new_pair;
-        new_pair.first = key;
-        new_pair.second = value;
-        valid_elements.push_back(new_pair);
+    static vector<string> first(vector<string> words, size_t count) {
+        if (words.size() > count)
+            words.resize(count);
+        return words;
+    }
 
-        int h = hash(key);
+    /* (word id, distance) of every word within maxEdit, in alphabetical order */
+    vector<pair<int32_t, int>> withinDistance(const string& word, int maxEdit, int minLength, int maxLength,
+                                              bool transpositions) const {
+        vector<pair<int32_t, int>> res;
+        if (maxEdit < 0)
+            return res;
 
-        for (int i = 0; i < capacity; i++) {
-            int idx = hashFunc(h, i);
+        size_t lengthLimit = maxLength < 0 ? maxDepth : min(maxDepth, static_cast<size_t>(maxLength));
+        size_t lengthFloor = static_cast<size_t>(max(minLength, 0));
+        const size_t width = word.size() + 1;
+        vector<int> rows((lengthLimit + 1) * width);
+        for (size_t j = 0; j < width; j++) {
+            rows[j] = static_cast<int>(j);
+        }
 
-            if (table[idx].vacant || table[idx].deleted) {
-                /* create a new entry when finding an empty spot */
-                table[idx] = Entry(key, value);
-                num_elements++;
-                return;
-            }
+        /* the root only matters when the empty string is a word */
+        if (nodes[0].wordId != -1 && static_cast<int>(word.size()) <= maxEdit && lengthFloor == 0)
+            res.push_back({nodes[0].wordId, static_cast<int>(word.size())});
 
-            if (table[idx].key == key) {
-                /* update an old entry's value to the value passed in when finding the same key */
-                table[idx].value = value;
-                return;
-            }
+        if (lengthLimit > 0)
+            fuzzyDfs(0, 0, FuzzyQuery{word, maxEdit, lengthFloor, lengthLimit, transpositions}, rows, res);
+        return res;
+    }
+
+    vector<pair<int32_t, int>> closest(const string& word, int maxEdit, int minLength, int maxLength,
+                                       int minResults, bool transpositions) const {
+        vector<pair<int32_t, int>> res;
+        for (int budget = 1; budget <= maxEdit; budget++) {
+            res = withinDistance(word, budget, minLength, maxLength, transpositions);
+            if (static_cast<int>(res.size()) >= minResults)
+                break;
         }
+        return res;
     }
 
-    void remove(K key) {
-        if constexpr (std::is_pointer<K>::value) {
-            if (key == nullptr) throw std::runtime_error("Tried to remove a null key; this is disallowed.");
-        }
-        if (num_elements == 0) return;
-
-        for(int i = 0; i < capacity; i++) {
-            int idx = hashFunc(hash(key), i);
-
-            /* If we come across a vacant entry, this means that */
-            /* the key we are trying to remove does not exist and we */
-            /* may stop probing. If we come across a DELETED entry, */
-            /* we can conclude that we MUST keep probing since the */
-            /* entry we are looking for may exist later on in the table. */
-
-            if (table[idx].vacant) return;
-            if (table[idx].deleted) continue;
-            
-            /* If we find the value with no issues, we may delete it. */
-            if (table[idx].key == key) {
-                table[idx].key = K();
-                table[idx].value = V();
-                table[idx].deleted = true;
-                num_elements--;
-                //for (int i = 0; i < valid_elements.size(); i++) {
-                //    if (valid_elements[i].first == key) {
-                //        vector.erase(vector.begin() + i);
-                //        break;
-                //    }
-                //}
-                return;
+    /* the sorted words of the Trie, with added merged in and removedWords left out */
+    vector<string> mergedWords(vector<string> added, vector<string> removedWords) const {
+        sort(added.begin(), added.end());
+        sort(removedWords.begin(), removedWords.end());
+        auto keep = [&removedWords](string_view word) {
+            return !binary_search(removedWords.begin(), removedWords.end(), word);
+        };
+
+        vector<string> merged;
+        merged.reserve(numWords() + added.size());
+        size_t next = 0;
+        for (size_t id = 0; id < numWords(); id++) {
+            string_view word = wordAt(static_cast<int32_t>(id));
+            while (next < added.size() && added[next] < word) {
+                if (keep(added[next]))
+                    merged.push_back(move(added[next]));
+                next++;
             }
+            if (keep(word))
+                merged.emplace_back(word);
         }
+        for (; next < added.size(); next++) {
+            if (keep(added[next]))
+                merged.push_back(move(added[next]));
+        }
+        merged.erase(unique(merged.begin(), merged.end()), merged.end());
+        return merged;
     }
 
-    V get(const K key) {
-        if constexpr (std::is_pointer<K>::value) {
-            if (key == nullptr) throw std::out_of_range("key is not valid.");
+    /*
+     * The weight of every word of merged: its weight in this Trie, raised to
+     * the weight it was inserted with, plus whatever was learned about it
+     * since (capped at the largest uint32_t).
+     */
+    vector<uint32_t> mergedWeights(const vector<string>& merged, const unordered_map<string, uint32_t>& inserted,
+                                   const unordered_map<string, uint64_t>& learnedWeights) const {
+        vector<uint32_t> res(merged.size(), 0);
+        for (size_t i = 0; i < merged.size(); i++) {
+            uint64_t weight = 0;
+            int32_t id = vocab->find(merged[i]);
+            if (id != -1)
+                weight = weights[id];
+            auto insertedWeight = inserted.find(merged[i]);
+            if (insertedWeight != inserted.end())
+                weight = max<uint64_t>(weight, insertedWeight->second);
+            auto extra = learnedWeights.find(merged[i]);
+            if (extra != learnedWeights.end())
+                weight += extra->second;
+            res[i] = static_cast<uint32_t>(min<uint64_t>(weight, numeric_limits<uint32_t>::max()));
         }
+        return res;
+    }
 
-        if (this->num_elements == 0) throw std::out_of_range("key is not valid.");
+    vector<pair<string, int>> toWords(const vector<pair<int32_t, int>>& found) const {
+        vector<pair<string, int>> res;
+        res.reserve(found.size());
+        for (const auto& entry : found) {
+            res.push_back({string(wordAt(entry.first)), entry.second});
+        }
+        return res;
+    }
 
-        for (int i = 0; i < capacity; i++) {
-            int idx = hashFunc(hash(key), i);
+public:
 
-            /* Similar to the remove function, if we encounter a vacant entry, */
-            /* we may stop probing and conclude that the entry does not exist. */
-            /* If we encounter a DELETED entry, we MUST continue probing because */
-            /* there is a chance the entry does exist. */
+    Trie(int k = 3) : k(k), sourceStamp(0), generation(0), maxDepth(0) {
+        if (k <= 0)
+            throw std::invalid_argument("k must be positive.");
+        build({}, {});
+    }
+
+    /* the spans point into this Trie's own arrays, so it cannot be copied */
+    Trie(const Trie&) = delete;
+    Trie& operator=(const Trie&) = delete;
+
+    /*
+     * Loads a Trie saved with save(). Nothing is parsed: the file is mapped
+     * and searched in place, so loading takes about as long as opening it.
+     * Throws if the file is not a snapshot of this version.
+     */
+    static unique_ptr<Trie> load(const string& path) {
+        auto file = make_shared<MappedFile>(path);
 
-            if (table[idx].vacant) throw std::out_of_range("key is not valid.");
-            if (table[idx].deleted) continue;
+        SnapshotHeader header;
+        if (file->size() < sizeof(header))
+            throw std::runtime_error("The snapshot is truncated or corrupt.");
+        memcpy(&header, file->bytes(), sizeof(header));
+        if (memcmp(header.magic, SNAPSHOT_MAGIC, sizeof(SNAPSHOT_MAGIC)) != 0)
+            throw std::runtime_error(path + " is not a Trie snapshot.");
+        if (header.version != SNAPSHOT_VERSION || header.byteOrder != SNAPSHOT_BYTE_ORDER)
+            throw std::runtime_error(path + " was written by an incompatible version.");
+        if (header.k == 0)
+            throw std::runtime_error("The snapshot is truncated or corrupt.");
 
-            /* If we successfully found the value, we may return it. */
-            if (table[idx].key == key) return table[idx].value;
+        Span<char> text;
+        Span<uint32_t> wordOffsets;
+        Span<int32_t> slots;
+        Span<uint32_t> byLength;
+        Span<uint32_t> lengthOffsets;
+        Span<uint32_t> letterMasks;
+        Span<uint8_t> letterCounts;
+        attach(*file, header, TEXT, text);
+        attach(*file, header, WORD_OFFSETS, wordOffsets);
+        attach(*file, header, HASH_SLOTS, slots);
+        attach(*file, header, BY_LENGTH, byLength);
+        attach(*file, header, LENGTH_OFFSETS, lengthOffsets);
+        attach(*file, header, LETTER_MASKS, letterMasks);
+        attach(*file, header, LETTER_COUNTS, letterCounts);
+
+        auto trie = make_unique<Trie>(static_cast<int>(header.k));
+        trie->vocab = make_shared<Vocabulary>(text, wordOffsets, slots, byLength, lengthOffsets,
+                                             letterMasks, letterCounts, file);
+        attach(*file, header, NODES, trie->nodes);
+        attach(*file, header, LABELS, trie->labels);
+        attach(*file, header, COMPLETIONS, trie->completions);
+        attach(*file, header, COMPLETION_OFFSETS, trie->completionOffsets);
+        attach(*file, header, WEIGHTS, trie->weights);
+        attach(*file, header, MAX_WEIGHTS, trie->maxWeights);
+
+        if (trie->nodes.size() == 0 || trie->completionOffsets.size() != trie->nodes.size() + 1
+                || trie->weights.size() != trie->vocab->size() || trie->maxWeights.size() != trie->nodes.size()
+                || trie->vocab->maxLength() != header.maxDepth)
+            throw std::runtime_error("The snapshot is truncated or corrupt.");
+
+        trie->built = Layout();
+        trie->mapped = file;
+        trie->maxDepth = header.maxDepth;
+        trie->sourceStamp = header.sourceStamp;
+        return trie;
+    }
+
+    /*
+     * Writes the frozen Trie to path as a snapshot tagged with sourceStamp
+     * (anything identifying the word list it was built from, so a stale
+     * snapshot can be told apart). The file is written next to path and
+     * renamed into place, so a process loading it never sees half of it.
+     */
+    void save(const string& path, uint64_t stamp = 0) {
+        freeze();
+
+        SnapshotHeader header = {};
+        memcpy(header.magic, SNAPSHOT_MAGIC, sizeof(SNAPSHOT_MAGIC));
+        header.version = SNAPSHOT_VERSION;
+        header.byteOrder = SNAPSHOT_BYTE_ORDER;
+        header.k = static_cast<uint32_t>(k);
+        header.maxDepth = static_cast<uint32_t>(maxDepth);
+        header.sourceStamp = stamp;
+
+        const Vocabulary& words = *vocab;
+        const pair<const void*, size_t> sections[NUM_SECTIONS] = {
+            {words.text.data, words.text.size() * sizeof(char)},
+            {words.offsets.data, words.offsets.size() * sizeof(uint32_t)},
+            {words.slots.data, words.slots.size() * sizeof(int32_t)},
+            {words.byLength.data, words.byLength.size() * sizeof(uint32_t)},
+            {words.lengthOffsets.data, words.lengthOffsets.size() * sizeof(uint32_t)},
+            {words.letterMasks.data, words.letterMasks.size() * sizeof(uint32_t)},
+            {words.letterCounts.data, words.letterCounts.size() * sizeof(uint8_t)},
+            {nodes.data, nodes.size() * sizeof(Node)},
+            {labels.data, labels.size() * sizeof(char)},
+            {completions.data, completions.size() * sizeof(int32_t)},
+            {completionOffsets.data, completionOffsets.size() * sizeof(uint32_t)},
+            {weights.data, weights.size() * sizeof(uint32_t)},
+            {maxWeights.data, maxWeights.size() * sizeof(uint32_t)},
+        };
+        const size_t counts[NUM_SECTIONS] = {
+            words.text.size(), words.offsets.size(), words.slots.size(), words.byLength.size(),
+            words.lengthOffsets.size(), words.letterMasks.size(), words.letterCounts.size(),
+            nodes.size(), labels.size(), completions.size(), completionOffsets.size(),
+            weights.size(), maxWeights.size(),
+        };
+
+        uint64_t offset = sizeof(header);
+        for (int section = 0; section < NUM_SECTIONS; section++) {
+            offset = (offset + 7) & ~uint64_t(7);
+            header.offsets[section] = offset;
+            header.counts[section] = counts[section];
+            offset += sections[section].second;
+        }
+
+        string temporary = path + ".tmp";
+        {
+            ofstream out(temporary, ios::binary | ios::trunc);
+            if (!out)
+                throw std::runtime_error("Could not write snapshot " + temporary);
+
+            const char padding[8] = {};
+            out.write(reinterpret_cast<const char*>(&header), sizeof(header));
+            uint64_t written = sizeof(header);
+            for (int section = 0; section < NUM_SECTIONS; section++) {
+                out.write(padding, header.offsets[section] - written);
+                out.write(static_cast<const char*>(sections[section].first), sections[section].second);
+                written = header.offsets[section] + sections[section].second;
+            }
+            if (!out)
+                throw std::runtime_error("Could not write snapshot " + temporary);
+        }
+
+        if (std::rename(temporary.c_str(), path.c_str()) != 0) {
+            std::remove(temporary.c_str());
+            throw std::runtime_error("Could not replace snapshot " + path);
+        }
+    }
+
+    /*
+     * inserting a word into the Trie; it becomes searchable after the next
+     * freeze. Inserting a word again never lowers its weight.
+     */
+    void insert(const string& word, uint32_t weight = 0) {
+        pending.push_back(word);
+        if (weight > 0) {
+            uint32_t& current = pendingWeights[word];
+            current = max(current, weight);
         }
-        throw out_of_range("key is not valid.");
     }
 
-    vector<pair<K, V>> getValidTableValues() {
-        return valid_elements;
+    /* adding count to the weight of word at the next freeze, e.g. when it was picked from the suggestions */
+    void learn(const string& word, uint32_t count = 1) {
+        learned[word] += count;
     }
 
+    /* removing a word from the Trie at the next freeze; a removal wins over an insert of the same word */
+    void remove(const string& word) {
+        removed.push_back(word);
+    }
 
-    bool containsKey(const K key) {
-        if constexpr (std::is_pointer<K>::value) {
-            if (key == nullptr) throw std::out_of_range("key is not valid.");
-        } 
-        if (num_elements == 0) return false;
-        for (int i = 0; i < capacity; i++) {
-            int idx = hashFunc(hash(key), i);
+    /* Merges every pending insert and removal into the word list and rebuilds the flat layout. */
+    void freeze() {
+        if (pending.empty() && removed.empty() && learned.empty())
+            return;
 
-            /* same logic as get and remove. */ 
-            /* vacant = stop probing and return false. */
-            /* deleted = continue probing. */
+        vector<string> merged = mergedWords(move(pending), move(removed));
+        vector<uint32_t> mergedWeightList = mergedWeights(merged, pendingWeights, learned);
+        pending = vector<string>();
+        removed = vector<string>();
+        pendingWeights.clear();
+        learned.clear();
+        build(merged, move(mergedWeightList));
+    }
 
-            if (table[idx].vacant) return false;
-            if (table[idx].deleted) continue;
-            if (table[idx].key == key) return true;
+    /*
+     * A new frozen Trie holding the words of this one plus added, minus
+     * removed, with learned[word] added to the weight of every word in
+     * learned, and the words in weights inserted with that weight. This one
+     * is left as it is, so readers can keep using it while the new one is
+     * built (with the GIL released) and swapped in.
+     */
+    unique_ptr<Trie> withChanges(vector<string> added, vector<string> removedWords,
+                                 const unordered_map<string, uint64_t>& learnedWeights = {},
+                                 const unordered_map<string, uint32_t>& insertedWeights = {}) {
+        freeze();
+        auto next = make_unique<Trie>(k);
+        {
+            py::gil_scoped_release release;
+            vector<string> merged = mergedWords(move(added), move(removedWords));
+            next->build(merged, mergedWeights(merged, insertedWeights, learnedWeights));
         }
-        return false;
+        return next;
     }
 
-    int size() const { return num_elements; }
-};
+    /*
+     * the best k completions of prefix, or the best count of them; like every
+     * query below, it runs with the GIL released. Up to k they are read off
+     * the precomputed list, beyond that they are searched best-first.
+     */
+    vector<string> search(const string& prefix, int count = 0) {
+        if (count < 0)
+            throw std::invalid_argument("count must not be negative.");
+        freeze();
+        py::gil_scoped_release release;
+        return completionsOf(prefix, static_cast<size_t>(count));
+    }
 
-class Trie {
+    /*
+     * Returns every word within maxEdit edits of word (Levenshtein distance,
+     * or optimal string alignment distance with transpositions) whose length
+     * lies in [minLength, maxLength], along with its distance. A negative
+     * maxLength means there is no upper bound. The words come back in
+     * alphabetical order.
+     */
+    vector<pair<string, int>> fuzzySearch(const string& word, int maxEdit, int minLength = 0, int maxLength = -1,
+                                          bool transpositions = false) {
+        freeze();
+        py::gil_scoped_release release;
+        return toWords(withinDistance(word, maxEdit, minLength, maxLength, transpositions));
+    }
 
-private:
+    /* fuzzySearch returning only the word ids */
+    vector<int32_t> fuzzySearchIds(const string& word, int maxEdit, int minLength = 0, int maxLength = -1,
+                                   bool transpositions = false) {
+        freeze();
+        py::gil_scoped_release release;
+        vector<int32_t> res;
+        for (const auto& entry : withinDistance(word, maxEdit, minLength, maxLength, transpositions)) {
+            res.push_back(entry.first);
+        }
+        return res;
+    }
 
-    struct Node {
-        HashTable<char, Node*> children;
-        bool isEndOfWord;
-        
-        Node() : children(50), isEndOfWord(false) {}
+    /*
+     * Like fuzzySearch, but with the smallest edit budget (from 1 up to
+     * maxEdit) that finds at least minResults words, so a close match never
+     * pays for searching the wider budgets.
+     */
+    vector<pair<string, int>> closestWords(const string& word, int maxEdit, int minLength = 0, int maxLength = -1,
+                                           int minResults = 1, bool transpositions = false) {
+        freeze();
+        py::gil_scoped_release release;
+        return toWords(closest(word, maxEdit, minLength, maxLength, minResults, transpositions));
+    }
 
-    };
+    /*
+     * Typo-tolerant autocomplete: the best count completions (k if count is
+     * 0) of every prefix within maxEdit edits of word (Levenshtein distance,
+     * or optimal string alignment distance with transpositions), with that
+     * distance. Closer prefixes come first, then completions rank as they do
+     * in search(). It is a single walk of the Trie, pruned like fuzzySearch.
+     */
+    vector<pair<string, int>> fuzzyComplete(const string& word, int maxEdit, int count = 0,
+                                            bool transpositions = false) {
+        if (count < 0)
+            throw std::invalid_argument("count must not be negative.");
+        freeze();
+        py::gil_scoped_release release;
+        return toWords(prefixCompletions(word, maxEdit, count == 0 ? k : static_cast<size_t>(count), transpositions));
+    }
 
-    Node* root;
+    /* fuzzyComplete for every word in one call, returning the words only */
+    vector<vector<string>> fuzzyCompleteBatch(const vector<string>& batch, int maxEdit, int count = 0,
+                                              bool transpositions = false) {
+        if (count < 0)
+            throw std::invalid_argument("count must not be negative.");
+        freeze();
+        py::gil_scoped_release release;
 
-    void dfs(Node *node, const string& prefix, vector<string>& words) const {
-        if (node->isEndOfWord) {
-            if (words.size() < 3) {
-                int flag = 1;
-                for (size_t i = 0; i < words.size(); i++) {
-                    if (words[i] == prefix)
-                        flag = 0;
-                }
-                if (flag)
-                    words.push_back(prefix);
+        vector<vector<string>> res(batch.size());
+        for (size_t i = 0; i < batch.size(); i++) {
+            for (const auto& entry : prefixCompletions(batch[i], maxEdit, count == 0 ? k : static_cast<size_t>(count),
+                                                       transpositions)) {
+                res[i].emplace_back(wordAt(entry.first));
             }
-            else {
-                for (int i = 0; i < 3; i++) {
-                    if (words[i] == prefix)
-                      continue;
-                    if (words[i].length() > prefix.length())
-                        words[i] = prefix;
-                }
+        }
+        return res;
+    }
+
+    /* search for every prefix in one call; the GIL is released while searching */
+    vector<vector<string>> searchBatch(const vector<string>& prefixes, int count = 0) {
+        if (count < 0)
+            throw std::invalid_argument("count must not be negative.");
+        freeze();
+        py::gil_scoped_release release;
+
+        vector<vector<string>> res;
+        res.reserve(prefixes.size());
+        for (const string& prefix : prefixes) {
+            res.push_back(completionsOf(prefix, static_cast<size_t>(count)));
+        }
+        return res;
+    }
+
+    /*
+     * closestWords for every word in one call, with the length window of
+     * words[i] given by minLengths[i] and maxLengths[i]. The GIL is released
+     * while searching.
+     */
+    vector<vector<pair<string, int>>> closestWordsBatch(const vector<string>& batch, int maxEdit,
+                                                        const vector<int>& minLengths, const vector<int>& maxLengths,
+                                                        int minResults = 1, bool transpositions = false) {
+        if (minLengths.size() != batch.size() || maxLengths.size() != batch.size())
+            throw std::invalid_argument("There must be one min_length and max_length per word.");
+
+        freeze();
+        py::gil_scoped_release release;
+
+        vector<vector<pair<string, int>>> res;
+        res.reserve(batch.size());
+        for (size_t i = 0; i < batch.size(); i++) {
+            res.push_back(toWords(closest(batch[i], maxEdit, minLengths[i], maxLengths[i], minResults, transpositions)));
+        }
+        return res;
+    }
+
+    /*
+     * closestWordsBatch returning only the ids of the words (in the
+     * Vocabulary of the Trie), so no string is copied until the candidates
+     * have been scored.
+     */
+    vector<vector<int32_t>> closestWordIdsBatch(const vector<string>& batch, int maxEdit,
+                                                const vector<int>& minLengths, const vector<int>& maxLengths,
+                                                int minResults = 1, bool transpositions = false) {
+        if (minLengths.size() != batch.size() || maxLengths.size() != batch.size())
+            throw std::invalid_argument("There must be one min_length and max_length per word.");
+
+        freeze();
+        py::gil_scoped_release release;
+
+        vector<vector<int32_t>> res(batch.size());
+        for (size_t i = 0; i < batch.size(); i++) {
+            for (const auto& entry : closest(batch[i], maxEdit, minLengths[i], maxLengths[i], minResults, transpositions)) {
+                res[i].push_back(entry.first);
             }
         }
-        vector<pair<char, Node*>> table = node->children.getValidTableValues();
-        for (const pair<char, Node*> &neighbor: table) {
-            dfs(neighbor.second, prefix + neighbor.first, words);
+        return res;
+    }
+
+    int getK() const {
+        return k;
+    }
+
+    /* the weight of word, or 0 if it is not in the Trie */
+    uint32_t weight(const string& word) {
+        freeze();
+        int32_t id = vocab->find(word);
+        return id == -1 ? 0 : weights[id];
+    }
+
+    size_t size() {
+        freeze();
+        return numWords();
+    }
+
+    size_t nodeCount() {
+        freeze();
+        return nodes.size();
+    }
+
+    /* every word, ordered by length and then alphabetically */
+    vector<string> wordsByLength() {
+        freeze();
+        vector<string> res;
+        res.reserve(numWords());
+        for (uint32_t id : vocab->byLength) {
+            res.emplace_back(wordAt(static_cast<int32_t>(id)));
         }
+        return res;
     }
 
-    void deleteTrie(Node *node) {
-      if (!node)
-        return;
+    /*
+     * The offsets of the length buckets in wordsByLength(): the words of
+     * length n are at positions [lengthBuckets()[n], lengthBuckets()[n + 1]).
+     */
+    vector<uint32_t> lengthBuckets() {
+        freeze();
+        return vector<uint32_t>(vocab->lengthOffsets.begin(), vocab->lengthOffsets.end());
+    }
 
-      vector<pair<char, Node*>> table = node->children.getValidTableValues();
+    /* the words of the Trie, which its word ids refer to */
+    shared_ptr<Vocabulary> vocabulary() {
+        freeze();
+        return vocab;
+    }
 
-      for (const pair<char, Node*> &neighbor: table) {
-          deleteTrie(neighbor.second);
-      }
+    /* the stamp passed to save() when the snapshot this Trie was loaded from was written, 0 otherwise */
+    uint64_t getSourceStamp() const {
+        return sourceStamp;
+    }
 
-      delete node;
+    bool isMapped() const {
+        return mapped != nullptr;
     }
 
-public:
+    /* approximate number of bytes held by the frozen layout, including the word list */
+    size_t memoryUsage() {
+        freeze();
+        if (mapped)
+            return mapped->size();
+        return vocab->memoryUsage() + nodes.size() * sizeof(Node) + labels.size()
+            + completions.size() * sizeof(int32_t) + completionOffsets.size() * sizeof(uint32_t)
+            + (weights.size() + maxWeights.size()) * sizeof(uint32_t);
+    }
+};
 
-    Trie() {
-        root = new Node;
+
+/*
+ * A position in a Trie that follows a word as it is typed. Typing a character
+ * moves the cursor one node down and a backspace moves it back up, so the
+ * completions of the word cost one step however long it gets, instead of a
+ * walk from the root on every keystroke.
+ *
+ * For every prefix of the word the cursor also keeps its active set: the
+ * nodes whose path is within maxEdit edits of that prefix, with their exact
+ * distance. The words within maxEdit edits of the typed word are then just
+ * the word nodes of the last set. Typing a character derives the next set
+ * from the last one, and a backspace drops it, so corrections within the
+ * cursor's budget never restart from the root either.
+ */
+class TrieCursor {
+
+private:
+
+    struct Active {
+        uint32_t node;
+        int distance;           /* edit distance between the node's path and the typed word */
+    };
+
+    Trie& trie;
+    int maxEdit;
+    uint64_t generation;        /* the Trie generation the node ids below belong to */
+    string typed;
+    vector<int32_t> path;       /* path[i] is the node of typed[0, i), or -1 once it left the Trie */
+    vector<vector<Active>> levels;  /* levels[i] is the active set of typed[0, i), sorted by node */
+
+    static bool relax(unordered_map<uint32_t, int>& best, uint32_t node, int distance) {
+        auto it = best.find(node);
+        if (it == best.end()) {
+            best.emplace(node, distance);
+            return true;
+        }
+        if (distance >= it->second)
+            return false;
+        it->second = distance;
+        return true;
     }
 
-    ~Trie() {
-        deleteTrie(root);
+    static vector<Active> sorted(const unordered_map<uint32_t, int>& best) {
+        vector<Active> res;
+        res.reserve(best.size());
+        for (const auto& entry : best) {
+            res.push_back({entry.first, entry.second});
+        }
+        sort(res.begin(), res.end(), [](const Active& a, const Active& b) { return a.node < b.node; });
+        return res;
     }
 
-    /* inserting a word into the Trie */
-    void insert(const string& word) {
-        Node* current = root;
-        for (char c : word) {
-            try {
-                current->children.get(c);
-            }
-            catch (const out_of_range& e) {
-                Node* node = new Node();
-                current->children.insert(c, node); 
+    /* Adds every descendant reachable by inserting characters within the budget (the last column of the DP). */
+    void insertions(unordered_map<uint32_t, int>& best) const {
+        vector<uint32_t> work;
+        for (const auto& entry : best) {
+            if (entry.second < maxEdit)
+                work.push_back(entry.first);
+        }
+
+        while (!work.empty()) {
+            uint32_t idx = work.back();
+            work.pop_back();
+            int distance = best[idx] + 1;
+            const Trie::Node& node = trie.nodes[idx];
+            nodesVisited += node.numChildren;
+            for (uint32_t i = node.firstChild; i < node.firstChild + node.numChildren; i++) {
+                if (relax(best, i, distance) && distance < maxEdit)
+                    work.push_back(i);
             }
-            current = current->children.get(c);
         }
-        current->isEndOfWord = true;
     }
 
-    vector<string> search(const string& prefix) const {
-        Node* current = root;
-        for (char c : prefix) {
-            try {
-                current->children.get(c);
+    /* the active set of the empty word: every node down to depth maxEdit */
+    vector<Active> initial() const {
+        unordered_map<uint32_t, int> best = {{0, 0}};
+        insertions(best);
+        return sorted(best);
+    }
+
+    /*
+     * The active set of typed + c from that of typed. The path of a node is
+     * within the budget of typed + c if c was deleted after an active node,
+     * matched or substituted by the label of a child of one, or if its own
+     * label was inserted after a node of the new set.
+     */
+    vector<Active> advance(const vector<Active>& active, char c) const {
+        unordered_map<uint32_t, int> best;
+        best.reserve(active.size() * 2);
+        for (const Active& a : active) {
+            if (a.distance < maxEdit)
+                relax(best, a.node, a.distance + 1);
+
+            const Trie::Node& node = trie.nodes[a.node];
+            nodesVisited += node.numChildren;
+            for (uint32_t i = node.firstChild; i < node.firstChild + node.numChildren; i++) {
+                int distance = a.distance + (trie.labels[i] == c ? 0 : 1);
+                if (distance <= maxEdit)
+                    relax(best, i, distance);
             }
-            catch (const out_of_range& e) {
-                return {}; /* prefix was not found */
+        }
+
+        insertions(best);
+        return sorted(best);
+    }
+
+    void step(char c) {
+        int32_t current = path.back();
+        path.push_back(current == -1 ? -1 : trie.child(trie.nodes[current], c));
+        levels.push_back(advance(levels.back(), c));
+        typed.push_back(c);
+    }
+
+    void reset() {
+        generation = trie.generation;
+        typed.clear();
+        path.assign(1, 0);
+        levels.assign(1, initial());
+    }
+
+    /* Freezes the Trie, and replays the typed word if that rebuilt it. */
+    void sync() {
+        trie.freeze();
+        if (generation == trie.generation)
+            return;
+
+        string word = typed;
+        reset();
+        for (char c : word) {
+            step(c);
+        }
+    }
+
+    vector<pair<int32_t, int>> closest(int maxEditQuery, int minLength, int maxLength, int minResults) {
+        sync();
+        vector<pair<int32_t, int>> res;
+        for (int budget = 1; budget <= maxEditQuery; budget++) {
+            if (budget > maxEdit) {
+                res = trie.withinDistance(typed, budget, minLength, maxLength, false);
+            } else {
+                res.clear();
+                for (const Active& a : levels.back()) {
+                    int32_t id = trie.nodes[a.node].wordId;
+                    if (id == -1 || a.distance > budget)
+                        continue;
+                    int length = static_cast<int>(trie.vocab->length(id));
+                    if (length >= minLength && (maxLength < 0 || length <= maxLength))
+                        res.push_back({id, a.distance});
+                }
+                sort(res.begin(), res.end());   /* word ids are alphabetical, like a search */
             }
-            current = current->children.get(c);
+
+            if (static_cast<int>(res.size()) >= minResults)
+                break;
         }
-        vector<string> words;
-        dfs(current, prefix, words);
-        return words;
+        return res;
+    }
+
+public:
+
+    TrieCursor(Trie& trie, int maxEdit = 2) : trie(trie), maxEdit(maxEdit) {
+        if (maxEdit < 0)
+            throw std::invalid_argument("max_edit must not be negative.");
+        trie.freeze();
+        reset();
+    }
+
+    /* typing the given characters */
+    void push(const string& chars) {
+        sync();
+        for (char c : chars) {
+            step(c);
+        }
+    }
+
+    /* backspacing count characters (at most all of them) */
+    void pop(size_t count = 1) {
+        sync();
+        size_t keep = typed.size() - min(count, typed.size());
+        typed.resize(keep);
+        path.resize(keep + 1);
+        levels.resize(keep + 1);
+    }
+
+    /* Moves to word by backspacing to the prefix it shares with the typed word and typing the rest. */
+    void moveTo(const string& word) {
+        sync();
+        size_t common = 0;
+        while (common < typed.size() && common < word.size() && typed[common] == word[common])
+            common++;
+        pop(typed.size() - common);
+        push(word.substr(common));
+    }
+
+    string text() const {
+        return typed;
+    }
+
+    /* the same as Trie.search(text()) */
+    vector<string> completions() {
+        sync();
+        if (path.back() == -1)
+            return {};
+        return trie.completionsAt(static_cast<uint32_t>(path.back()));
+    }
+
+    /*
+     * The same as Trie.closestWords(text(), ...) without transpositions.
+     * Budgets up to the cursor's own come from the active set, larger ones
+     * fall back to a search from the root.
+     */
+    vector<pair<string, int>> closestWords(int maxEditQuery, int minLength = 0, int maxLength = -1,
+                                           int minResults = 1) {
+        return trie.toWords(closest(maxEditQuery, minLength, maxLength, minResults));
+    }
+
+    /* closestWords returning only the word ids */
+    vector<int32_t> closestWordIds(int maxEditQuery, int minLength = 0, int maxLength = -1, int minResults = 1) {
+        vector<int32_t> res;
+        for (const auto& entry : closest(maxEditQuery, minLength, maxLength, minResults)) {
+            res.push_back(entry.first);
+        }
+        return res;
+    }
+
+    int getMaxEdit() const {
+        return maxEdit;
+    }
+
+    /* number of nodes in the current active set */
+    size_t activeCount() const {
+        return levels.back().size();
     }
 };
 
@@ -325,8 +1333,108 @@ public:
 
 
 PYBIND11_MODULE(TrieModule, m) {
+    m.def("nodesVisited", &getNodesVisited, "Returns how many Trie nodes the searches of the calling thread have examined so far.");
+
+    /* registered here, and shared with MinDist and SymSpell once this module is imported */
+    py::class_<Vocabulary, shared_ptr<Vocabulary>>(m, "Vocabulary")
+        .def(py::init([](vector<string> words) {
+            sort(words.begin(), words.end());
+            words.erase(unique(words.begin(), words.end()), words.end());
+            return make_shared<Vocabulary>(words);
+        }), py::arg("words"))
+        .def("__len__", &Vocabulary::size)
+        .def("size", &Vocabulary::size)
+        .def("__contains__", [](const Vocabulary& v, const string& word) { return v.contains(word); })
+        .def("contains", [](const Vocabulary& v, const string& word) { return v.contains(word); }, py::arg("word"))
+        .def("find", [](const Vocabulary& v, const string& word) { return v.find(word); }, py::arg("word"))
+        /* contains for many words in one call, e.g. every word of a document */
+        .def("containsBatch", [](const Vocabulary& v, const vector<string>& words) {
+            vector<bool> res(words.size());
+            {
+                py::gil_scoped_release release;
+                for (size_t i = 0; i < words.size(); ++i) {
+                    res[i] = v.contains(words[i]);
+                }
+            }
+            return res;
+        }, py::arg("words"))
+        .def("word", [](const Vocabulary& v, int32_t id) {
+            v.checkId(id);
+            return string(v.word(id));
+        }, py::arg("id"))
+        .def("words", [](const Vocabulary& v, const vector<int32_t>& ids) {
+            vector<string> res;
+            res.reserve(ids.size());
+            for (int32_t id : ids) {
+                v.checkId(id);
+                res.emplace_back(v.word(id));
+            }
+            return res;
+        }, py::arg("ids"))
+        .def("wordsByLength", [](const Vocabulary& v) {
+            vector<string> res;
+            res.reserve(v.size());
+            for (uint32_t id : v.byLength) {
+                res.emplace_back(v.word(static_cast<int32_t>(id)));
+            }
+            return res;
+        })
+        .def("lengthRange", &Vocabulary::lengthRange, py::arg("length"))
+        .def("maxLength", &Vocabulary::maxLength)
+        .def("memoryUsage", &Vocabulary::memoryUsage);
+
     py::class_<Trie>(m, "Trie")
-        .def(py::init<>())
-        .def("insert", &Trie::insert)
-        .def("search", &Trie::search);
+        .def(py::init<int>(), py::arg("k") = 3)
+        .def("insert", &Trie::insert, py::arg("word"), py::arg("weight") = 0)
+        .def("remove", &Trie::remove)
+        .def("learn", &Trie::learn, py::arg("word"), py::arg("count") = 1)
+        .def("freeze", &Trie::freeze)
+        .def("withChanges", &Trie::withChanges, py::arg("added"), py::arg("removed"),
+             py::arg("learned") = unordered_map<string, uint64_t>(),
+             py::arg("weights") = unordered_map<string, uint32_t>())
+        .def("search", &Trie::search, py::arg("prefix"), py::arg("count") = 0)
+        .def("fuzzySearch", &Trie::fuzzySearch, py::arg("word"), py::arg("max_edit"),
+             py::arg("min_length") = 0, py::arg("max_length") = -1, py::arg("transpositions") = false)
+        .def("fuzzySearchIds", &Trie::fuzzySearchIds, py::arg("word"), py::arg("max_edit"),
+             py::arg("min_length") = 0, py::arg("max_length") = -1, py::arg("transpositions") = false)
+        .def("closestWords", &Trie::closestWords, py::arg("word"), py::arg("max_edit"),
+             py::arg("min_length") = 0, py::arg("max_length") = -1, py::arg("min_results") = 1,
+             py::arg("transpositions") = false)
+        .def("searchBatch", &Trie::searchBatch, py::arg("prefixes"), py::arg("count") = 0)
+        .def("fuzzyComplete", &Trie::fuzzyComplete, py::arg("word"), py::arg("max_edit"), py::arg("count") = 0,
+             py::arg("transpositions") = false)
+        .def("fuzzyCompleteBatch", &Trie::fuzzyCompleteBatch, py::arg("words"), py::arg("max_edit"),
+             py::arg("count") = 0, py::arg("transpositions") = false)
+        .def("closestWordsBatch", &Trie::closestWordsBatch, py::arg("words"), py::arg("max_edit"),
+             py::arg("min_lengths"), py::arg("max_lengths"), py::arg("min_results") = 1,
+             py::arg("transpositions") = false)
+        .def("closestWordIdsBatch", &Trie::closestWordIdsBatch, py::arg("words"), py::arg("max_edit"),
+             py::arg("min_lengths"), py::arg("max_lengths"), py::arg("min_results") = 1,
+             py::arg("transpositions") = false)
+        .def("vocabulary", &Trie::vocabulary)
+        .def_static("load", &Trie::load, py::arg("path"))
+        .def("save", &Trie::save, py::arg("path"), py::arg("source_stamp") = 0)
+        .def("size", &Trie::size)
+        .def("getK", &Trie::getK)
+        .def("weight", &Trie::weight, py::arg("word"))
+        .def("nodeCount", &Trie::nodeCount)
+        .def("wordsByLength", &Trie::wordsByLength)
+        .def("lengthBuckets", &Trie::lengthBuckets)
+        .def("getSourceStamp", &Trie::getSourceStamp)
+        .def("isMapped", &Trie::isMapped)
+        .def("memoryUsage", &Trie::memoryUsage);
+
+    py::class_<TrieCursor>(m, "TrieCursor")
+        .def(py::init<Trie&, int>(), py::arg("trie"), py::arg("max_edit") = 2, py::keep_alive<1, 2>())
+        .def("push", &TrieCursor::push, py::arg("chars"))
+        .def("pop", &TrieCursor::pop, py::arg("count") = 1)
+        .def("moveTo", &TrieCursor::moveTo, py::arg("word"))
+        .def("text", &TrieCursor::text)
+        .def("completions", &TrieCursor::completions)
+        .def("closestWords", &TrieCursor::closestWords, py::arg("max_edit"), py::arg("min_length") = 0,
+             py::arg("max_length") = -1, py::arg("min_results") = 1)
+        .def("closestWordIds", &TrieCursor::closestWordIds, py::arg("max_edit"), py::arg("min_length") = 0,
+             py::arg("max_length") = -1, py::arg("min_results") = 1)
+        .def("getMaxEdit", &TrieCursor::getMaxEdit)
+        .def("activeCount", &TrieCursor::activeCount);
 }
@@ -0,0 +1,232 @@
+#pragma once
+
+#include <vector>
+#include <string>
+#include <string_view>
+#include <algorithm>
+#include <memory>
+#include <cstdint>
+#include <stdexcept>
+#include <climits>
+
+/*
+ * Shared by the TrieModule, MinDist and SymSpell bindings: a Vocabulary built
+ * by one module (usually the Trie's) is handed to the others from Python, so
+ * they can all refer to words by id instead of copying strings around.
+ */
+
+/* A read-only view of an array, either owned by a vector or inside a mapped file. */
+template <typename T>
+struct Span {
+    const T* data = nullptr;
+    size_t count = 0;
+
+    Span() = default;
+    Span(const T* data, size_t count) : data(data), count(count) {}
+    Span(const std::vector<T>& v) : data(v.data()), count(v.size()) {}
+
+    const T& operator[](size_t i) const { return data[i]; }
+    const T* begin() const { return data; }
+    const T* end() const { return data + count; }
+    size_t size() const { return count; }
+};
+
+/*
+ * The word list, stored once: every word is a run of one contiguous buffer,
+ * and its id is its position in alphabetical order, so word i is
+ * text[offsets[i], offsets[i + 1]). Next to that it keeps an open addressing
+ * hash table from words to ids (a membership test is one or two probes, not a
+ * scan of the list), and the ids ordered by length, so the words of length n
+ * are byLength[lengthOffsets[n], lengthOffsets[n + 1]).
+ *
+ * Every word also has a letter signature: a bit per letter a-z it contains
+ * (letterMasks[i]) and how often it contains each one, capped at 255
+ * (letterCounts[26 * i, 26 * i + 26)). MinDist compares these with the
+ * input's to rule out candidates before computing any edit distance.
+ *
+ * Like the Trie, the arrays are read through spans, so they are either owned
+ * by the Vocabulary or point into a mapped snapshot that it keeps alive.
+ */
+class Vocabulary {
+
+public:
+
+    struct Arrays {
+        std::vector<char> text;
+        std::vector<uint32_t> offsets;
+        std::vector<int32_t> slots;             /* hash table of word ids, -1 for an empty slot */
+        std::vector<uint32_t> byLength;
+        std::vector<uint32_t> lengthOffsets;
+        std::vector<uint32_t> letterMasks;
+        std::vector<uint8_t> letterCounts;
+    };
+
+    static constexpr size_t LETTERS = 26;
+
+    Span<char> text;
+    Span<uint32_t> offsets;
+    Span<int32_t> slots;
+    Span<uint32_t> byLength;
+    Span<uint32_t> lengthOffsets;
+    Span<uint32_t> letterMasks;
+    Span<uint8_t> letterCounts;
+
+private:
+
+    Arrays owned;
+    std::shared_ptr<const void> keepAlive;      /* whatever the spans point into, if not `owned` */
+
+    /* 64-bit FNV-1a */
+    static uint64_t hashWord(std::string_view word) {
+        uint64_t h = 14695981039346656037ULL;
+        for (char c : word) {
+            h ^= static_cast<unsigned char>(c);
+            h *= 1099511628211ULL;
+        }
+        return h;
+    }
+
+public:
+
+    /* the letter signature of word; counts has room for LETTERS entries, and characters outside a-z are skipped */
+    static uint32_t letterSignature(std::string_view word, uint8_t* counts) {
+        uint32_t mask = 0;
+        std::fill(counts, counts + LETTERS, 0);
+        for (char c : word) {
+            if (c < 'a' || c > 'z')
+                continue;
+            mask |= 1u << (c - 'a');
+            if (counts[c - 'a'] < UINT8_MAX)
+                counts[c - 'a']++;
+        }
+        return mask;
+    }
+
+    Vocabulary() : Vocabulary(std::vector<std::string>()) {}
+
+    /* Builds a Vocabulary of the given words, which must be sorted and unique. */
+    explicit Vocabulary(const std::vector<std::string>& sortedWords) {
+        owned.offsets.reserve(sortedWords.size() + 1);
+        owned.offsets.push_back(0);
+        size_t maxLength = 0;
+        for (const std::string& word : sortedWords) {
+            owned.text.insert(owned.text.end(), word.begin(), word.end());
+            owned.offsets.push_back(static_cast<uint32_t>(owned.text.size()));
+            maxLength = std::max(maxLength, word.size());
+        }
+
+        /* at most half full, so probe sequences stay short */
+        size_t capacity = 16;
+        while (capacity < 2 * sortedWords.size())
+            capacity *= 2;
+        owned.slots.assign(capacity, -1);
+        for (size_t id = 0; id < sortedWords.size(); id++) {
+            size_t slot = hashWord(sortedWords[id]) & (capacity - 1);
+            while (owned.slots[slot] != -1)
+                slot = (slot + 1) & (capacity - 1);
+            owned.slots[slot] = static_cast<int32_t>(id);
+        }
+
+        /* a counting sort by length keeps the alphabetical order within every length */
+        owned.lengthOffsets.assign(maxLength + 2, 0);
+        for (const std::string& word : sortedWords) {
+            owned.lengthOffsets[word.size() + 1]++;
+        }
+        for (size_t length = 1; length < owned.lengthOffsets.size(); length++) {
+            owned.lengthOffsets[length] += owned.lengthOffsets[length - 1];
+        }
+        owned.byLength.resize(sortedWords.size());
+        std::vector<uint32_t> next(owned.lengthOffsets.begin(), owned.lengthOffsets.end() - 1);
+        for (size_t id = 0; id < sortedWords.size(); id++) {
+            owned.byLength[next[sortedWords[id].size()]++] = static_cast<uint32_t>(id);
+        }
+
+        owned.letterMasks.resize(sortedWords.size());
+        owned.letterCounts.resize(LETTERS * sortedWords.size());
+        for (size_t id = 0; id < sortedWords.size(); id++) {
+            owned.letterMasks[id] = letterSignature(sortedWords[id], &owned.letterCounts[LETTERS * id]);
+        }
+
+        text = owned.text;
+        offsets = owned.offsets;
+        slots = owned.slots;
+        byLength = owned.byLength;
+        lengthOffsets = owned.lengthOffsets;
+        letterMasks = owned.letterMasks;
+        letterCounts = owned.letterCounts;
+    }
+
+    /*
+     * A Vocabulary over arrays that live elsewhere (a mapped snapshot), kept
+     * alive by keepAlive. Throws if the arrays do not fit together.
+     */
+    Vocabulary(Span<char> text, Span<uint32_t> offsets, Span<int32_t> slots, Span<uint32_t> byLength,
+               Span<uint32_t> lengthOffsets, Span<uint32_t> letterMasks, Span<uint8_t> letterCounts,
+               std::shared_ptr<const void> keepAlive)
+        : text(text), offsets(offsets), slots(slots), byLength(byLength), lengthOffsets(lengthOffsets),
+          letterMasks(letterMasks), letterCounts(letterCounts), keepAlive(std::move(keepAlive)) {
+        if (offsets.size() == 0 || offsets[offsets.size() - 1] > text.size()
+                || byLength.size() != offsets.size() - 1 || lengthOffsets.size() < 2
+                || lengthOffsets[lengthOffsets.size() - 1] != byLength.size()
+                || slots.size() == 0 || (slots.size() & (slots.size() - 1)) != 0
+                || letterMasks.size() != size() || letterCounts.size() != LETTERS * size())
+            throw std::runtime_error("The vocabulary arrays are truncated or corrupt.");
+    }
+
+    /* the spans point into this object's own arrays, so it cannot be copied */
+    Vocabulary(const Vocabulary&) = delete;
+    Vocabulary& operator=(const Vocabulary&) = delete;
+
+    size_t size() const {
+        return offsets.size() - 1;
+    }
+
+    std::string_view word(int32_t id) const {
+        return std::string_view(text.data + offsets[id], offsets[id + 1] - offsets[id]);
+    }
+
+    size_t length(int32_t id) const {
+        return offsets[id + 1] - offsets[id];
+    }
+
+    const uint8_t* letterCountsOf(int32_t id) const {
+        return letterCounts.data + LETTERS * static_cast<size_t>(id);
+    }
+
+    /* the id of word, or -1 if it is not in the Vocabulary */
+    int32_t find(std::string_view query) const {
+        size_t mask = slots.size() - 1;
+        for (size_t slot = hashWord(query) & mask; slots[slot] != -1; slot = (slot + 1) & mask) {
+            if (word(slots[slot]) == query)
+                return slots[slot];
+        }
+        return -1;
+    }
+
+    bool contains(std::string_view query) const {
+        return find(query) != -1;
+    }
+
+    /* length of the longest word */
+    size_t maxLength() const {
+        return lengthOffsets.size() - 2;
+    }
+
+    /* the range of byLength holding the words of the given length */
+    std::pair<uint32_t, uint32_t> lengthRange(size_t length) const {
+        if (length + 1 >= lengthOffsets.size())
+            return {static_cast<uint32_t>(size()), static_cast<uint32_t>(size())};
+        return {lengthOffsets[length], lengthOffsets[length + 1]};
+    }
+
+    void checkId(int32_t id) const {
+        if (id < 0 || static_cast<size_t>(id) >= size())
+            throw std::out_of_range("word id out of range");
+    }
+
+    /* approximate number of bytes of the arrays */
+    size_t memoryUsage() const {
+        return text.size() + (offsets.size() + byLength.size() + lengthOffsets.size()) * sizeof(uint32_t)
+            + slots.size() * sizeof(int32_t) + letterMasks.size() * sizeof(uint32_t) + letterCounts.size();
+    }
+};
@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from collections import Counter
+from typing import Dict, Iterable, List, Set, Tuple
+
+OPERATIONS = ("add", "remove", "accept")
+
+
+class DictionaryLog:
+    """An append-only log of the words added to and removed from the dictionary at runtime.
+
+    Every update is one JSON line, {"op": "add" | "remove" | "accept", "words": [...]},
+    flushed to disk before the update is applied, so the word file itself is
+    never rewritten. "accept" records suggestions that were picked, each one
+    adding one to the weight of its word. Replaying the log in order gives
+    the net change to apply on top of the word file at startup.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        # Updates may come from several request threads at once
+        self._lock = threading.Lock()
+
+    def append(self, op: str, words: Iterable[str]) -> None:
+        """Record an update durably."""
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown dictionary operation: {op}")
+        line = json.dumps({"op": op, "words": list(words)}) + "\n"
+        with self._lock, open(self.path, "a+b") as file:
+            # Start on a fresh line if a crash left a torn one behind
+            if file.seek(0, os.SEEK_END) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    line = "\n" + line
+            file.write(line.encode())
+            file.flush()
+            os.fsync(file.fileno())
+
+    def read_bytes(self) -> bytes:
+        """Return the raw log, or nothing if there is none yet (used to stamp snapshots)."""
+        try:
+            return self.path.read_bytes()
+        except FileNotFoundError:
+            return b""
+
+    def replay(self) -> Tuple[List[str], List[str], Dict[str, int]]:
+        """Return the (added, removed, accepted) words the whole log amounts to, accepted with how often."""
+        added: Set[str] = set()
+        removed: Set[str] = set()
+        accepted: Counter = Counter()
+        lines = self.read_bytes().decode(errors="replace").splitlines()
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                op, words = entry["op"], entry["words"]
+            except (ValueError, KeyError, TypeError):
+                # A crash while appending can leave a torn line, which was never applied;
+                # the next append starts after it, so it need not be the last one
+                if not line.endswith("}"):
+                    print(f"{self.path}:{number}: ignoring a torn dictionary log entry", file=sys.stderr)
+                    continue
+                raise ValueError(f"{self.path}:{number}: malformed dictionary log entry") from None
+            if op == "add":
+                added.update(words)
+                removed.difference_update(words)
+            elif op == "remove":
+                removed.update(words)
+                added.difference_update(words)
+                # A word that comes back later starts over
+                for word in words:
+                    accepted.pop(word, None)
+            elif op == "accept":
+                accepted.update(words)
+        return sorted(added), sorted(removed), dict(accepted)
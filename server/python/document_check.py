@@ -0,0 +1,114 @@
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+# Words, with the apostrophes of contractions kept inside them
+TOKEN_PATTERN = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)*")
+# A piece of text without any whitespace is only held back until it gets this long
+MAX_HELD_BACK = 4096
+
+# Misspellings are reported as {"offset": ..., "token": ..., "suggestions": [...]}
+Misspelling = Dict[str, object]
+
+
+class DocumentChecker:
+    """Finds the misspelled words of a document that arrives piece by piece.
+
+    Tokens are checked against the dictionary in batches of batch_size with a
+    single known(words) call, and the distinct unknown ones are corrected with
+    a single correct(words) call per batch. The corrections of the last
+    max_remembered misspellings are kept, so a misspelling that comes up again
+    is not corrected twice. Only the unfinished word at the end of a piece and
+    one batch of tokens are held at a time, so a document of any size is
+    checked in bounded memory.
+    """
+
+    def __init__(self, known: Callable[[List[str]], List[bool]], correct: Callable[[List[str]], List[List[str]]],
+                 batch_size: int = 1024, max_remembered: int = 10000, max_word_length: int = 44):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.known = known
+        self.correct = correct
+        self.batch_size = batch_size
+        self.max_remembered = max_remembered
+        self.max_word_length = max_word_length
+        self.tokens = 0
+        self.misspellings = 0
+        self._held_back = ""
+        # Offset in the document of the first character of _held_back
+        self._offset = 0
+        # (offset, token, lowercased token) of the tokens not checked yet
+        self._pending: List[Tuple[int, str, str]] = []
+        self._remembered: "OrderedDict[str, List[str]]" = OrderedDict()
+
+    def feed(self, text: str) -> List[Misspelling]:
+        """Add the next piece of the document and return the misspellings found so far, in document order."""
+        text = self._held_back + text
+        # A word may go on in the next piece, so everything after the last whitespace waits for it
+        end = len(text)
+        while end > 0 and not text[end - 1].isspace():
+            end -= 1
+        if end == 0 and len(text) < MAX_HELD_BACK:
+            self._held_back = text
+            return []
+
+        end = end or len(text)
+        found = self._tokenize(text, end)
+        self._held_back = text[end:]
+        self._offset += end
+        return found
+
+    def finish(self) -> List[Misspelling]:
+        """Check what is left once the whole document was fed."""
+        found = self._tokenize(self._held_back, len(self._held_back))
+        self._offset += len(self._held_back)
+        self._held_back = ""
+        return found + self._check_pending()
+
+    def check(self, pieces: Iterable[str]) -> Iterator[Misspelling]:
+        """Yield the misspellings of the document made of pieces as soon as they are found."""
+        for piece in pieces:
+            yield from self.feed(piece)
+        yield from self.finish()
+
+    def _tokenize(self, text: str, end: int) -> List[Misspelling]:
+        found = []
+        for match in TOKEN_PATTERN.finditer(text, 0, end):
+            token = match.group()
+            self.tokens += 1
+            # Contractions are not in the dictionary, and overlong words are not checked anywhere
+            if "'" in token or len(token) >= self.max_word_length:
+                continue
+            self._pending.append((self._offset + match.start(), token, token.lower()))
+            if len(self._pending) >= self.batch_size:
+                found.extend(self._check_pending())
+        return found
+
+    def _check_pending(self) -> List[Misspelling]:
+        if not self._pending:
+            return []
+        pending, self._pending = self._pending, []
+
+        unique = list(dict.fromkeys(word for _, _, word in pending))
+        unknown = {word for word, known in zip(unique, self.known(unique)) if not known}
+        to_correct = [word for word in unique if word in unknown and word not in self._remembered]
+        corrections = {}
+        if to_correct:
+            corrections = dict(zip(to_correct, self.correct(to_correct)))
+
+        found = []
+        for offset, token, word in pending:
+            if word not in unknown:
+                continue
+            suggestions = corrections.get(word)
+            if suggestions is None:
+                suggestions = self._remembered[word]
+                self._remembered.move_to_end(word)
+            found.append({"offset": offset, "token": token, "suggestions": suggestions})
+
+        for word, suggestions in corrections.items():
+            self._remembered[word] = suggestions
+        while len(self._remembered) > self.max_remembered:
+            self._remembered.popitem(last=False)
+        self.misspellings += len(found)
+        return found
@@ -0,0 +1,160 @@
+import sys
+import time
+import random
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds, in seconds, of the latency buckets: from 10 microseconds (a cached
+# keystroke) to a second (a long word scored against a wide window)
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Descriptions of the counters requests add to through RequestTimer.count
+COUNTER_HELP = {
+    "candidates_scored": "Correction candidates scored by MinDist.",
+    "trie_nodes_visited": "Trie nodes examined by the searches for correction candidates.",
+}
+
+
+class Histogram:
+    """Counts of observations per latency bucket, with their sum, as Prometheus histograms keep them."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # One count per bucket, plus one for everything above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        """Return the _bucket, _sum and _count samples of the histogram in the Prometheus text format."""
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound:g}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.9g}")
+        lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class RequestTimer:
+    """Times the stages of one request: lap(stage) ends the stage that began at the previous lap (or at the start).
+
+    Nothing is shared until finish(), so a lap costs one clock read and an
+    append, and the whole request is recorded under a single lock.
+    """
+
+    __slots__ = ("metrics", "route", "start", "last", "laps", "counts")
+
+    def __init__(self, metrics: "Metrics", route: str):
+        self.metrics = metrics
+        self.route = route
+        self.start = self.last = time.perf_counter()
+        self.laps: List[Tuple[str, float]] = []
+        self.counts: Dict[str, int] = {}
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.laps.append((stage, now - self.last))
+        self.last = now
+
+    def count(self, name: str, amount: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def finish(self, detail: str = "") -> float:
+        """Record the request and return how long it took; detail goes to the slow request log."""
+        total = time.perf_counter() - self.start
+        self.metrics.record(self, total, detail)
+        return total
+
+
+class Metrics:
+    """Per-stage latency histograms and counters of the suggestion path, served in the Prometheus text format.
+
+    Requests that take at least slow_threshold seconds are counted, and a
+    slow_sample_rate fraction of them is written to stderr with the time of
+    every stage, so a slow request shows where its time went.
+    """
+
+    def __init__(self, namespace: str = "autocorrect", buckets: Sequence[float] = LATENCY_BUCKETS,
+                 slow_threshold: Optional[float] = None, slow_sample_rate: float = 1.0):
+        if slow_threshold is not None and slow_threshold <= 0:
+            raise ValueError("slow_threshold must be positive")
+        if not 0 <= slow_sample_rate <= 1:
+            raise ValueError("slow_sample_rate must be between 0 and 1")
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+        self.slow_threshold = slow_threshold
+        self.slow_sample_rate = slow_sample_rate
+        # Routes may run on several threads at once
+        self._lock = threading.Lock()
+        # (route, stage) -> histogram, with stage "total" for the whole request
+        self._latencies: Dict[Tuple[str, str], Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._slow_requests = 0
+        # name -> (type, help, read), sampled when the metrics are rendered
+        self._collected: Dict[str, Tuple[str, str, Callable[[], float]]] = {}
+
+    def timer(self, route: str) -> RequestTimer:
+        return RequestTimer(self, route)
+
+    def collect(self, name: str, kind: str, help_text: str, read: Callable[[], float]) -> None:
+        """Expose a value kept elsewhere (such as a cache's hit count) as a counter or gauge named name."""
+        if kind not in ("counter", "gauge"):
+            raise ValueError(f"Unknown metric type: {kind}")
+        self._collected[name] = (kind, help_text, read)
+
+    def record(self, timer: RequestTimer, total: float, detail: str = "") -> None:
+        """Add the stages and counts of a finished request."""
+        slow = self.slow_threshold is not None and total >= self.slow_threshold
+        with self._lock:
+            for stage, seconds in timer.laps + [("total", total)]:
+                histogram = self._latencies.get((timer.route, stage))
+                if histogram is None:
+                    histogram = self._latencies[(timer.route, stage)] = Histogram(self.buckets)
+                histogram.observe(seconds)
+            for name, amount in timer.counts.items():
+                self._counters[name] = self._counters.get(name, 0) + amount
+            if slow:
+                self._slow_requests += 1
+
+        if slow and random.random() < self.slow_sample_rate:
+            stages = ", ".join(f"{stage} {seconds * 1000:.2f}ms" for stage, seconds in timer.laps)
+            counts = "".join(f", {name} {amount}" for name, amount in timer.counts.items())
+            print(f"Slow request {timer.route} {detail!r}: {total * 1000:.2f}ms ({stages}{counts})", file=sys.stderr)
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        prefix = self.namespace
+        with self._lock:
+            latencies = sorted(self._latencies.items())
+            latency_lines = []
+            for (route, stage), histogram in latencies:
+                latency_lines.extend(histogram.lines(f"{prefix}_stage_seconds", f'route="{route}",stage="{stage}"'))
+            counters = sorted(self._counters.items())
+            slow_requests = self._slow_requests
+
+        lines = [f"# HELP {prefix}_stage_seconds Time spent in each stage of a request (stage \"total\" is all of it).",
+                 f"# TYPE {prefix}_stage_seconds histogram"]
+        lines.extend(latency_lines)
+        for name, amount in counters:
+            if name in COUNTER_HELP:
+                lines.append(f"# HELP {prefix}_{name}_total {COUNTER_HELP[name]}")
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {amount}")
+        lines.append(f"# HELP {prefix}_slow_requests_total Requests that took at least the slow request threshold.")
+        lines.append(f"# TYPE {prefix}_slow_requests_total counter")
+        lines.append(f"{prefix}_slow_requests_total {slow_requests}")
+        for name, (kind, help_text, read) in sorted(self._collected.items()):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {read():.9g}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,519 @@
+"""The scoring functions of MinDist, compiled with numba instead of a C++ toolchain.
+
+Every function takes the same arguments and returns the same results as its
+MinDist counterpart, rankings and tie-breaking included, so either module can
+score the candidates of a WordProcessor (ProcessorConfig.scoring_backend) and
+each one can be checked against the other (benchmark.py --cross-check).
+
+Words are scored as rows of a padded byte matrix: the vocabulary is encoded
+once (and again only when it is swapped for a new one), candidates are row
+numbers into it, and the edit distance, keyboard distance and fused score
+kernels run over the rows without the GIL.
+"""
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+
+import numba
+import numpy as np
+
+# The same built-in layouts as MinDist, top row first; a space leaves a gap
+BUILTIN_LAYOUTS = {
+    "qwerty": ["1!2@3#4$5%6^7&8*9(0)-_=", "qwertyuiop{[}]\\|", "asdfghjkl;:\"'", "zxcvbnm,<.>/?"],
+    "azerty": ["1234567890)=", "azertyuiop^$", "qsdfghjklm%*", "wxcvbn,;:!"],
+    "dvorak": ["1234567890[]", "',.pyfgcrl/=\\", "aoeuidhtns-", ";qjkxbmwvz"],
+}
+
+# What swapping two neighbouring letters costs in the fused score, as in MinDist: less
+# when the two keys are typed by different hands (the first LEFT_HAND_KEYS of a row are the left's)
+TRANSPOSITION_COST = 0.4
+SAME_HAND_TRANSPOSITION_COST = 0.45
+LEFT_HAND_KEYS = 5
+# An unlimited max_edit becomes this cutoff, as in MinDist
+UNLIMITED_CUTOFF = (2**31 - 1) // 2
+# Encoded vocabularies kept at once: the current one, and the one it is replacing
+ENCODED_VOCABULARIES = 2
+LETTERS = 26
+
+
+class KeyboardLayout:
+    """A layout compiled into byte-indexed tables: the distance between every pair of keys, and the fused substitution and transposition costs."""
+
+    def __init__(self, rows: Sequence[str]):
+        xs = np.full(256, -1, dtype=np.int64)
+        ys = np.full(256, -1, dtype=np.int64)
+        for y, row in enumerate(rows):
+            for x, key in enumerate(row.encode("utf-8", "surrogateescape")):
+                # The first occurrence of a key wins
+                if key != ord(" ") and xs[key] == -1:
+                    xs[key], ys[key] = x, y
+
+        on_keyboard = xs != -1
+        both = on_keyboard[:, None] & on_keyboard[None, :]
+        dx = (xs[:, None] - xs[None, :]).astype(np.float64)
+        dy = (ys[:, None] - ys[None, :]).astype(np.float64)
+        self.distances = np.where(both, np.sqrt(dx * dx + dy * dy), 0.0)
+        # Keys right next to each other cost half an edit, anything further (or off the keyboard) a full one
+        self.substitution = np.where(both, np.minimum(1.0, 0.5 * self.distances), 1.0)
+        np.fill_diagonal(self.substitution, 0.0)
+        left = xs < LEFT_HAND_KEYS
+        self.transposition = np.where(both & (left[:, None] != left[None, :]),
+                                      TRANSPOSITION_COST, SAME_HAND_TRANSPOSITION_COST)
+
+
+_layouts_lock = threading.Lock()
+_layouts: Dict[str, KeyboardLayout] = {}
+
+
+def addLayout(name: str, rows: List[str]) -> None:
+    """Compile a keyboard layout from its rows of keys and register it under name."""
+    layout = KeyboardLayout(rows)
+    with _layouts_lock:
+        _layouts[name] = layout
+
+
+def loadLayout(name: str, path: str) -> None:
+    """Read a keyboard layout file (one row of keys per line) and register it under name."""
+    try:
+        with open(path, "rb") as file:
+            lines = file.read().split(b"\n")
+    except OSError:
+        raise RuntimeError(f"Could not open keyboard layout file: {path}")
+    rows = [line.removesuffix(b"\r").decode("utf-8", "surrogateescape") for line in lines]
+    rows = [row for row in rows if row]
+    if not rows:
+        raise RuntimeError(f"Keyboard layout file has no rows: {path}")
+    addLayout(name, rows)
+
+
+def _get_layout(name: str) -> KeyboardLayout:
+    with _layouts_lock:
+        layout = _layouts.get(name)
+        if layout is None:
+            if name not in BUILTIN_LAYOUTS:
+                raise ValueError(f"Unknown keyboard layout: {name}")
+            layout = _layouts[name] = KeyboardLayout(BUILTIN_LAYOUTS[name])
+        return layout
+
+
+def layouts() -> List[str]:
+    """Return the names of the keyboard layouts that can be used."""
+    with _layouts_lock:
+        return list(BUILTIN_LAYOUTS) + [name for name in _layouts if name not in BUILTIN_LAYOUTS]
+
+
+def _letter_counts(matrix: np.ndarray) -> np.ndarray:
+    """Count every letter a-z in every row of matrix."""
+    counts = np.zeros((matrix.shape[0], LETTERS), dtype=np.int64)
+    for letter in range(LETTERS):
+        counts[:, letter] = np.count_nonzero(matrix == ord("a") + letter, axis=1)
+    return counts
+
+
+class EncodedWords:
+    """Words as a matrix of bytes, one zero-padded row per word, with their lengths and length order.
+
+    With letter_counts, the count of every letter a-z of every word is kept
+    as well, so the candidates that are too far off to score can be told
+    apart without computing their distance (MinDist's letter prefilter).
+    """
+
+    def __init__(self, words: Sequence[str], letter_counts: bool = False):
+        encoded = [word.encode() for word in words]
+        self.lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        width = max(int(self.lengths.max(initial=0)), 1)
+        self.matrix = np.frombuffer(b"".join(word.ljust(width, b"\0") for word in encoded),
+                                    dtype=np.uint8).reshape(len(encoded), width)
+        self.letter_counts = _letter_counts(self.matrix) if letter_counts else None
+        # Row numbers ordered by length, then by row, like Vocabulary.byLength
+        self.by_length = np.argsort(self.lengths, kind="stable")
+        # by_length[length_offsets[n]:length_offsets[n + 1]] are the rows of length n
+        self.length_offsets = np.searchsorted(self.lengths[self.by_length], np.arange(width + 2))
+
+    def window(self, min_length: int, max_length: int) -> np.ndarray:
+        """Return the rows with a length in [min_length, max_length] (no upper bound when max_length < 0)."""
+        def length_range(length):
+            if length + 1 >= len(self.length_offsets):
+                return len(self.lengths), len(self.lengths)
+            return self.length_offsets[length], self.length_offsets[length + 1]
+
+        low = max(min_length, 0)
+        high = len(self.length_offsets) - 2 if max_length < 0 else max_length
+        first = length_range(low)[0]
+        last = first if high < low else max(first, length_range(high)[1])
+        return self.by_length[first:last]
+
+
+_encoded_lock = threading.Lock()
+# id(vocabulary) -> (vocabulary, its words encoded); the vocabulary is kept so its id is not reused
+_encoded: "OrderedDict[int, Tuple[object, EncodedWords]]" = OrderedDict()
+
+
+def _encode_vocabulary(vocabulary) -> EncodedWords:
+    """Return the encoded words of a TrieModule.Vocabulary, whose word ids are its row numbers."""
+    with _encoded_lock:
+        entry = _encoded.get(id(vocabulary))
+        if entry is not None and entry[0] is vocabulary:
+            _encoded.move_to_end(id(vocabulary))
+            return entry[1]
+
+        encoded = EncodedWords(vocabulary.words(list(range(len(vocabulary)))), letter_counts=True)
+        _encoded[id(vocabulary)] = (vocabulary, encoded)
+        while len(_encoded) > ENCODED_VOCABULARIES:
+            _encoded.popitem(last=False)
+        return encoded
+
+
+def _to_cutoff(max_edit: float) -> int:
+    if not max_edit < UNLIMITED_CUTOFF:
+        return UNLIMITED_CUTOFF
+    return math.floor(max_edit)
+
+
+def _encode(word: str) -> np.ndarray:
+    return np.frombuffer(word.encode(), dtype=np.uint8)
+
+
+@numba.njit(nogil=True, cache=True)
+def _edit_distance(a, m, b, n, cutoff, row):
+    """Levenshtein distance of a[:m] and b[:n], or cutoff + 1 once it is certainly above cutoff.
+
+    Only the cells within cutoff of the diagonal are computed; row is scratch
+    space of at least n + 1 cells.
+    """
+    if abs(m - n) > cutoff:
+        return cutoff + 1
+
+    inf = cutoff + 1
+    for j in range(n + 1):
+        row[j] = j if j <= cutoff else inf
+
+    for i in range(1, m + 1):
+        lo = max(1, i - cutoff)
+        hi = min(n, i + cutoff)
+        diag = row[lo - 1]
+        row[lo - 1] = i if lo == 1 and i <= cutoff else inf
+        row_min = row[lo - 1]
+
+        for j in range(lo, hi + 1):
+            up = row[j]
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(up + 1, row[j - 1] + 1, diag + cost, inf)
+            row[j] = value
+            diag = up
+            row_min = min(row_min, value)
+        if hi < n:
+            row[hi + 1] = inf
+
+        if row_min > cutoff:
+            return cutoff + 1
+
+    return min(row[n], inf)
+
+
+@numba.njit(nogil=True, cache=True)
+def _weighted_distance(a, m, b, n, substitution, transposition, cutoff, rows):
+    """The fused typo score of a[:m] and b[:n], or infinity once it is certainly above cutoff.
+
+    rows is scratch space of 3 rows of at least n + 1 cells.
+    """
+    if abs(m - n) > cutoff:
+        return np.inf
+
+    before_prev, prev, curr = 0, 1, 2
+    for j in range(n + 1):
+        rows[before_prev, j] = 0.0
+        rows[prev, j] = float(j)
+
+    for i in range(1, m + 1):
+        rows[curr, 0] = float(i)
+        row_min = rows[curr, 0]
+
+        for j in range(1, n + 1):
+            best = min(rows[prev, j] + 1.0, rows[curr, j - 1] + 1.0,
+                       rows[prev, j - 1] + substitution[a[i - 1], b[j - 1]])
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                best = min(best, rows[before_prev, j - 2] + transposition[a[i - 2], a[i - 1]])
+            rows[curr, j] = best
+            row_min = min(row_min, best)
+
+        if row_min > cutoff:
+            return np.inf
+        before_prev, prev, curr = prev, curr, before_prev
+
+    return np.inf if rows[prev, n] > cutoff else rows[prev, n]
+
+
+@numba.njit(nogil=True, cache=True)
+def _too_many_letters(word_counts, counts, row, budget):
+    """Whether the letters one word has more of than the other take more than budget edits."""
+    surplus = 0
+    deficit = 0
+    for letter in range(word_counts.shape[0]):
+        difference = word_counts[letter] - counts[row, letter]
+        if difference > 0:
+            surplus += difference
+        else:
+            deficit -= difference
+    return max(surplus, deficit) > budget
+
+
+@numba.njit(nogil=True, cache=True)
+def _compare_rows(word, word_counts, matrix, lengths, counts, filtered, rows, k, cutoff, distances, edits, keyboard):
+    """Fill edits (and keyboard, where the edit distance is within reach) for the given rows of matrix.
+
+    Rows that cannot be among the k best (k > 0) or within cutoff get an edit
+    distance above cutoff. Once k rows were scored, the k-th best edit
+    distance so far becomes the cutoff, and with filtered the letter counts
+    drop rows before their distance is computed.
+    """
+    m = word.shape[0]
+    scratch = np.empty(matrix.shape[1] + 1, dtype=np.int64)
+    best = np.full(max(k, 1), cutoff + 1, dtype=np.int64)
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        n = lengths[row]
+        bound = min(cutoff, best[k - 1]) if k > 0 else cutoff
+        edits[i] = cutoff + 1
+        if filtered and _too_many_letters(word_counts, counts, row, bound):
+            continue
+        edit = _edit_distance(word, m, matrix[row], n, bound, scratch)
+        if edit > bound:
+            continue
+
+        edits[i] = edit
+        # Keys that are not on the keyboard have a distance of 0 in the table
+        dist = 0.0
+        for j in range(min(m, n)):
+            dist += distances[word[j], matrix[row, j]]
+        dist += 2.0 * abs(float(n) - float(m))
+        keyboard[i] = dist
+
+        if k > 0 and edit < best[k - 1]:
+            position = k - 1
+            while position > 0 and best[position - 1] > edit:
+                best[position] = best[position - 1]
+                position -= 1
+            best[position] = edit
+
+
+@numba.njit(nogil=True, cache=True)
+def _rank_rows(word, word_counts, matrix, lengths, counts, filtered, rows, k, cutoff, substitution, transposition,
+               scores):
+    """Fill scores with the fused score of every given row of matrix, like _compare_rows (infinity when out of reach)."""
+    m = word.shape[0]
+    scratch = np.empty((3, matrix.shape[1] + 1), dtype=np.float64)
+    best = np.full(max(k, 1), np.inf)
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        bound = min(cutoff, best[k - 1]) if k > 0 else cutoff
+        scores[i] = np.inf
+        # A substitution can cost half an edit, so every letter counts for half as much
+        if filtered and _too_many_letters(word_counts, counts, row, 2.0 * bound):
+            continue
+        score = _weighted_distance(word, m, matrix[row], lengths[row], substitution, transposition, bound, scratch)
+        if score > bound:
+            continue
+
+        scores[i] = score
+        if k > 0 and score < best[k - 1]:
+            position = k - 1
+            while position > 0 and best[position - 1] > score:
+                best[position] = best[position - 1]
+                position -= 1
+            best[position] = score
+
+
+@numba.njit(nogil=True, cache=True)
+def _letter_counts_of(word):
+    counts = np.zeros(LETTERS, dtype=np.int64)
+    for letter in word:
+        if ord("a") <= letter <= ord("z"):
+            counts[letter - ord("a")] += 1
+    return counts
+
+
+def _scoring_inputs(input_word: str, words: EncodedWords) -> Tuple[np.ndarray, np.ndarray, np.ndarray, bool]:
+    """Return the encoded input word, its letter counts, the letter counts of words, and whether to filter by them."""
+    word = _encode(input_word)
+    if words.letter_counts is None:
+        return word, np.zeros(LETTERS, dtype=np.int64), np.zeros((0, LETTERS), dtype=np.int64), False
+    return word, _letter_counts_of(word), words.letter_counts, True
+
+
+def _compare(input_word: str, words: EncodedWords, rows: np.ndarray, keys: np.ndarray, k: int,
+             max_edit: float, layout: KeyboardLayout) -> List[Tuple[int, float, float]]:
+    """Return (index into rows, edit distance, keyboard distance) of the best rows, as MinDist orders them."""
+    cutoff = _to_cutoff(max_edit)
+    edits = np.empty(len(rows), dtype=np.int64)
+    keyboard = np.zeros(len(rows), dtype=np.float64)
+    word, word_counts, counts, filtered = _scoring_inputs(input_word, words)
+    _compare_rows(word, word_counts, words.matrix, words.lengths, counts, filtered, rows, k, cutoff,
+                  layout.distances, edits, keyboard)
+
+    kept = np.flatnonzero(edits <= cutoff)
+    if k > 0:
+        # Ordered by edit distance, then keyboard distance, then key
+        kept = kept[np.lexsort((keys[kept], keyboard[kept], edits[kept]))[:k]]
+    return list(zip(kept.tolist(), edits[kept].astype(np.float64).tolist(), keyboard[kept].tolist()))
+
+
+def _rank(input_word: str, words: EncodedWords, rows: np.ndarray, keys: np.ndarray, k: int,
+          max_score: float, layout: KeyboardLayout) -> List[Tuple[int, float]]:
+    """Return (index into rows, fused score) of the best rows, as MinDist orders them."""
+    scores = np.empty(len(rows), dtype=np.float64)
+    word, word_counts, counts, filtered = _scoring_inputs(input_word, words)
+    _rank_rows(word, word_counts, words.matrix, words.lengths, counts, filtered, rows, k, float(max_score),
+               layout.substitution, layout.transposition, scores)
+
+    kept = np.flatnonzero(scores <= max_score)
+    if k > 0:
+        kept = kept[np.lexsort((keys[kept], scores[kept]))[:k]]
+    return list(zip(kept.tolist(), scores[kept].tolist()))
+
+
+def _check_k(k: int) -> None:
+    if k < 0:
+        raise ValueError("k must not be negative.")
+
+
+def _check_windows(input_words: List[str], min_lengths: List[int], max_lengths: List[int]) -> None:
+    if len(min_lengths) != len(input_words) or len(max_lengths) != len(input_words):
+        raise ValueError("There must be one min_length and max_length per input word.")
+
+
+def _id_rows(vocabulary, ids: List[int]) -> np.ndarray:
+    rows = np.asarray(ids, dtype=np.int64)
+    if len(rows) and (rows.min() < 0 or rows.max() >= len(vocabulary)):
+        raise IndexError("word id out of range")
+    return rows
+
+
+def minDistance(word1: str, word2: str, max_edit: float = math.inf) -> float:
+    """Return the edit distance between two words, or max_edit + 1 once it is known to exceed max_edit."""
+    a, b = _encode(word1), _encode(word2)
+    cutoff = _to_cutoff(max_edit)
+    return float(_edit_distance(a, len(a), b, len(b), cutoff, np.empty(len(b) + 1, dtype=np.int64)))
+
+
+def weightedDistance(word1: str, word2: str, layout: str = "qwerty") -> float:
+    """Return the fused typo score between two words."""
+    a, b = _encode(word1), _encode(word2)
+    compiled = _get_layout(layout)
+    return _weighted_distance(a, len(a), b, len(b), compiled.substitution, compiled.transposition, math.inf,
+                              np.empty((3, len(b) + 1), dtype=np.float64))
+
+
+def compareWords(input_word: str, words: List[str], k: int = 0, max_edit: float = math.inf,
+                 layout: str = "qwerty") -> List[Tuple[str, float, float]]:
+    """Return the (word, edit distance, keyboard distance) of words, or of the k best of them when k > 0."""
+    return compareWordsBatch([input_word], [words], k, max_edit, layout)[0]
+
+
+def compareWordsBatch(input_words: List[str], word_lists: List[List[str]], k: int = 0,
+                      max_edit: float = math.inf, layout: str = "qwerty") -> List[List[Tuple[str, float, float]]]:
+    """compareWords for a batch of input words, each with its own list of words."""
+    _check_k(k)
+    if len(input_words) != len(word_lists):
+        raise ValueError("There must be one list of words per input word.")
+    keyboard = _get_layout(layout)
+
+    results = []
+    for input_word, words in zip(input_words, word_lists):
+        rows = np.arange(len(words), dtype=np.int64)
+        scored = _compare(input_word, EncodedWords(words), rows, rows, k, max_edit, keyboard)
+        results.append([(words[index], edit, dist) for index, edit, dist in scored])
+    return results
+
+
+def rankWords(input_word: str, words: List[str], k: int = 0, max_score: float = math.inf,
+              layout: str = "qwerty") -> List[Tuple[str, float]]:
+    """Return the (word, fused score) of words, or of the k lowest scores when k > 0."""
+    return rankWordsBatch([input_word], [words], k, max_score, layout)[0]
+
+
+def rankWordsBatch(input_words: List[str], word_lists: List[List[str]], k: int = 0,
+                   max_score: float = math.inf, layout: str = "qwerty") -> List[List[Tuple[str, float]]]:
+    """rankWords for a batch of input words, each with its own list of words."""
+    _check_k(k)
+    if len(input_words) != len(word_lists):
+        raise ValueError("There must be one list of words per input word.")
+    keyboard = _get_layout(layout)
+
+    results = []
+    for input_word, words in zip(input_words, word_lists):
+        rows = np.arange(len(words), dtype=np.int64)
+        ranked = _rank(input_word, EncodedWords(words), rows, rows, k, max_score, keyboard)
+        results.append([(words[index], score) for index, score in ranked])
+    return results
+
+
+def compareWordIdsBatch(input_words: List[str], vocabulary, id_lists: List[List[int]], k: int = 0,
+                        max_edit: float = math.inf, layout: str = "qwerty") -> List[List[Tuple[int, float, float]]]:
+    """compareWordsBatch for candidates given as word ids of a TrieModule.Vocabulary."""
+    _check_k(k)
+    if len(input_words) != len(id_lists):
+        raise ValueError("There must be one list of word ids per input word.")
+    keyboard = _get_layout(layout)
+    words = _encode_vocabulary(vocabulary)
+
+    results = []
+    for input_word, ids in zip(input_words, id_lists):
+        rows = _id_rows(vocabulary, ids)
+        # Ties keep the order of the list
+        scored = _compare(input_word, words, rows, np.arange(len(rows)), k, max_edit, keyboard)
+        results.append([(ids[index], edit, dist) for index, edit, dist in scored])
+    return results
+
+
+def rankWordIdsBatch(input_words: List[str], vocabulary, id_lists: List[List[int]], k: int = 0,
+                     max_score: float = math.inf, layout: str = "qwerty") -> List[List[Tuple[int, float]]]:
+    """rankWordsBatch for candidates given as word ids of a TrieModule.Vocabulary."""
+    _check_k(k)
+    if len(input_words) != len(id_lists):
+        raise ValueError("There must be one list of word ids per input word.")
+    keyboard = _get_layout(layout)
+    words = _encode_vocabulary(vocabulary)
+
+    results = []
+    for input_word, ids in zip(input_words, id_lists):
+        rows = _id_rows(vocabulary, ids)
+        ranked = _rank(input_word, words, rows, np.arange(len(rows)), k, max_score, keyboard)
+        results.append([(ids[index], score) for index, score in ranked])
+    return results
+
+
+def compareLengthWindowBatch(input_words: List[str], vocabulary, min_lengths: List[int], max_lengths: List[int],
+                             k: int = 0, max_edit: float = math.inf,
+                             layout: str = "qwerty") -> List[List[Tuple[int, float, float]]]:
+    """compareWordIdsBatch with every word of the vocabulary in a length window as the candidates."""
+    _check_k(k)
+    _check_windows(input_words, min_lengths, max_lengths)
+    keyboard = _get_layout(layout)
+    words = _encode_vocabulary(vocabulary)
+
+    results = []
+    for input_word, min_length, max_length in zip(input_words, min_lengths, max_lengths):
+        rows = words.window(min_length, max_length)
+        # Ties are broken by word id, i.e. alphabetically
+        scored = _compare(input_word, words, rows, rows, k, max_edit, keyboard)
+        results.append([(int(rows[index]), edit, dist) for index, edit, dist in scored])
+    return results
+
+
+def rankLengthWindowBatch(input_words: List[str], vocabulary, min_lengths: List[int], max_lengths: List[int],
+                          k: int = 0, max_score: float = math.inf,
+                          layout: str = "qwerty") -> List[List[Tuple[int, float]]]:
+    """rankWordIdsBatch with every word of the vocabulary in a length window as the candidates."""
+    _check_k(k)
+    _check_windows(input_words, min_lengths, max_lengths)
+    keyboard = _get_layout(layout)
+    words = _encode_vocabulary(vocabulary)
+
+    results = []
+    for input_word, min_length, max_length in zip(input_words, min_lengths, max_lengths):
+        rows = words.window(min_length, max_length)
+        ranked = _rank(input_word, words, rows, rows, k, max_score, keyboard)
+        results.append([(int(rows[index]), score) for index, score in ranked])
+    return results
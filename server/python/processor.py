@@ -1,38 +1,175 @@
+import os
 import sys
 import json
+import time
 import asyncio
-from typing import List, Dict, Set
-import aiohttp
-import re
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List, Dict, Set, Optional, TextIO, Tuple
 from pathlib import Path
 from dataclasses import dataclass
+from collections import Counter, OrderedDict
 import TrieModule
-import MinDist
-from bs4 import BeautifulSoup
+import SymSpell
+try:
+    import MinDist
+except ImportError:
+    # Without the C++ scoring extension, scoring_backend "auto" falls back to numba
+    MinDist = None
+from suggestion_cache import SuggestionCache
+from word_ingest import WordIngester
+from dictionary_log import DictionaryLog
+from metrics import Metrics, RequestTimer
+from shared_index import SharedIndex
+from worker_protocol import FrameWriter, read_frame
+from document_check import DocumentChecker, Misspelling
+from word_weights import read_weights
+from request_coalescing import SessionSequence, SingleFlight, Superseded
 
 @dataclass
 class ProcessorConfig:
     max_word_length: int = 44
     max_suggestions: int = 3
+    max_edit_distance: int = 5
     cache_file: str = "words.txt"
+    # Completions are ranked by weight (heaviest first), then length. Weights are read
+    # from weights_file ("word count" lines, optional) and grow by one every time a
+    # suggestion is accepted; accepted words are applied learn_batch_size at a time
+    weights_file: Optional[str] = "word_counts.txt"
+    learn_batch_size: int = 64
+    # Pages cache_file is built from when it is missing (None for the built-in sources).
+    # At most fetch_connections pages (fetch_connections_per_host per host) are fetched at
+    # once, optionally no more than fetch_rate_per_host a second, and parsed by
+    # parse_workers processes as they arrive. Raw pages are kept in page_cache_dir (None
+    # disables it) and only downloaded again when the server says they changed
+    source_urls: Optional[List[str]] = None
+    fetch_connections: int = 16
+    fetch_connections_per_host: int = 4
+    fetch_rate_per_host: Optional[float] = None
+    parse_workers: Optional[int] = None
+    page_cache_dir: Optional[str] = "page_cache"
+    # Binary snapshot of the trie built from cache_file. It is memory-mapped on start
+    # instead of rebuilding the trie, and rebuilt whenever cache_file changes
+    snapshot_file: str = "words.snapshot"
+    # Words added or removed at runtime are appended to this log rather than rewriting
+    # cache_file, and replayed on top of cache_file at startup
+    dictionary_log: str = "words.log"
+    # "trie" walks the trie for every correction, "symspell" precomputes a deletion
+    # index (more RAM, fewer visited words) for edit budgets up to symspell_distance, and
+    # "scan" scores every word in the length window after cheap letter and bigram
+    # filters have dropped the ones that cannot be close enough
+    correction_engine: str = "trie"
+    symspell_distance: int = 2
+    # Words without exact completions are first completed fuzzily: the completions of
+    # every prefix within fuzzy_prefix_distance edits of the word (a swap of two letters
+    # counting as one), closest prefix first, so "aplp" still suggests "apple" (0 turns
+    # it off). Words shorter than fuzzy_prefix_min_length, which are within reach of too
+    # many prefixes, and words without fuzzy completions are corrected as whole words
+    fuzzy_prefix_distance: int = 1
+    fuzzy_prefix_min_length: int = 4
+    # Layout used for keyboard distances unless a request asks for another one. Every
+    # <name>.txt file in layouts_dir (one row of keys per line) is loaded as layout <name>
+    keyboard_layout: str = "qwerty"
+    layouts_dir: str = "layouts"
+    # "classic" ranks corrections by edit distance, then keyboard distance; "fused" ranks
+    # them by a single keyboard-weighted score that also counts swapped letters as one edit
+    scoring: str = "classic"
+    # Candidates are scored by the MinDist extension ("native"), or by the same
+    # functions compiled with numba ("numba"); "auto" uses MinDist when it is built
+    scoring_backend: str = "auto"
+    # Suggestions of recently seen words are kept in an LRU cache of this many entries
+    # (0 disables it), each expiring after result_cache_ttl seconds if that is set
+    result_cache_size: int = 10000
+    result_cache_ttl: Optional[float] = None
+    # Requests with a session id reuse a trie cursor that follows the word as it is typed,
+    # keeping the words within session_edit_distance edits of it; the least recently used
+    # of more than max_sessions sessions is dropped
+    max_sessions: int = 1000
+    session_edit_distance: int = 2
+    # Every request is timed stage by stage ({"metrics": true} returns the histograms in
+    # the Prometheus text format); requests slower than slow_request_threshold seconds
+    # are counted, and slow_request_sample_rate of them are logged to stderr
+    slow_request_threshold: Optional[float] = None
+    slow_request_sample_rate: float = 1.0
+    # With --framed, requests are answered by this many threads at once (the native
+    # searches and scoring release the GIL), each reply as soon as it is ready
+    request_threads: int = 4
+    # Whole documents ({"text": ...}, or --check) are checked document_batch_size tokens
+    # at a time, and the corrections of the last document_remembered distinct
+    # misspellings are reused instead of being looked up again
+    document_batch_size: int = 1024
+    document_remembered: int = 10000
+    # A document can also be sent piece by piece ({"document": id, "text": piece}); the
+    # checkers of more than max_documents unfinished documents are dropped, oldest first
+    max_documents: int = 100
+
+CORRECTION_ENGINES = ("trie", "symspell", "scan")
+SCORING_MODES = ("classic", "fused")
+SCORING_BACKENDS = ("auto", "native", "numba")
+# Fields of a request that updates the dictionary: words to add, to remove, and accepted suggestions
+UPDATE_FIELDS = ("add", "remove", "accept")
+
+def load_scorer(backend: str):
+    """Return the module that scores candidates for the given scoring backend."""
+    if backend == "native" or (backend == "auto" and MinDist is not None):
+        if MinDist is None:
+            raise ImportError("The MinDist extension is not built; use scoring_backend \"numba\"")
+        return MinDist
+    import numba_scoring
+    return numba_scoring
 
 class WordProcessor:
     def __init__(self, config: ProcessorConfig = ProcessorConfig()):
-        self.trie: TrieModule.Trie = TrieModule.Trie()
-        self.words: List[str] = []
-        self.word_map_first: Dict[int, int] = {}
-        self.word_map_last: Dict[int, int] = {}
+        if config.correction_engine not in CORRECTION_ENGINES:
+            raise ValueError(f"Unknown correction engine: {config.correction_engine}")
+        if config.scoring not in SCORING_MODES:
+            raise ValueError(f"Unknown scoring mode: {config.scoring}")
+        if config.scoring_backend not in SCORING_BACKENDS:
+            raise ValueError(f"Unknown scoring backend: {config.scoring_backend}")
         self.config = config
+        # MinDist, or numba_scoring, which has the same functions
+        self.scorer = load_scorer(config.scoring_backend)
+        # The trie precomputes the best max_suggestions completions of every prefix
+        self.trie: TrieModule.Trie = TrieModule.Trie(config.max_suggestions)
+        # The trie's words; candidates are passed around as ids into it until they are ranked
+        self.vocabulary: TrieModule.Vocabulary = TrieModule.Vocabulary([])
+        self.deletion_index: Optional[SymSpell.DeletionIndex] = None
+        # Keyed on (word, layout); k, the engine and the scoring mode are fixed per processor
+        self.cache = SuggestionCache(config.result_cache_size, config.result_cache_ttl)
+        self.sessions: "OrderedDict[str, TrieModule.TrieCursor]" = OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self.documents: "OrderedDict[str, DocumentChecker]" = OrderedDict()
+        self._documents_lock = threading.Lock()
+        self.dictionary_log = DictionaryLog(config.dictionary_log)
+        # Every processor started on the same files maps the same snapshot, so the trie
+        # is built once and its memory is shared however many processors there are
+        self.index = SharedIndex(config.cache_file, config.snapshot_file, self.dictionary_log,
+                                 config.max_suggestions, config.weights_file)
+        # Accepted suggestions not applied to the weights yet
+        self.accepted: Counter = Counter()
+        self.metrics = Metrics(slow_threshold=config.slow_request_threshold,
+                               slow_sample_rate=config.slow_request_sample_rate)
+        for name in ("hits", "misses", "evictions", "expirations"):
+            self.metrics.collect(f"cache_{name}_total", "counter", f"Suggestion cache {name}.",
+                                 lambda name=name: getattr(self.cache, name))
+        self.metrics.collect("cache_entries", "gauge", "Suggestions in the cache.", lambda: len(self.cache))
+        # Concurrent requests for the same word share one lookup, and a session's request
+        # gives up before correcting once a newer keystroke of that session arrived
+        self.in_flight = SingleFlight()
+        self.session_sequence = SessionSequence(config.max_sessions)
+        self.metrics.collect("coalesced_requests_total", "counter",
+                             "Requests answered by the lookup of an identical one already running.",
+                             lambda: self.in_flight.coalesced)
+        self.metrics.collect("superseded_requests_total", "counter",
+                             "Session requests dropped because a newer one arrived.",
+                             lambda: self.session_sequence.superseded)
         self.responses: List[str] = []
 
-    async def fetch_words(self) -> Set[str]:
-        """Fetch words asynchronously from sources."""
-        async def fetch(url, session):
-            try:
-                async with session.get(url, timeout=10) as response:
-                    return await response.text()
-            except Exception as e:
-                return ""
+    def source_urls(self) -> List[str]:
+        """Return the pages the word list is built from."""
+        if self.config.source_urls is not None:
+            return list(self.config.source_urls)
 
         urls = []
 
@@ -50,94 +187,466 @@ class WordProcessor:
         urls.append('https://www.boldtuesday.com/pages/alphabetical-list-of-all-countries-and-capitals-shown-on-list-of-countries-poster?srsltid=AfmBOoqRuzPIeHdHqZWc7jQT7gBKHTtr9ncYJpDAVCr_Us8aKl47Ca3e')
         urls.append('https://www.thefreedictionary.com/A-very-long-list-of-adverbs,-not-all-of-which-end-in--ly.htm')
         urls.append('https://byjus.com/english/list-of-adverbs/')
+        return urls
+
+    async def fetch_words(self) -> Set[str]:
+        """Fetch words asynchronously from sources."""
+        ingester = WordIngester(self.config.fetch_connections, self.config.fetch_connections_per_host,
+                                self.config.fetch_rate_per_host, self.config.page_cache_dir,
+                                self.config.parse_workers)
+        return await ingester.ingest(self.source_urls())
+
+    def _build_trie(self, added: List[str], removed: List[str], accepted: Dict[str, int]) -> TrieModule.Trie:
+        """Build the trie of the word file plus the added words, leaving out the removed ones, with their weights."""
+        trie = TrieModule.Trie(self.config.max_suggestions)
+        weights = read_weights(self.config.weights_file)
+        with open(self.config.cache_file) as file:
+            # The first line is the number of pages the list was built from, not a word
+            file.readline()
+            for line in file:
+                word = line.strip().lower()
+                trie.insert(word, weights.get(word, 0))
+        for word in added:
+            trie.insert(word, weights.get(word, 0))
+        for word in removed:
+            trie.remove(word)
+        for word, count in accepted.items():
+            trie.learn(word, count)
+        trie.freeze()
+        return trie
+
+    def _use_trie(self, trie: TrieModule.Trie) -> None:
+        """Serve suggestions from trie from now on."""
+        vocabulary = trie.vocabulary()
+        deletion_index = None
+        if self.config.correction_engine == "symspell":
+            # Built per process: unlike the trie, it is not part of the shared snapshot
+            deletion_index = self._build_deletion_index(vocabulary)
 
+        self.trie, self.vocabulary, self.deletion_index = trie, vocabulary, deletion_index
+        # Cached suggestions and session cursors belong to the old version
+        self.cache.clear()
+        self.sessions.clear()
 
-        unique_words = set()
+    def _load_layouts(self) -> None:
+        """Compile the keyboard layout files so requests can pick them by name."""
+        layouts_dir = Path(self.config.layouts_dir)
+        if layouts_dir.is_dir():
+            for path in sorted(layouts_dir.glob("*.txt")):
+                self.scorer.loadLayout(path.stem, str(path))
 
+        if self.config.keyboard_layout not in self.scorer.layouts():
+            raise ValueError(f"Unknown keyboard layout: {self.config.keyboard_layout}")
 
-        async with aiohttp.ClientSession() as session:
-            responses = await asyncio.gather(*[fetch(url, session) for url in urls])
+    def _build_deletion_index(self, vocabulary: TrieModule.Vocabulary) -> SymSpell.DeletionIndex:
+        """Build the SymSpell deletion index and report what it cost."""
+        start = time.perf_counter()
+        deletion_index = SymSpell.DeletionIndex(self.config.symspell_distance)
+        # Built over the trie's vocabulary, so its ids are the trie's ids
+        deletion_index.build(vocabulary)
+        elapsed = time.perf_counter() - start
 
-        for response in responses:
-            # Parse the HTML content
-            soup = BeautifulSoup(response, 'html.parser')
-            # Extract text from the parsed HTML
-            text = soup.get_text()
-            # Find all words using regex
-            words = re.findall(r"\b[a-zA-Z']+\b", text.lower())
-            unique_words.update(words)
+        # stdout carries the responses, so the report goes to stderr
+        print(f"Built deletion index in {elapsed:.2f}s: {deletion_index.size()} entries, "
+              f"{deletion_index.memoryUsage() / 2**20:.1f} MiB", file=sys.stderr)
+        return deletion_index
 
-            #for response in responses:
-            #    unique_words.update(word_pattern.findall(response.lower()))
+    def update_words(self, added: List[str] = (), removed: List[str] = (),
+                     accepted: List[str] = ()) -> Dict[str, int]:
+        """Add and remove dictionary words, or learn from accepted suggestions, at runtime.
 
-        return unique_words
+        Returns how many words were added, removed and accepted, and how many there are now.
+        """
+        added = [word for word in (word.strip().lower() for word in added)
+                 if 0 < len(word) < self.config.max_word_length]
+        removed = [word.strip().lower() for word in removed]
+        accepted = [word for word in (word.strip().lower() for word in accepted)
+                    if 0 < len(word) < self.config.max_word_length]
+        self.accepted.update(accepted)
 
-    def _build_trie_and_maps(self) -> None:
-        """Build trie and word maps."""
-        current_length = 1
-        for i, word in enumerate(self.words):
-            self.trie.insert(word)
-            if len(word) > current_length:
-                self.word_map_last[current_length] = i
-                current_length = len(word)
-                self.word_map_first[current_length] = i
+        # Learning a handful of picks is not worth a rebuild (nor dropping the cached
+        # suggestions), so they wait for a batch or for the next real update
+        if added or removed or sum(self.accepted.values()) >= self.config.learn_batch_size:
+            # The change is logged, then the new version is built beside the current one
+            # (natively, with the GIL released) and published as the snapshot the other
+            # processors switch to; a removal wins over an add of the same word. The picks
+            # are only forgotten once they are in the trie; if the update fails they are
+            # tried again with the next one
+            learned = dict(self.accepted)
+            weights = read_weights(self.config.weights_file) if added else {}
+            trie = self.index.update(self.trie, added, removed, self._build_trie, learned,
+                                     {word: weights[word] for word in added if word in weights})
+            self.accepted.clear()
+            self._use_trie(trie)
+        return {"added": len(added), "removed": len(removed), "accepted": len(accepted), "size": self.trie.size()}
+
+    def refresh(self) -> None:
+        """Switch to the dictionary another processor published, if it changed (costs one stat call otherwise)."""
+        trie = self.index.refresh(self._build_trie)
+        if trie is not None:
+            self._use_trie(trie)
+
+    def _candidates_within(self, input_word: str, max_edit: int, min_length: int, max_length: int) -> List[int]:
+        """Return the ids of the dictionary words within max_edit edits of input_word."""
+        fused = self.config.scoring == "fused"
+        if self.deletion_index is not None and max_edit <= self.config.symspell_distance:
+            # The deletion index over-approximates, so verify its candidates by scoring them
+            candidates = self.deletion_index.lookupIds(input_word, max_edit, min_length, max_length)
+            if fused:
+                verified = self.scorer.rankWordIdsBatch([input_word], self.vocabulary, [candidates], max_score=max_edit)
+                return [word_id for word_id, _ in verified[0]]
+            verified = self.scorer.compareWordIdsBatch([input_word], self.vocabulary, [candidates], max_edit=max_edit)
+            return [word_id for word_id, _, _ in verified[0]]
+
+        # The fused score counts a swap of two letters as one edit, so the walk should too
+        return self.trie.fuzzySearchIds(input_word, max_edit, min_length, max_length, transpositions=fused)
+
+    def _length_window(self, input_word: str) -> Tuple[int, int]:
+        """Return the (min, max) length of the words considered as corrections."""
+        min_length = len(input_word)
+        if len(input_word) > 5:
+            min_length -= 2
+        return min_length, len(input_word) + 4
+
+    def _correction_candidates(self, input_word: str) -> List[int]:
+        """Find the dictionary words closest to input_word by walking the trie."""
+        min_length, max_length = self._length_window(input_word)
+
+        # Widen the edit budget one step at a time until there are enough candidates,
+        # so only the part of the trie close to the input word gets visited
+        candidates = []
+        for max_edit in range(1, self.config.max_edit_distance + 1):
+            candidates = self._candidates_within(input_word, max_edit, min_length, max_length)
+            if len(candidates) >= self.config.max_suggestions:
+                break
+        return candidates
+
+    def _correction_candidates_batch(self, input_words: List[str]) -> List[List[int]]:
+        """Find the correction candidates of several words, in one trie call when possible."""
+        if self.deletion_index is not None:
+            return [self._correction_candidates(word) for word in input_words]
+
+        windows = [self._length_window(word) for word in input_words]
+        return self.trie.closestWordIdsBatch(input_words, self.config.max_edit_distance,
+                                             [low for low, _ in windows], [high for _, high in windows],
+                                             self.config.max_suggestions,
+                                             transpositions=self.config.scoring == "fused")
 
     async def initialize(self):
         """Initialize processor and load words."""
         cache_path = Path(self.config.cache_file)
 
-        if cache_path.exists():
-            with open(cache_path, "r") as file:
-                self.words = [line.strip() for line in file]
-        else:
-            self.words = sorted(await self.fetch_words())
+        if not cache_path.exists():
+            words = sorted(await self.fetch_words())
             with open(self.config.cache_file, "w") as file:
-                file.writelines(f"{word}\n" for word in self.words)
+                file.write(f"{len(self.source_urls())}\n")
+                file.writelines(f"{word}\n" for word in words)
 
-        self.words = sorted([word.lower() for word in self.words], key=len)
-        self._build_trie_and_maps()
+        # Maps the snapshot of the word file with the dictionary log applied, which
+        # only the first processor to start after a change has to build
+        self._load_layouts()
+        self._use_trie(self.index.open(self._build_trie))
 
-    def process_word(self, input_word: str) -> List[str]:
-        """Process input word and return suggestions."""
-        try:
-            if not input_word or len(input_word) >= self.config.max_word_length:
-                return []
-
-            # Try autocomplete first
-            output = self.trie.search(input_word)
-            
-            # If no autocomplete results, try autocorrect
-            if not output and input_word not in self.words:
-                lower = len(input_word)
-                if (len(input_word) > 5):
-                    lower -= 2
-                lower_bound = self.word_map_first.get(lower, 0)
-                upper_bound = self.word_map_last.get(len(input_word) + 4, 0)
-                shorter_words = self.words[lower_bound:upper_bound + 1]
-                
-                # Fix: MinDist.compareWords should return [(word, distance, etc)]
-                output = MinDist.compareWords(input_word, shorter_words)
-                
-                # Ensure output is sorted and sliced correctly
-                if output:
-                    output.sort(key=lambda x: (x[1], x[2]))  # Sort by distance or other metric
-                    output = output[:self.config.max_suggestions]
-
-                if output and output[0][1] > 5.0:
-                    return []  # If all suggestions are bad, return empty list
-
-                return [word for word, _, _ in output]  # Ensure we are just returning words
-
-            return output[:self.config.max_suggestions]  # Ensure we return limited suggestions
+    def _rank_corrections(self, input_words: List[str], candidates: List[List[int]], layout: str) -> List[List[str]]:
+        """Score the candidate ids of every input word and return the best words of each."""
+        if self.config.scoring == "fused":
+            # rankWordIdsBatch returns the best [(word id, score)] per word, lowest score first
+            outputs = self.scorer.rankWordIdsBatch(input_words, self.vocabulary, candidates, self.config.max_suggestions,
+                                               self.config.max_edit_distance, layout)
+        else:
+            # compareWordIdsBatch returns the best [(word id, distance, etc)] per word, already
+            # sorted by edit distance, then keyboard distance
+            outputs = self.scorer.compareWordIdsBatch(input_words, self.vocabulary, candidates,
+                                                  self.config.max_suggestions, self.config.max_edit_distance, layout)
+
+        return self._best_corrections(outputs)
+
+    def _scan_corrections(self, input_words: List[str], layout: str) -> List[List[str]]:
+        """Score every word in the length window of each input word and return the best of each."""
+        windows = [self._length_window(word) for word in input_words]
+        min_lengths = [low for low, _ in windows]
+        max_lengths = [high for _, high in windows]
+        if self.config.scoring == "fused":
+            outputs = self.scorer.rankLengthWindowBatch(input_words, self.vocabulary, min_lengths, max_lengths,
+                                                    self.config.max_suggestions, self.config.max_edit_distance,
+                                                    layout)
+        else:
+            outputs = self.scorer.compareLengthWindowBatch(input_words, self.vocabulary, min_lengths, max_lengths,
+                                                       self.config.max_suggestions, self.config.max_edit_distance,
+                                                       layout)
+        return self._best_corrections(outputs)
+
+    def _corrections(self, input_words: List[str], layout: str, timer: RequestTimer) -> List[List[str]]:
+        """Return the best corrections of several misspelled words with the configured engine."""
+        if self.config.correction_engine == "scan":
+            corrections = self._scan_corrections(input_words, layout)
+            timer.lap("scan")
+            return corrections
+
+        visited = TrieModule.nodesVisited()
+        candidates = self._correction_candidates_batch(input_words)
+        timer.lap("candidates")
+        timer.count("trie_nodes_visited", TrieModule.nodesVisited() - visited)
+        timer.count("candidates_scored", sum(len(ids) for ids in candidates))
+        corrections = self._rank_corrections(input_words, candidates, layout)
+        timer.lap("score")
+        return corrections
+
+    def _fuzzy_completions(self, input_words: List[str]) -> List[List[str]]:
+        """Return the completions of the prefixes close to each input word, or nothing for the ones that are too short."""
+        eligible = [word for word in input_words if len(word) >= self.config.fuzzy_prefix_min_length]
+        if self.config.fuzzy_prefix_distance <= 0 or not eligible:
+            return [[] for _ in input_words]
+        completions = dict(zip(eligible, self.trie.fuzzyCompleteBatch(eligible, self.config.fuzzy_prefix_distance,
+                                                                      self.config.max_suggestions,
+                                                                      transpositions=True)))
+        return [completions.get(word, []) for word in input_words]
+
+    def _best_corrections(self, outputs: list) -> List[List[str]]:
+        """Turn the [(word id, distance, ...)] of every input word into its suggestions."""
+        corrections = []
+        for output in outputs:
+            if output and output[0][1] > self.config.max_edit_distance:
+                corrections.append([])  # If all suggestions are bad, return an empty list
+            else:
+                # Only the few suggestions that are returned become strings
+                corrections.append(self.vocabulary.words([suggestion[0] for suggestion in output]))
+        return corrections
+
+    def _session_cursor(self, session: str) -> TrieModule.TrieCursor:
+        """Return the trie cursor of a typing session, starting one if needed."""
+        cursor = self.sessions.get(session)
+        if cursor is None:
+            cursor = TrieModule.TrieCursor(self.trie, self.config.session_edit_distance)
+            self.sessions[session] = cursor
+            if len(self.sessions) > self.config.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session)
+        return cursor
+
+    def _process_session_word(self, input_word: str, layout: str, session: str, ticket: int) -> List[str]:
+        """Process the word a session is typing, moving its cursor instead of starting from the root.
+
+        Raises Superseded, before any correction is computed, if a newer request
+        of the session arrived after the one holding ticket.
+        """
+        if not input_word or len(input_word) >= self.config.max_word_length:
+            return []
+
+        timer = self.metrics.timer("session")
+        cached = self.cache.get((input_word, layout))
+        timer.lap("cache")
+        if cached is not None:
+            timer.finish(input_word)
+            return cached
+        self.session_sequence.check(session, ticket)
+
+        # Usually the word only gained or lost a character since the last request. Requests
+        # may be served by several threads, and a cursor can only follow one of them at a time
+        candidates = None
+        with self._sessions_lock:
+            cursor = self._session_cursor(session)
+            visited = TrieModule.nodesVisited()
+            cursor.moveTo(input_word)
+
+            output = cursor.completions()[:self.config.max_suggestions]
+            timer.lap("complete")
+            if not output and self.config.correction_engine == "trie" and self.config.scoring == "classic":
+                min_length, max_length = self._length_window(input_word)
+                candidates = cursor.closestWordIds(self.config.max_edit_distance, min_length, max_length,
+                                                   self.config.max_suggestions)
+                timer.lap("candidates")
+            timer.count("trie_nodes_visited", TrieModule.nodesVisited() - visited)
+
+        if not output:
+            visited = TrieModule.nodesVisited()
+            output = self._fuzzy_completions([input_word])[0]
+            timer.lap("fuzzy_complete")
+            timer.count("trie_nodes_visited", TrieModule.nodesVisited() - visited)
+
+        if not output:
+            # Correcting is the expensive part, and nobody is waiting for a stale keystroke's suggestions
+            self.session_sequence.check(session, ticket)
+            if candidates is not None:
+                timer.count("candidates_scored", len(candidates))
+                output = self._rank_corrections([input_word], [candidates], layout)[0]
+                timer.lap("score")
+            else:
+                # The cursor counts no transpositions and only knows the trie walk
+                output = self._corrections([input_word], layout, timer)[0]
+
+        self.cache.put((input_word, layout), output)
+        timer.finish(input_word)
+        return output
+
+    def process_words(self, input_words: List[str], layout: Optional[str] = None) -> List[List[str]]:
+        """Process several input words at once and return their suggestions in input order."""
+        layout = layout or self.config.keyboard_layout
+        timer = self.metrics.timer("words")
 
+        # Each distinct word is looked up once, however often it was sent, and not
+        # at all if its suggestions are still cached
+        results: Dict[str, List[str]] = dict.fromkeys(input_words, [])
+        unique = []
+        for word in dict.fromkeys(input_words):
+            if not word or len(word) >= self.config.max_word_length:
+                continue
+            cached = self.cache.get((word, layout))
+            if cached is None:
+                unique.append(word)
+            else:
+                results[word] = cached
+        timer.lap("cache")
+
+        # Try autocomplete first
+        for word, completions in zip(unique, self.trie.searchBatch(unique)):
+            results[word] = completions[:self.config.max_suggestions]
+        timer.lap("complete")
+
+        # Every dictionary word completes to at least itself, so words without
+        # completions are misspelled: they may still be the start of a word with a typo
+        # in it, and the ones that are not are autocorrected
+        misspelled = [word for word in unique if not results[word]]
+        if misspelled:
+            visited = TrieModule.nodesVisited()
+            for word, completions in zip(misspelled, self._fuzzy_completions(misspelled)):
+                results[word] = completions
+            timer.lap("fuzzy_complete")
+            timer.count("trie_nodes_visited", TrieModule.nodesVisited() - visited)
+            misspelled = [word for word in misspelled if not results[word]]
+        if misspelled:
+            for word, corrections in zip(misspelled, self._corrections(misspelled, layout, timer)):
+                results[word] = corrections
+
+        for word in unique:
+            self.cache.put((word, layout), results[word])
+        timer.finish(" ".join(input_words) if len(input_words) <= 8 else f"{len(input_words)} words")
+        return [results[word] for word in input_words]
+
+    def _correct_document_words(self, words: List[str], layout: str) -> List[List[str]]:
+        """Correct one batch of the misspelled words of a document."""
+        timer = self.metrics.timer("document")
+        corrections = self._corrections(words, layout, timer)
+        timer.finish(f"{len(words)} words")
+        return corrections
+
+    def document_checker(self, layout: Optional[str] = None) -> DocumentChecker:
+        """Return a checker for one document, fed piece by piece, that scores corrections on the given layout."""
+        layout = layout or self.config.keyboard_layout
+        # Looked up on every batch, so a document spanning a dictionary update uses the new words
+        return DocumentChecker(lambda words: self.vocabulary.containsBatch(words),
+                               lambda words: self._correct_document_words(words, layout),
+                               self.config.document_batch_size, self.config.document_remembered,
+                               self.config.max_word_length)
+
+    def check_document(self, text: str, layout: Optional[str] = None) -> List[Misspelling]:
+        """Return the misspelled words of text, with their offsets and suggestions, in document order."""
+        return list(self.document_checker(layout).check([text]))
+
+    def check_document_piece(self, document: str, piece: str, layout: Optional[str] = None,
+                             start: bool = False, end: bool = False) -> List[Misspelling]:
+        """Feed the next piece of a document sent piece by piece, and return the misspellings found so far.
+
+        The first piece has start set and the last one end. Pieces of one
+        document must be sent one at a time, each after the previous reply.
+        """
+        with self._documents_lock:
+            if start:
+                checker = self.documents[document] = self.document_checker(layout)
+                if len(self.documents) > self.config.max_documents:
+                    self.documents.popitem(last=False)
+            elif document in self.documents:
+                checker = self.documents[document]
+                self.documents.move_to_end(document)
+            else:
+                raise LookupError(f"Unknown document {document}; it was finished, dropped or never started")
+            if end:
+                del self.documents[document]
+
+        found = checker.feed(piece) if piece else []
+        if end:
+            found += checker.finish()
+        return found
+
+    def process_word(self, input_word: str, layout: Optional[str] = None, session: Optional[str] = None,
+                     ticket: Optional[int] = None) -> List[str]:
+        """Process input word and return suggestions, scoring keys on the given layout.
+
+        A session's requests are numbered as they arrive (ticket, if the caller
+        took one from session_sequence when the request came in), and one that
+        was overtaken by a newer request of its session raises Superseded.
+        """
+        layout = layout or self.config.keyboard_layout
+        if session is not None and ticket is None:
+            ticket = self.session_sequence.arrive(session)
+        try:
+            # The suggestions of a word are the same whoever asks, so a session can
+            # share them too; its cursor just catches up on its next keystroke
+            if session is not None:
+                return self.in_flight.do((input_word, layout),
+                                         lambda: self._process_session_word(input_word, layout, session, ticket))
+            return self.in_flight.do((input_word, layout), lambda: self.process_words([input_word], layout)[0])
+        except Superseded:
+            raise
         except Exception as e:
             print(f"Error processing word: {e}")
             return []
 
-async def main():
-    processor = WordProcessor()
-    await processor.initialize()
+def is_update(request: dict) -> bool:
+    """Whether request changes the dictionary (or its weights)."""
+    return any(field in request for field in UPDATE_FIELDS)
+
+def handle_request(processor: WordProcessor, request: dict, ticket: Optional[int] = None):
+    """Answer one request and return the data of the reply (ticket numbers a session's request, see process_word)."""
+    if request.get("cache_stats"):
+        return processor.cache.stats()
+    if request.get("metrics"):
+        return processor.metrics.render()
+    if is_update(request):
+        return processor.update_words(request.get("add", []), request.get("remove", []), request.get("accept", []))
+    # Not every path scores keys (a completed word never does), so check before any of them
+    layout = request.get("layout")
+    if layout is not None and layout not in processor.scorer.layouts():
+        raise ValueError(f"Unknown keyboard layout: {layout}")
+    if "words" in request:
+        return processor.process_words(request["words"], request.get("layout"))
+    if "document" in request:
+        return processor.check_document_piece(request["document"], request.get("text", ""), request.get("layout"),
+                                              request.get("start", False), request.get("end", False))
+    if "text" in request:
+        return processor.check_document(request["text"], request.get("layout"))
+    return processor.process_word(request.get("word", ""), request.get("layout"), request.get("session"), ticket)
+
+def health(processor: WordProcessor, started: float, in_flight: int) -> Dict[str, object]:
+    """Return what a health check reports about this processor."""
+    return {"status": "ok", "words": processor.trie.size(), "in_flight": in_flight,
+            "uptime": time.monotonic() - started}
+
+def check_stream(processor: WordProcessor, source: TextIO, layout: Optional[str] = None,
+                 chunk_size: int = 2**16) -> None:
+    """Write the misspelled words of the document read from source to stdout, one JSON object per line.
+
+    Each piece of chunk_size characters is checked as soon as it is read,
+    and the misspellings found are written right away.
+    """
+    start = time.perf_counter()
+    checker = processor.document_checker(layout)
+    while True:
+        piece = source.read(chunk_size)
+        found = checker.feed(piece) if piece else checker.finish()
+        if found:
+            sys.stdout.write("".join(json.dumps(misspelling) + "\n" for misspelling in found))
+            sys.stdout.flush()
+        if not piece:
+            break
+
+    elapsed = time.perf_counter() - start
+    print(f"Checked {checker.tokens} tokens in {elapsed:.2f}s ({checker.tokens / max(elapsed, 1e-9):,.0f} tokens/s), "
+          f"{checker.misspellings} misspelled", file=sys.stderr)
 
+def serve_lines(processor: WordProcessor) -> None:
+    """Answer one JSON request per line of stdin with one JSON line on stdout, in order."""
+    started = time.monotonic()
     while True:
         data = sys.stdin.readline()
         if not data:
@@ -145,14 +654,123 @@ async def main():
 
         try:
             request = json.loads(data)
-            word = request.get("word", "")
-            response = processor.process_word(word)
+            processor.refresh()
+            if request.get("health"):
+                response = health(processor, started, 0)
+            else:
+                response = handle_request(processor, request)
             print(json.dumps({"data": response}))
         except Exception as e:
             print(f"Error handling request: {e}")
         
         sys.stdout.flush()
 
+def serve_framed(processor: WordProcessor, threads: int) -> None:
+    """Answer length-prefixed JSON requests from stdin on a thread pool, replying out of order.
+
+    Every request carries an "id" that its reply repeats. A {"ready": true}
+    message is sent once the dictionary is loaded, and {"health": true} is
+    answered right away by the reading thread. A request that cannot be
+    answered as asked (an unknown layout) gets an "error" with "invalid": true. Dictionary changes (ours or
+    another processor's) wait for the requests in flight and are applied before
+    any later request starts, so a request never sees two versions of the trie.
+    A session's request that is still queued when a newer one of the same
+    session arrives is answered right away with {"superseded": true} and no
+    suggestions, as is one that was overtaken while it ran.
+    """
+    started = time.monotonic()
+    writer = FrameWriter(sys.stdout.buffer)
+    # stdout only carries frames from here on; anything else printed goes to stderr
+    sys.stdout = sys.stderr
+
+    def reply(request_id, request: dict, ticket: Optional[int] = None) -> None:
+        try:
+            writer.write({"id": request_id, "data": handle_request(processor, request, ticket)})
+        except Superseded:
+            writer.write({"id": request_id, "data": [], "superseded": True})
+        except ValueError as e:
+            # The request itself was wrong (an unknown layout), not the processor
+            writer.write({"id": request_id, "error": str(e), "invalid": True})
+        except Exception as e:
+            writer.write({"id": request_id, "error": str(e)})
+
+    writer.write({"ready": True, "pid": os.getpid(), "words": processor.trie.size()})
+    in_flight: List[Future] = []
+    # The latest queued request of every session, cancelled when the next one comes in
+    queued: Dict[str, Tuple[object, Future]] = {}
+    with ThreadPoolExecutor(threads) as pool:
+        while True:
+            try:
+                request = read_frame(sys.stdin.buffer)
+            except ValueError as e:
+                # The stream cannot be resynchronized after a bad frame
+                print(f"Error reading request: {e}", file=sys.stderr)
+                break
+            if request is None:
+                break
+
+            request_id = request.pop("id", None)
+            in_flight = [future for future in in_flight if not future.done()]
+            if request.get("health"):
+                writer.write({"id": request_id, "data": health(processor, started, len(in_flight))})
+                continue
+
+            update = is_update(request)
+            if update or processor.index.changed():
+                wait(in_flight)
+                in_flight = []
+                try:
+                    processor.refresh()
+                except Exception as e:
+                    print(f"Could not refresh the dictionary: {e}", file=sys.stderr)
+            if update:
+                reply(request_id, request)
+                continue
+
+            session = request.get("session")
+            if session is None:
+                in_flight.append(pool.submit(reply, request_id, request))
+                continue
+            ticket = processor.session_sequence.arrive(session)
+            previous = queued.get(session)
+            if previous is not None and previous[1].cancel():
+                processor.session_sequence.count_superseded()
+                writer.write({"id": previous[0], "data": [], "superseded": True})
+            future = pool.submit(reply, request_id, request, ticket)
+            in_flight.append(future)
+            queued = {key: entry for key, entry in queued.items() if not entry[1].done()}
+            queued[session] = (request_id, future)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Serve autocomplete and autocorrect suggestions over stdin/stdout.")
+    parser.add_argument("--framed", action="store_true",
+                        help="speak the length-prefixed protocol of server.ts instead of one JSON object per line")
+    parser.add_argument("--threads", type=int, help="threads answering framed requests")
+    parser.add_argument("--check", nargs="?", const="-", metavar="FILE",
+                        help="write the misspelled words of FILE (or stdin) as JSON lines, then exit")
+    parser.add_argument("--layout", help="keyboard layout corrections are scored on")
+    parser.add_argument("--scoring-backend", choices=SCORING_BACKENDS, default="auto",
+                        help="score candidates with the MinDist extension or with numba")
+    args = parser.parse_args()
+
+    config = ProcessorConfig(scoring_backend=args.scoring_backend)
+    if args.threads is not None:
+        if args.threads < 1:
+            parser.error("--threads must be positive")
+        config.request_threads = args.threads
+    processor = WordProcessor(config)
+    await processor.initialize()
+
+    if args.check is not None:
+        if args.check == "-":
+            check_stream(processor, sys.stdin, args.layout)
+        else:
+            with open(args.check, encoding="utf-8", errors="replace") as source:
+                check_stream(processor, source, args.layout)
+    elif args.framed:
+        serve_framed(processor, config.request_threads)
+    else:
+        serve_lines(processor)
+
 if __name__ == "__main__":
     asyncio.run(main())
-
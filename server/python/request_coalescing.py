@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class Superseded(Exception):
+    """Raised by a request that a newer request of the same session made pointless."""
+
+
+class SingleFlight:
+    """Runs one computation per key at a time, sharing its result with every caller that asks meanwhile.
+
+    The first caller of a key computes it, and callers arriving while it runs
+    wait for the same result (or exception) instead of repeating the work.
+    Nothing is remembered once the computation is over; that is the job of
+    the suggestion cache. A computation given up with Superseded is only the
+    first caller's business, so the next waiting caller computes the key
+    itself instead of failing too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running: Dict[Hashable, Future] = {}
+        self.computed = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, compute: Callable[[], T]) -> T:
+        """Return compute(), or the result of the computation of key that is already running."""
+        while True:
+            with self._lock:
+                running = self._running.get(key)
+                if running is None:
+                    future = self._running[key] = Future()
+                    self.computed += 1
+                else:
+                    self.coalesced += 1
+
+            if running is None:
+                return self._lead(key, future, compute)
+            try:
+                return running.result()
+            except Superseded:
+                continue
+
+    def _lead(self, key: Hashable, future: Future, compute: Callable[[], T]) -> T:
+        try:
+            result = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._running[key]
+
+
+class SessionSequence:
+    """Numbers the requests of every session in arrival order, to tell whether one is still the latest.
+
+    A typing session sends a request per keystroke, and only the last one's
+    suggestions get shown, so a request can give up before its expensive
+    stages once a newer one arrived. The max_sessions most recently active
+    sessions are tracked; a forgotten session's requests count as current.
+    """
+
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._latest: "OrderedDict[str, int]" = OrderedDict()
+        self.superseded = 0
+
+    def arrive(self, session: str) -> int:
+        """Register a new request of session and return its ticket."""
+        with self._lock:
+            ticket = self._latest.get(session, 0) + 1
+            self._latest[session] = ticket
+            self._latest.move_to_end(session)
+            if len(self._latest) > self.max_sessions:
+                self._latest.popitem(last=False)
+            return ticket
+
+    def is_latest(self, session: str, ticket: int) -> bool:
+        with self._lock:
+            return self._latest.get(session, ticket) == ticket
+
+    def check(self, session: str, ticket: int) -> None:
+        """Raise Superseded if a newer request of session arrived after the one holding ticket."""
+        if not self.is_latest(session, ticket):
+            self.count_superseded()
+            raise Superseded(f"A newer request of session {session} arrived")
+
+    def count_superseded(self) -> None:
+        """Count a request dropped for a newer one without ever running (see check)."""
+        with self._lock:
+            self.superseded += 1
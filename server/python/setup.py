@@ -5,11 +5,19 @@ ext_modules = [
     Pybind11Extension(
         "TrieModule",
         ["bindings/TrieModule.cpp"],
+        depends=["bindings/Vocabulary.h"],
         cxx_std=17
     ),
     Pybind11Extension(
         "MinDist",
         ["bindings/MinDist.cpp"],
+        depends=["bindings/Vocabulary.h"],
+        cxx_std=17
+    ),
+    Pybind11Extension(
+        "SymSpell",
+        ["bindings/SymSpell.cpp"],
+        depends=["bindings/Vocabulary.h"],
         cxx_std=17
     ),
 ]
@@ -18,7 +26,7 @@ setup(
     name="fastwordprocessor",
     version="0.1.0",
     author="Atharva Kerkar",
-    description="Fast Trie and MinDist Python bindings using pybind11",
+    description="Fast Trie, MinDist and SymSpell Python bindings using pybind11",
     ext_modules=ext_modules,
     cmdclass={"build_ext": build_ext},
     zip_safe=False,
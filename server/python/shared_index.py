@@ -0,0 +1,137 @@
+import os
+import sys
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import TrieModule
+from dictionary_log import DictionaryLog
+
+# Builds the frozen trie of the word file with the (added, removed, accepted) words of the log applied
+TrieBuilder = Callable[[List[str], List[str], Dict[str, int]], TrieModule.Trie]
+
+
+class SharedIndex:
+    """One trie for every process serving the same word file, shared through a memory-mapped snapshot.
+
+    The first process to open the index builds the trie and saves it as a
+    snapshot, and every process (the builder included) then serves the
+    mapped file. The pages of a mapped file are shared, so more workers do
+    not need more copies of the trie. Building and updating take an
+    exclusive lock on <snapshot>.lock, so the trie is built once however many
+    workers start at the same time. A dictionary update is published as a new
+    snapshot; the other processes see the log change and map that snapshot.
+    The word weights are part of the trie, so a change to weights_file
+    rebuilds it too.
+    """
+
+    def __init__(self, word_file: str, snapshot_file: str, dictionary_log: DictionaryLog, k: int,
+                 weights_file: Optional[str] = None):
+        self.word_file = Path(word_file)
+        self.weights_file = Path(weights_file) if weights_file is not None else None
+        self.snapshot_file = Path(snapshot_file)
+        self.lock_file = Path(f"{snapshot_file}.lock")
+        self.dictionary_log = dictionary_log
+        self.k = k
+        # (size, mtime, inode) of the log the current trie was opened with
+        self._log_state: Optional[Tuple[int, int, int]] = None
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _current_log_state(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            info = os.stat(self.dictionary_log.path)
+        except FileNotFoundError:
+            return None
+        return info.st_size, info.st_mtime_ns, info.st_ino
+
+    def source_stamp(self) -> int:
+        """Identify the word file with the dictionary log applied, which is what the snapshot stands for."""
+        stamp = hashlib.blake2b(self.word_file.read_bytes(), digest_size=8)
+        stamp.update(self.dictionary_log.read_bytes())
+        if self.weights_file is not None and self.weights_file.is_file():
+            stamp.update(self.weights_file.read_bytes())
+        return int.from_bytes(stamp.digest(), "little")
+
+    def _load(self, source_stamp: int) -> Optional[TrieModule.Trie]:
+        """Map the snapshot if it is the trie of source_stamp."""
+        try:
+            trie = TrieModule.Trie.load(str(self.snapshot_file))
+        except RuntimeError:
+            # Missing, unreadable or written by another version, so it just gets rebuilt
+            return None
+        if trie.getSourceStamp() != source_stamp or trie.getK() != self.k:
+            return None
+        return trie
+
+    def _publish(self, trie: TrieModule.Trie, source_stamp: int) -> TrieModule.Trie:
+        """Save trie as the snapshot and return the mapped copy, or trie itself if it could not be saved."""
+        try:
+            trie.save(str(self.snapshot_file), source_stamp)
+        except RuntimeError as e:
+            print(f"Could not save snapshot: {e}", file=sys.stderr)
+            return trie
+        # Serving the mapped file instead of the freshly built arrays lets this
+        # process share its pages with the others too
+        return self._load(source_stamp) or trie
+
+    def _open_locked(self, build: TrieBuilder) -> TrieModule.Trie:
+        log_state = self._current_log_state()
+        source_stamp = self.source_stamp()
+        trie = self._load(source_stamp)
+        if trie is None:
+            added, removed, accepted = self.dictionary_log.replay()
+            trie = self._publish(build(added, removed, accepted), source_stamp)
+        self._log_state = log_state
+        return trie
+
+    def open(self, build: TrieBuilder) -> TrieModule.Trie:
+        """Return the trie of the current word file and log, building and saving it unless another process has."""
+        with self._locked():
+            return self._open_locked(build)
+
+    def changed(self) -> bool:
+        """Whether the dictionary log changed since this process opened the trie (a single stat call)."""
+        return self._current_log_state() != self._log_state
+
+    def refresh(self, build: TrieBuilder) -> Optional[TrieModule.Trie]:
+        """Return the current trie if another process updated the dictionary since this one opened it, else None."""
+        if not self.changed():
+            return None
+        return self.open(build)
+
+    def update(self, trie: TrieModule.Trie, added: List[str], removed: List[str],
+               build: TrieBuilder, accepted: Optional[Dict[str, int]] = None,
+               weights: Optional[Dict[str, int]] = None) -> TrieModule.Trie:
+        """Log and apply a dictionary update to trie, publish the result to the other processes and return it.
+
+        accepted maps picked suggestions to how often they were picked, which
+        is added to their weights; weights holds the weights of the added
+        words from the weights file, as a rebuild would give them.
+
+        trie keeps answering while the new one is built. If another process
+        updated the dictionary meanwhile, its update is picked up first, so
+        no update is lost.
+        """
+        with self._locked():
+            if self.changed():
+                trie = self._open_locked(build)
+            # Logged first, so a change that was answered survives a crash
+            if added:
+                self.dictionary_log.append("add", added)
+            if removed:
+                self.dictionary_log.append("remove", removed)
+            if accepted:
+                self.dictionary_log.append("accept", [word for word, count in accepted.items()
+                                                      for _ in range(count)])
+            updated = self._publish(trie.withChanges(added, removed, accepted or {}, weights or {}), self.source_stamp())
+            self._log_state = self._current_log_state()
+            return updated
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+
+class SuggestionCache:
+    """A bounded LRU cache of suggestion lists, with an optional time to live."""
+
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = None):
+        if max_size < 0:
+            raise ValueError("max_size must not be negative")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("ttl must be positive")
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (time stored, suggestions), least recently used first
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # Routes may run on several threads, and a lookup reorders the entries
+        self._lock = threading.Lock()
+        # Bumped by clear(), so results computed before it can be told apart
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[List[str]]:
+        """Return the cached suggestions for key, or None if there are none (or they expired)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key: Hashable, suggestions: List[str], generation: Optional[int] = None) -> None:
+        """Cache suggestions under key, evicting the least recently used entries when full.
+
+        With a generation, the suggestions are dropped if the cache has been cleared
+        since that generation was read (they were computed from the old data).
+        """
+        if self.max_size == 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic(), tuple(suggestions))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop every entry, e.g. because the dictionary changed. The counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Return the counters, along with the current size and the hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
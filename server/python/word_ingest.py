@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import json
+import re
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+from bs4 import BeautifulSoup
+
+WORD_PATTERN = re.compile(r"\b[a-zA-Z']+\b")
+LOWERCASE_WORD_PATTERN = re.compile(r"\b[a-z]+\b")
+
+
+def html_words(page: str) -> Set[str]:
+    """Return the words in the visible text of an HTML page, lowercased."""
+    text = BeautifulSoup(page, "html.parser").get_text()
+    return set(WORD_PATTERN.findall(text.lower()))
+
+
+def raw_words(page: str) -> Set[str]:
+    """Return the runs of letters anywhere in a page, markup included, lowercased."""
+    return set(LOWERCASE_WORD_PATTERN.findall(page.lower()))
+
+
+class PageCache:
+    """Raw pages on disk, keyed by URL, with the validators needed to re-fetch them conditionally."""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, url: str) -> Tuple[Path, Path]:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return self.directory / f"{key}.html", self.directory / f"{key}.json"
+
+    def get(self, url: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """Return the cached (page, validators) of url, or None if it was never stored."""
+        page_path, meta_path = self._paths(url)
+        try:
+            meta = json.loads(meta_path.read_text())
+            return page_path.read_text(), meta.get("validators", {})
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url: str, page: str, validators: Dict[str, str]) -> None:
+        """Store page and its validators, replacing both files atomically."""
+        page_path, meta_path = self._paths(url)
+        for path, content in ((page_path, page), (meta_path, json.dumps({"url": url, "validators": validators}))):
+            temporary = path.with_suffix(path.suffix + ".tmp")
+            temporary.write_text(content)
+            temporary.replace(path)
+
+
+class WordIngester:
+    """Fetches the source pages with bounded concurrency and tokenizes them in a process pool.
+
+    A fixed number of fetchers take URLs off one queue, so no more than
+    max_connections pages are held at a time, however many URLs there are. Each
+    page goes to the pool as soon as it arrives and its words are merged into the
+    result right away. Requests to one host are spaced by 1 / per_host_rate
+    seconds. With a page cache, pages are re-fetched with If-None-Match /
+    If-Modified-Since, and a cached page stands in for one that cannot be fetched.
+    """
+
+    def __init__(self, max_connections: int = 16, per_host_connections: int = 4,
+                 per_host_rate: Optional[float] = None, cache_dir: Optional[str] = None,
+                 workers: Optional[int] = None, timeout: float = 10,
+                 tokenizer: Callable[[str], Set[str]] = html_words):
+        if max_connections < 1 or per_host_connections < 1:
+            raise ValueError("max_connections and per_host_connections must be positive")
+        if per_host_rate is not None and per_host_rate <= 0:
+            raise ValueError("per_host_rate must be positive")
+        self.max_connections = max_connections
+        self.per_host_connections = per_host_connections
+        self.per_host_rate = per_host_rate
+        self.cache = PageCache(cache_dir) if cache_dir else None
+        self.workers = workers
+        self.timeout = timeout
+        # Runs in the worker processes, so it must be a module level function
+        self.tokenizer = tokenizer
+        # host -> (lock, time of the last request to it)
+        self._hosts: Dict[str, list] = {}
+        self.stats: Dict[str, int] = {}
+
+    async def _wait_for_host(self, url: str) -> None:
+        """Space the requests to the host of url by 1 / per_host_rate seconds."""
+        if self.per_host_rate is None:
+            return
+        host = urlsplit(url).netloc
+        slot = self._hosts.setdefault(host, [asyncio.Lock(), 0.0])
+        async with slot[0]:
+            delay = slot[1] + 1 / self.per_host_rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            slot[1] = time.monotonic()
+
+    async def _fetch(self, session: aiohttp.ClientSession, url: str) -> Optional[str]:
+        """Return the current page at url, from the cache when it has not changed, or None."""
+        cached = self.cache.get(url) if self.cache else None
+        headers = {}
+        if cached is not None:
+            if "etag" in cached[1]:
+                headers["If-None-Match"] = cached[1]["etag"]
+            if "last_modified" in cached[1]:
+                headers["If-Modified-Since"] = cached[1]["last_modified"]
+
+        await self._wait_for_host(url)
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    self.stats["not_modified"] += 1
+                    return cached[0]
+                response.raise_for_status()
+                page = await response.text()
+                validators = {}
+                if "ETag" in response.headers:
+                    validators["etag"] = response.headers["ETag"]
+                if "Last-Modified" in response.headers:
+                    validators["last_modified"] = response.headers["Last-Modified"]
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError) as e:
+            if cached is not None:
+                self.stats["stale"] += 1
+                print(f"Using the cached copy of {url}: {e!r}", file=sys.stderr)
+                return cached[0]
+            self.stats["failed"] += 1
+            print(f"Could not fetch {url}: {e!r}", file=sys.stderr)
+            return None
+
+        self.stats["fetched"] += 1
+        if self.cache is not None:
+            self.cache.put(url, page, validators)
+        return page
+
+    async def ingest(self, urls: Iterable[str], executor: Optional[Executor] = None) -> Set[str]:
+        """Return the words of every page in urls."""
+        self.stats = dict.fromkeys(("fetched", "not_modified", "stale", "failed"), 0)
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        for url in dict.fromkeys(urls):
+            queue.put_nowait(url)
+        unique_words: Set[str] = set()
+
+        async def fetcher(session):
+            while True:
+                try:
+                    url = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                page = await self._fetch(session, url)
+                if page:
+                    unique_words.update(await loop.run_in_executor(pool, self.tokenizer, page))
+
+        pool = executor or ProcessPoolExecutor(self.workers)
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host_connections)
+        try:
+            async with aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+                await asyncio.gather(*[fetcher(session) for _ in range(min(self.max_connections, queue.qsize()))])
+        finally:
+            if executor is None:
+                pool.shutdown()
+
+        # stdout may carry responses, so the report goes to stderr
+        print(f"Ingested {len(unique_words)} words: " + ", ".join(f"{count} {name}" for name, count in self.stats.items()),
+              file=sys.stderr)
+        return unique_words
@@ -0,0 +1,26 @@
+from pathlib import Path
+from typing import Dict, Optional
+
+# Weights are stored as 32-bit counts in the trie
+MAX_WEIGHT = 2**32 - 1
+
+
+def read_weights(path: Optional[str]) -> Dict[str, int]:
+    """Read a word count file into {word: count}.
+
+    Every line is a word and how often it is used, separated by whitespace or
+    a tab ("the 23135851162"), as in the usual unigram frequency lists. Words
+    are lowercased, a word listed twice keeps its larger count, and lines
+    that do not parse are skipped. Without a file there are no weights.
+    """
+    weights: Dict[str, int] = {}
+    if path is None or not Path(path).is_file():
+        return weights
+    with open(path, encoding="utf-8", errors="replace") as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) != 2 or not fields[1].isdigit():
+                continue
+            word = fields[0].lower()
+            weights[word] = max(weights.get(word, 0), min(int(fields[1]), MAX_WEIGHT))
+    return weights
@@ -0,0 +1,57 @@
+import json
+import threading
+from typing import BinaryIO, Optional
+
+# Every message is a 4-byte big-endian length followed by that many bytes of UTF-8 JSON
+HEADER_SIZE = 4
+MAX_FRAME_SIZE = 64 * 2**20
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(stream: BinaryIO) -> Optional[dict]:
+    """Return the next message on stream, or None once it is closed.
+
+    Raises ValueError for a frame that is too large, cut short or not a JSON object.
+    """
+    header = _read_exactly(stream, HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) < HEADER_SIZE:
+        raise ValueError("The stream ended inside a frame header")
+
+    size = int.from_bytes(header, "big")
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {size} bytes is larger than {MAX_FRAME_SIZE}")
+    body = _read_exactly(stream, size)
+    if len(body) < size:
+        raise ValueError("The stream ended inside a frame")
+
+    message = json.loads(body)
+    if not isinstance(message, dict):
+        raise ValueError("A frame must hold a JSON object")
+    return message
+
+
+class FrameWriter:
+    """Writes messages as frames, whole, from any number of threads."""
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def write(self, message: dict) -> None:
+        body = json.dumps(message).encode()
+        frame = len(body).to_bytes(HEADER_SIZE, "big") + body
+        with self._lock:
+            self.stream.write(frame)
+            self.stream.flush()
@@ -0,0 +1,285 @@
+/*
+ * A warm pool of long-lived `processor.py --framed` workers. Each worker loads
+ * the dictionary once (mapping the shared snapshot) and then serves requests
+ * for as long as it lives. Requests are length-prefixed JSON frames tagged
+ * with an id, so many of them can be in flight on one worker at a time and
+ * the replies are matched up by id in whatever order they come back.
+ */
+
+import { spawn, ChildProcess } from 'child_process';
+
+const HEADER_SIZE = 4;
+
+interface WorkerMessage {
+  id?: number;
+  data?: unknown;
+  error?: string;
+  invalid?: boolean;
+  superseded?: boolean;
+  ready?: boolean;
+}
+
+// The data of a reply, and whether the worker dropped the request because a newer
+// one of its session arrived (the data is then empty)
+export interface WorkerReply<T> {
+  data: T;
+  superseded: boolean;
+}
+
+interface PendingRequest {
+  resolve: (reply: WorkerReply<any>) => void;
+  reject: (error: Error) => void;
+  timer: NodeJS.Timeout;
+}
+
+export interface PythonPoolOptions {
+  size: number;                 // number of worker processes
+  cwd: string;                  // directory of processor.py
+  python?: string;              // interpreter to run it with
+  threads?: number;             // threads per worker (processor.py --threads)
+  requestTimeoutMs?: number;    // a request without a reply by then fails
+  startupTimeoutMs?: number;    // a worker that is not ready by then is restarted
+  healthIntervalMs?: number;    // how often every ready worker is health checked
+  restartDelayMs?: number;      // pause before replacing a worker that exited
+}
+
+// Splits a byte stream into frames: a 4-byte big-endian length, then that many bytes of JSON
+class FrameReader {
+  private buffer = Buffer.alloc(0);
+
+  push(chunk: Buffer): WorkerMessage[] {
+    this.buffer = this.buffer.length ? Buffer.concat([this.buffer, chunk]) : chunk;
+    const messages: WorkerMessage[] = [];
+    while (this.buffer.length >= HEADER_SIZE) {
+      const size = this.buffer.readUInt32BE(0);
+      if (this.buffer.length < HEADER_SIZE + size) {
+        break;
+      }
+      messages.push(JSON.parse(this.buffer.subarray(HEADER_SIZE, HEADER_SIZE + size).toString('utf8')));
+      this.buffer = this.buffer.subarray(HEADER_SIZE + size);
+    }
+    return messages;
+  }
+}
+
+function encodeFrame(message: object): Buffer {
+  const body = Buffer.from(JSON.stringify(message), 'utf8');
+  const header = Buffer.alloc(HEADER_SIZE);
+  header.writeUInt32BE(body.length, 0);
+  return Buffer.concat([header, body]);
+}
+
+// A request the worker refused as invalid (such as an unknown layout), rather than failed to answer
+export class InvalidRequestError extends Error {}
+
+class PythonWorker {
+  readonly process: ChildProcess;
+  readonly ready: Promise<void>;
+  isReady = false;
+  private pending = new Map<number, PendingRequest>();
+  private nextId = 1;
+  private reader = new FrameReader();
+
+  constructor(private options: Required<PythonPoolOptions>, onExit: (worker: PythonWorker) => void) {
+    this.process = spawn(options.python, ['processor.py', '--framed', '--threads', String(options.threads)], {
+      cwd: options.cwd,
+    });
+
+    let markReady: () => void;
+    let failStartup: (error: Error) => void;
+    this.ready = new Promise<void>((resolve, reject) => {
+      markReady = resolve;
+      failStartup = reject;
+    });
+    // Nobody may be waiting for a worker that is being replaced
+    this.ready.catch(() => {});
+
+    const startupTimer = setTimeout(() => {
+      failStartup(new Error(`Python worker was not ready after ${options.startupTimeoutMs} ms`));
+      this.process.kill();
+    }, options.startupTimeoutMs);
+
+    this.process.stdout?.on('data', (chunk: Buffer) => {
+      let messages: WorkerMessage[];
+      try {
+        messages = this.reader.push(chunk);
+      } catch (error) {
+        // A garbled stream cannot be resynchronized
+        console.error('Invalid frame from Python worker:', error);
+        this.process.kill();
+        return;
+      }
+
+      for (const message of messages) {
+        if (message.ready) {
+          clearTimeout(startupTimer);
+          this.isReady = true;
+          markReady();
+          continue;
+        }
+
+        const request = message.id === undefined ? undefined : this.pending.get(message.id);
+        if (!request) {
+          continue;   // it timed out already
+        }
+        this.pending.delete(message.id!);
+        clearTimeout(request.timer);
+        if (message.error !== undefined) {
+          request.reject(message.invalid ? new InvalidRequestError(message.error) : new Error(message.error));
+        } else {
+          request.resolve({ data: message.data, superseded: message.superseded === true });
+        }
+      }
+    });
+
+    this.process.stderr?.on('data', (data: Buffer) => {
+      console.error(`Python error: ${data.toString()}`);
+    });
+
+    this.process.on('exit', (code, signal) => {
+      clearTimeout(startupTimer);
+      this.isReady = false;
+      failStartup(new Error(`Python worker exited (code ${code}, signal ${signal}) before it was ready`));
+      for (const request of this.pending.values()) {
+        clearTimeout(request.timer);
+        request.reject(new Error(`Python worker exited (code ${code}, signal ${signal})`));
+      }
+      this.pending.clear();
+      onExit(this);
+    });
+  }
+
+  get inFlight(): number {
+    return this.pending.size;
+  }
+
+  request<T>(payload: object, timeoutMs: number = this.options.requestTimeoutMs): Promise<WorkerReply<T>> {
+    return new Promise<WorkerReply<T>>((resolve, reject) => {
+      const id = this.nextId++;
+      const timer = setTimeout(() => {
+        this.pending.delete(id);
+        reject(new Error(`Python worker did not answer within ${timeoutMs} ms`));
+      }, timeoutMs);
+      this.pending.set(id, { resolve, reject, timer });
+      // Requests are pipelined: there is no waiting for the previous reply
+      this.process.stdin?.write(encodeFrame({ ...payload, id }));
+    });
+  }
+
+  kill(): void {
+    this.process.kill();
+  }
+}
+
+// FNV-1a, to spread affinity keys over the workers
+function hashString(text: string): number {
+  let hash = 0x811c9dc5;
+  for (let i = 0; i < text.length; i++) {
+    hash ^= text.charCodeAt(i);
+    hash = Math.imul(hash, 0x01000193);
+  }
+  return hash >>> 0;
+}
+
+export class PythonWorkerPool {
+  private options: Required<PythonPoolOptions>;
+  private workers: PythonWorker[] = [];
+  private healthTimer: NodeJS.Timeout | null = null;
+  private closed = false;
+
+  constructor(options: PythonPoolOptions) {
+    this.options = {
+      python: 'python',
+      threads: 4,
+      requestTimeoutMs: 30000,
+      startupTimeoutMs: 120000,
+      healthIntervalMs: 10000,
+      restartDelayMs: 1000,
+      ...options,
+    };
+    if (this.options.size < 1) {
+      throw new Error('A Python worker pool needs at least one worker');
+    }
+  }
+
+  // Starts every worker and resolves once all of them have loaded the dictionary
+  async start(): Promise<void> {
+    for (let i = 0; i < this.options.size; i++) {
+      this.workers.push(this.spawnWorker());
+    }
+    await Promise.all(this.workers.map(worker => worker.ready));
+
+    this.healthTimer = setInterval(() => this.checkHealth(), this.options.healthIntervalMs);
+    this.healthTimer.unref();
+  }
+
+  // Sends payload to a ready worker and resolves with the data of its reply
+  request<T>(payload: object, affinity?: string): Promise<T> {
+    return this.reply<T>(payload, affinity).then(reply => reply.data);
+  }
+
+  // Sends payload to a ready worker and resolves with its whole reply. Requests with
+  // the same affinity go to the same worker while it is ready, so a typing session keeps
+  // its trie cursor and identical words share one lookup; the others (and those whose
+  // worker is down) go to the ready worker with the fewest requests in flight
+  reply<T>(payload: object, affinity?: string): Promise<WorkerReply<T>> {
+    if (affinity !== undefined) {
+      const worker = this.workers[hashString(affinity) % this.workers.length];
+      if (worker?.isReady) {
+        return worker.request<T>(payload);
+      }
+    }
+
+    let best: PythonWorker | null = null;
+    for (const worker of this.workers) {
+      if (worker.isReady && (!best || worker.inFlight < best.inFlight)) {
+        best = worker;
+      }
+    }
+    if (!best) {
+      return Promise.reject(new Error('No Python worker is ready'));
+    }
+    return best.request<T>(payload);
+  }
+
+  close(): void {
+    this.closed = true;
+    if (this.healthTimer) {
+      clearInterval(this.healthTimer);
+    }
+    for (const worker of this.workers) {
+      worker.kill();
+    }
+  }
+
+  private spawnWorker(): PythonWorker {
+    return new PythonWorker(this.options, exited => this.replaceWorker(exited));
+  }
+
+  // A worker that exited is replaced by a fresh one after a short pause
+  private replaceWorker(exited: PythonWorker): void {
+    if (this.closed) {
+      return;
+    }
+    console.error(`Python worker ${exited.process.pid} exited, starting a new one`);
+    setTimeout(() => {
+      const index = this.workers.indexOf(exited);
+      if (!this.closed && index !== -1) {
+        this.workers[index] = this.spawnWorker();
+      }
+    }, this.options.restartDelayMs);
+  }
+
+  // A worker that does not answer a health check in time is killed, and so replaced
+  private checkHealth(): void {
+    for (const worker of this.workers) {
+      if (!worker.isReady) {
+        continue;
+      }
+      worker.request({ health: true }, this.options.requestTimeoutMs).catch(error => {
+        console.error(`Python worker ${worker.process.pid} failed its health check:`, error.message);
+        worker.kill();
+      });
+    }
+  }
+}
@@ -8,23 +8,16 @@
 import express, { Request, Response } from 'express';
 import rateLimit from 'express-rate-limit';
 import cors from 'cors';
-import { spawn, ChildProcess } from 'child_process';
 import path from 'path';
-import Piscina from 'piscina';
 import { fileURLToPath } from 'url';
 import { dirname } from 'path';
+import { randomUUID } from 'crypto';
+import { InvalidRequestError, PythonWorkerPool, type WorkerReply } from './pythonPool.js';
+import type { AutocorrectRequest, BatchAutocorrectRequest, DictionaryUpdateRequest, DictionaryUpdateResult, Misspelling, SpellcheckRequest } from './types/index.js';
 
 const __filename = fileURLToPath(import.meta.url);
 const __dirname = dirname(__filename);
 
-const workerPool = new Piscina({
-  filename: path.resolve(__dirname, 'pythonWorker.js'),
-  minThreads: 2,
-  maxThreads: 4,
-});
-
-
-
 // Express app setup
 const app = express();
 const port = process.env.PORT || 3000;
@@ -45,7 +38,13 @@ const corsOptions = {
 };
 
 
+// Whole documents are checked at /api/spellcheck, so it takes far larger bodies than the
+// other routes; a plain text body is not parsed at all, but streamed to the worker
+const MAX_DOCUMENT_SIZE = process.env.MAX_DOCUMENT_SIZE || '50mb';
+const DOCUMENT_PIECE_LENGTH = 64 * 1024;
+
 // Middleware
+app.use('/api/spellcheck', express.json({ limit: MAX_DOCUMENT_SIZE }));
 app.use(express.json());
 app.use(cors(corsOptions));
 
@@ -60,124 +59,175 @@ const limiter = rateLimit({
   legacyHeaders: false,
 });
 
-// Python process management
-let pythonProcess: ChildProcess | null = null;
+// Warm processor.py workers; each one answers many requests at a time over its own pipes
+const pythonPool = new PythonWorkerPool({
+  size: Number(process.env.PYTHON_WORKERS) || 2,
+  cwd: path.join(__dirname, 'python'), // This works with ES Modules
+  threads: Number(process.env.PYTHON_THREADS) || 4,
+});
 
-// Initialize Python backend
-function initializePythonBackend(): Promise<void> {
-  return new Promise((resolve, reject) => {
-    console.log('Initializing Python backend...');
-    pythonProcess = spawn('python', ['processor.py'], {
-      cwd: path.join(__dirname, 'python') // This works with ES Modules
-    });
+// Initialize Python backend; resolves once every worker has loaded the dictionary
+async function initializePythonBackend(): Promise<void> {
+  console.log('Initializing Python backend...');
+  await pythonPool.start();
+}
 
-    pythonProcess.stderr?.on('data', (data: Buffer) => {
-      console.error(`Python error: ${data.toString()}`);
-    });
+// Consolidated word processing function. A session's keystrokes all go to one worker,
+// which keeps its trie cursor and drops the ones it has not started on when the next
+// arrives; without a session, the same word goes to one worker, so concurrent
+// requests for it share a lookup
+async function handleWordProcessing(word: string, layout?: string, session?: string): Promise<WorkerReply<string[]>> {
+  return pythonPool.reply<string[]>({ word, layout, session }, session ?? `${layout ?? ''}:${word}`);
+}
 
-    pythonProcess.on('close', (code: number) => {
-      if (code !== 0) {
-        reject(new Error(`Python process exited with code ${code}`));
-      }
-    });
+// Processes several words in one round trip; the result has one list of suggestions per word
+async function handleBatchProcessing(words: string[], layout?: string): Promise<string[][]> {
+  return pythonPool.request<string[][]>({ words, layout });
+}
 
-    setTimeout(() => resolve(), 13000);
-  });
+// Splits a document into the pieces it is sent to a worker in, never inside a surrogate pair
+function* textPieces(text: string): Generator<string> {
+  for (let start = 0; start < text.length;) {
+    let end = Math.min(start + DOCUMENT_PIECE_LENGTH, text.length);
+    if (end < text.length && /[\uD800-\uDBFF]/.test(text[end - 1])) {
+      end--;
+    }
+    yield text.slice(start, end);
+    start = end;
+  }
 }
 
-// A queue to handle requests
-let requestQueue: { word: string, resolve: Function, reject: Function }[] = [];
-let isProcessing = false;
+// Adds and removes dictionary words, and learns from picked suggestions; the other
+// workers pick the change up before their next request
+async function handleDictionaryUpdate(add: string[], remove: string[], accept: string[]): Promise<DictionaryUpdateResult> {
+  return pythonPool.request<DictionaryUpdateResult>({ add, remove, accept });
+}
+
+// Requests the worker refused (an unknown layout) are the client's fault, anything else is ours
+function errorStatus(error: unknown): number {
+  return error instanceof InvalidRequestError ? 400 : 500;
+}
 
-// Handle Python backend responses
-pythonProcess?.stdout?.on('data', (data: Buffer) => {
+// Routes
+app.post('/api/autocorrect', async (
+  req: Request<{}, {}, AutocorrectRequest>,
+  res: Response<{ suggestions: string[], superseded?: boolean, error?: string }>
+) => {
   try {
-    const result = JSON.parse(data.toString());
-    const currentRequest = requestQueue.shift(); // Remove the first request from the queue
-    if (currentRequest) {
-      currentRequest.resolve(result);
+    const { input_word, layout, session_id } = req.body;
+    if (!input_word) {
+      return res.status(400).json({
+        suggestions: [],
+        error: 'Input word is required'
+      });
     }
-    isProcessing = false;
-    processNextInQueue();
+
+    // A superseded reply has no suggestions; the client keeps showing the newer request's
+    const { data, superseded } = await handleWordProcessing(input_word, layout, session_id);
+    res.json({ suggestions: data, superseded });
   } catch (error) {
-    console.error('Error parsing Python response:', error);
-    const currentRequest = requestQueue.shift();
-    if (currentRequest) {
-      currentRequest.reject(error);
-    }
-    isProcessing = false;
-    processNextInQueue();
+    console.error('Error processing word:', error);
+    res.status(errorStatus(error)).json({
+      suggestions: [],
+      error: error instanceof Error ? error.message : 'Unknown error occurred'
+    });
   }
 });
 
-// Consolidated word processing function
-async function handleWordProcessing(word: string): Promise<string[]> {
-  return new Promise((resolve, reject) => {
-    if (!pythonProcess) {
-      reject(new Error('Python backend not initialized'));
-      return;
+app.post('/api/autocorrect/batch', async (
+  req: Request<{}, {}, BatchAutocorrectRequest>,
+  res: Response<{ suggestions: string[][], error?: string }>
+) => {
+  try {
+    const { input_words, layout } = req.body;
+    if (!Array.isArray(input_words) || input_words.some(word => typeof word !== 'string')) {
+      return res.status(400).json({
+        suggestions: [],
+        error: 'input_words must be an array of words'
+      });
     }
 
-    requestQueue.push({ word, resolve, reject });
-    processNextInQueue();
-  });
-}
-
-// Function to process the next word in the queue
-function processNextInQueue() {
-  if (isProcessing || requestQueue.length === 0) {
-    return;
+    const result = await handleBatchProcessing(input_words, layout);
+    res.json({ suggestions: result });
+  } catch (error) {
+    console.error('Error processing words:', error);
+    res.status(errorStatus(error)).json({
+      suggestions: [],
+      error: error instanceof Error ? error.message : 'Unknown error occurred'
+    });
   }
+});
 
-  const currentRequest = requestQueue[0];
-  isProcessing = true;
-
-  const input = JSON.stringify({ word: currentRequest.word }) + '\n';
-  if (!pythonProcess?.stdin?.write(input)) {
-    pythonProcess.stdin.once('drain', () => {
-      processNextInQueue();
-    });
-    return;
+// Answers with one JSON line per misspelled word, in document order, written as soon as
+// the piece of the document it is in was checked. The document is a plain text body
+// (layout in the query string), read as it arrives, or a JSON body's text
+app.post('/api/spellcheck', async (
+  req: Request<{}, {}, SpellcheckRequest>,
+  res: Response
+) => {
+  let pieces: AsyncIterable<string> | Iterable<string>;
+  let layout: string | undefined;
+  if (req.is('text/plain')) {
+    req.setEncoding('utf8');   // a character split across chunks is decoded once it is whole
+    pieces = req as AsyncIterable<string>;
+    layout = typeof req.query.layout === 'string' ? req.query.layout : undefined;
+  } else {
+    const { text, layout: bodyLayout } = req.body ?? {};
+    if (typeof text !== 'string') {
+      return res.status(400).json({ error: 'text must be a string' });
+    }
+    pieces = textPieces(text);
+    layout = bodyLayout;
   }
 
-  const onData = (data: Buffer) => {
-    try {
-      const result = JSON.parse(data.toString());
-      currentRequest.resolve(result);
-    } catch (err) {
-      currentRequest.reject(err);
-    } finally {
-      isProcessing = false;
-      requestQueue.shift();
-      processNextInQueue();
-
-      pythonProcess.stdout?.off('data', onData);
+  // Every piece goes to the worker that holds the document, after the previous one's reply
+  const document = randomUUID();
+  let start = true;
+  const send = async (text: string, end: boolean) => {
+    const found = await pythonPool.request<Misspelling[]>({ document, text, layout, start, end }, document);
+    start = false;
+    if (!res.headersSent) {
+      res.type('application/x-ndjson');
+    }
+    if (found.length > 0) {
+      res.write(found.map(misspelling => JSON.stringify(misspelling) + '\n').join(''));
     }
   };
 
-  pythonProcess.stdout?.on('data', onData);
-}
+  try {
+    for await (const piece of pieces) {
+      await send(piece, false);
+    }
+    await send('', true);
+    res.end();
+  } catch (error) {
+    console.error('Error checking document:', error);
+    if (res.headersSent) {
+      res.destroy();   // the misspellings so far went out; there is no status left to send
+      return;
+    }
+    res.status(errorStatus(error)).json({
+      error: error instanceof Error ? error.message : 'Unknown error occurred'
+    });
+  }
+});
 
-// Routes
-app.post('/api/autocorrect', async (
-  req: Request<{}, {}, { input_word: string }>,
-  res: Response<{ suggestions: string[], error?: string }>
+app.post('/api/dictionary', limiter, async (
+  req: Request<{}, {}, DictionaryUpdateRequest>,
+  res: Response<DictionaryUpdateResult | { error: string }>
 ) => {
   try {
-    const { input_word } = req.body;
-    if (!input_word) {
-      return res.status(400).json({
-        suggestions: [],
-        error: 'Input word is required'
-      });
+    const { add = [], remove = [], accept = [] } = req.body;
+    const isWordList = (words: unknown) => Array.isArray(words) && words.every(word => typeof word === 'string');
+    if (!isWordList(add) || !isWordList(remove) || !isWordList(accept)) {
+      return res.status(400).json({ error: 'add, remove and accept must be arrays of words' });
     }
 
-    const result = await handleWordProcessing(input_word);
-    res.json({ suggestions: result });
+    const result = await handleDictionaryUpdate(add, remove, accept);
+    res.json(result);
   } catch (error) {
-    console.error('Error processing word:', error);
+    console.error('Error updating dictionary:', error);
     res.status(500).json({
-      suggestions: [],
       error: error instanceof Error ? error.message : 'Unknown error occurred'
     });
   }
@@ -198,9 +248,7 @@ async function startServer(): Promise<void> {
 
 // Handle graceful shutdown
 process.on('SIGTERM', () => {
-  if (pythonProcess) {
-    pythonProcess.kill();
-  }
+  pythonPool.close();
   process.exit(0);
 });
 
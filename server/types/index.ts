@@ -2,6 +2,37 @@
 // server/types/index.ts
 export interface AutocorrectRequest {
   input_word: string;
+  layout?: string;   // keyboard layout name, defaults to qwerty
+  session_id?: string;   // lets the backend resume from the previous keystroke of this client
+}
+
+export interface BatchAutocorrectRequest {
+  input_words: string[];
+  layout?: string;
+}
+
+export interface SpellcheckRequest {
+  text: string;
+  layout?: string;
+}
+
+export interface Misspelling {
+  offset: number;   // position of the word in the text, in characters
+  token: string;
+  suggestions: string[];
+}
+
+export interface DictionaryUpdateRequest {
+  add?: string[];
+  remove?: string[];
+  accept?: string[];   // suggestions the user picked, which then rank higher
+}
+
+export interface DictionaryUpdateResult {
+  added: number;
+  removed: number;
+  accepted: number;
+  size: number;   // number of words in the dictionary after the update
 }
 
 export interface AutocorrectResponse {